@@ -0,0 +1,136 @@
+import sys
+import json
+import asyncio
+import argparse
+import importlib
+from pathlib import Path
+
+from bodspipelines.infrastructure.storage import Storage
+from bodspipelines.infrastructure.inputs import KinesisInput, FileInput
+from bodspipelines.infrastructure.outputs import KinesisOutput, NullOutput, FileOutput
+from bodspipelines.infrastructure.clients.memory_client import MemoryClient
+from bodspipelines.infrastructure.metrics import metrics
+
+
+class LocalFiles:
+    """Origin yielding local data files (in place of downloading)"""
+    def __init__(self, paths):
+        """Initial setup"""
+        self.paths = [Path(path) for path in paths]
+
+    def prepare(self, path, name, updates=False):
+        """Yield data files"""
+        yield from self.paths
+
+
+def offline(stage, files=None, inputs=None, output=None, store=True):
+    """Replace services used by stage with local files and in-memory storage
+
+    files: source name -> list of data files to read (in place of download)
+    inputs: source name -> file of JSON records (in place of Kinesis stream)
+    output: file to write output JSON records to (otherwise discarded)
+    store: keep items in memory (otherwise null storage, where every item is new)
+
+    Returns replaced (component, attribute, value) for restoring afterwards."""
+    replaced = []
+
+    def replace(component, attribute, value):
+        replaced.append((component, attribute, getattr(component, attribute)))
+        setattr(component, attribute, value)
+
+    for source in stage.sources:
+        if files and source.name in files:
+            replace(source, "origin", LocalFiles(files[source.name]))
+        elif inputs and source.name in inputs:
+            replace(source, "origin", FileInput(inputs[source.name]))
+        elif isinstance(source.origin, KinesisInput):
+            raise ValueError(f"No input file for {source.name} source")
+    clients = {}
+    for component in stage.outputs + stage.processors:
+        storage = getattr(component, "storage", None)
+        if isinstance(storage, Storage) and not isinstance(storage.storage, MemoryClient):
+            client = clients.get(id(storage.storage))
+            if client is None:
+                client = clients[id(storage.storage)] = MemoryClient(storage.storage.indexes, store=store)
+            replace(storage, "storage", client)
+        if isinstance(getattr(component, "output", None), KinesisOutput):
+            replace(component, "output", FileOutput(output) if output else NullOutput())
+    return replaced
+
+
+def report(summary):
+    """Table of items, rate and time for each component
+
+    Busy time is time spent in the component (processors and storage), and
+    active time is from first to last item (sources, including downstream
+    processing between items)."""
+    lines = [f"Elapsed: {summary['elapsed_seconds']:.2f}s", "",
+             f"{'component':40} {'items':>10} {'items/s':>10} {'time s':>8} {'items/time s':>12}"]
+    for component, values in sorted(summary["components"].items()):
+        if not "items_total" in values:
+            continue
+        time = values.get("latency_seconds", {}).get("sum", values.get("active_seconds"))
+        lines.append(f"{component:40} {values['items_total']:10d} {values['items_per_second']:10.0f} "
+                     f"{time if time is not None else float('nan'):8.2f} "
+                     f"{values['items_total'] / time if time else float('nan'):12.0f}")
+    return "\n".join(lines) + "\n"
+
+
+async def run_benchmark(pipeline, stage_name, updates=False, **options):
+    """Process pipeline stage offline, returning metrics summary"""
+    stage = pipeline.get_stage(stage_name)
+    replaced = offline(stage, **options)
+    metrics.reset()
+    try:
+        await pipeline.process_stage(stage_name, updates=updates)
+    finally:
+        for component, attribute, value in replaced:
+            setattr(component, attribute, value)
+    return metrics.summary()
+
+
+def benchmark(pipeline, stage_name, updates=False, **options):
+    """Process pipeline stage without Elasticsearch or Kinesis, returning metrics summary"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(run_benchmark(pipeline, stage_name, updates=updates, **options))
+
+
+def source_files(values, multiple=False):
+    """Parse NAME=PATH arguments"""
+    out = {}
+    for value in values or []:
+        name, path = value.split("=", 1)
+        if multiple:
+            out.setdefault(name, []).append(path)
+        else:
+            out[name] = path
+    return out
+
+
+def main(args=None):
+    """Run pipeline stage benchmark from command line"""
+    parser = argparse.ArgumentParser(description="Run pipeline stage against local files without services")
+    parser.add_argument("pipeline", help="pipeline object (e.g. bodspipelines.pipelines.gleif.config:pipeline)")
+    parser.add_argument("stage", help="stage name")
+    parser.add_argument("--file", action="append", metavar="SOURCE=PATH",
+                        help="data file for source (repeat for several)")
+    parser.add_argument("--input", action="append", metavar="SOURCE=PATH",
+                        help="JSON records file for stream source")
+    parser.add_argument("--output", help="file for output JSON records (default discard)")
+    parser.add_argument("--null-storage", action="store_true", help="store nothing (every item is new)")
+    parser.add_argument("--updates", action="store_true", help="process as updates")
+    parser.add_argument("--summary", help="file for JSON metrics summary")
+    args = parser.parse_args(args)
+    module_name, name = args.pipeline.split(":")
+    pipeline = getattr(importlib.import_module(module_name), name)
+    Path("data").mkdir(exist_ok=True)
+    summary = benchmark(pipeline, args.stage, updates=args.updates, files=source_files(args.file, multiple=True),
+                        inputs=source_files(args.input), output=args.output, store=not args.null_storage)
+    sys.stdout.write(report(summary))
+    if args.summary:
+        Path(args.summary).write_text(json.dumps(summary, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,351 @@
 #from functools import wraps
+import os
+import sys
+import json
+import marshal
+import sqlite3
+import asyncio
 import inspect
+import tempfile
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from bodspipelines.infrastructure.log import get_logger
+from bodspipelines.infrastructure.utils import load_last_run
+
+logger = get_logger("caching")
 
 def get_id(storage, item_type, item):
     """Get item id given item and item_type"""
     return storage.storage.indexes[item_type]['id'](item)
 
+def pack_uuid(value):
+    """16 byte value for UUID string (or None if not lowercase hyphenated UUID string)"""
+    if (type(value) is not str or len(value) != 36 or value[8] != "-" or value[13] != "-" or
+        value[18] != "-" or value[23] != "-" or value != value.lower()):
+        return None
+    try:
+        packed = bytes.fromhex(value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:])
+    except ValueError:
+        return None
+    return packed if len(packed) == 16 else None
+
+def unpack_uuid(packed):
+    """UUID string for 16 byte value"""
+    value = packed.hex()
+    return f"{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}"
+
+def intern(value):
+    """Shared copy of string value"""
+    return sys.intern(value) if type(value) is str else value
+
+def pack_references(references):
+    """Compact (statement ids, latest ids) for list of references (or None if not packable)"""
+    if not isinstance(references, list):
+        return None
+    statement_ids = bytearray()
+    latest_ids = []
+    for reference in references:
+        if len(reference) != 2 or not 'latest_id' in reference:
+            return None
+        packed = pack_uuid(reference.get('statement_id'))
+        if packed is None:
+            return None
+        statement_ids += packed
+        latest_ids.append(intern(reference['latest_id']))
+    return bytes(statement_ids), tuple(latest_ids)
+
+def unpack_references(packed):
+    """List of references from compact (statement ids, latest ids)"""
+    statement_ids, latest_ids = packed
+    return [{'statement_id': unpack_uuid(statement_ids[i*16:i*16+16]), 'latest_id': latest_id}
+            for i, latest_id in enumerate(latest_ids)]
+
+
+class CompactRecords(MutableMapping):
+    """Mapping of id to record with fixed fields, held compactly
+
+    Records are stored in slots: UUID fields packed as 16 bytes in one
+    array, and other fields in a list per field (strings interned), so an
+    entry costs a slot number rather than a dict and its strings. Records
+    which don't fit the fields are kept as they are."""
+    def __init__(self, fields):
+        """Initial setup"""
+        self.fields = fields			# (name, kind) with kind "key", "uuid", "value" or "references"
+        self.names = {name for name, kind in fields}
+        self.key = next(name for name, kind in fields if kind == "key")
+        self.uuids = [name for name, kind in fields if kind == "uuid"]
+        self.size = 16 * len(self.uuids)	# Bytes of packed UUIDs per slot
+        self.columns = {name: [] for name, kind in fields if kind in ("value", "references")}
+        self.kinds = [(name, kind == "references") for name, kind in fields if name in self.columns]
+        self.slots = {}				# Id: slot
+        self.packed = bytearray()		# UUID fields for each slot
+        self.raw = {}				# Slot: record not fitting fields
+        self.missing = set()			# (Slot, name) for UUID fields set to None
+        self.free = []				# Slots of deleted records
+
+    def allocate(self):
+        """Slot for new record"""
+        if self.free:
+            return self.free.pop()
+        slot = len(self.slots)
+        self.packed.extend(bytes(self.size))
+        for column in self.columns.values():
+            column.append(None)
+        return slot
+
+    def pack(self, item_id, record):
+        """Packed UUIDs and column values for record (or None if record doesn't fit fields)"""
+        if not isinstance(record, dict) or record.keys() != self.names or record[self.key] != item_id:
+            return None
+        uuids = b""
+        missing = []
+        for name in self.uuids:
+            if record[name] is None:
+                missing.append(name)
+                uuids += bytes(16)
+                continue
+            packed = pack_uuid(record[name])
+            if packed is None:
+                return None
+            uuids += packed
+        values = []
+        for name, references in self.kinds:
+            value = pack_references(record[name]) if references else intern(record[name])
+            if references and value is None:
+                return None
+            values.append(value)
+        return uuids, values, missing
+
+    def __setitem__(self, item_id, record):
+        item_id = intern(item_id)
+        slot = self.slots.get(item_id)
+        if slot is None:
+            slot = self.slots[item_id] = self.allocate()
+        packed = self.pack(item_id, record)
+        if packed is None:
+            self.raw[slot] = record
+            return
+        if self.raw: self.raw.pop(slot, None)
+        self.packed[slot*self.size:(slot+1)*self.size] = packed[0]
+        for (name, references), value in zip(self.kinds, packed[1]):
+            self.columns[name][slot] = value
+        if self.missing or packed[2]:
+            for name in self.uuids:
+                self.missing.discard((slot, name))
+            self.missing.update((slot, name) for name in packed[2])
+
+    def unpack(self, item_id, slot):
+        """Record in slot"""
+        record = self.raw.get(slot)
+        if record is not None:
+            return record
+        record = {}
+        offset = slot * self.size
+        for name, kind in self.fields:
+            if kind == "key":
+                record[name] = item_id
+            elif kind == "uuid":
+                if self.missing and (slot, name) in self.missing:
+                    record[name] = None
+                else:
+                    record[name] = unpack_uuid(self.packed[offset:offset+16])
+                offset += 16
+            elif kind == "value":
+                record[name] = self.columns[name][slot]
+            else:
+                record[name] = unpack_references(self.columns[name][slot])
+        return record
+
+    def get(self, item_id, default=None):
+        slot = self.slots.get(item_id)
+        return default if slot is None else self.unpack(item_id, slot)
+
+    def __getitem__(self, item_id):
+        return self.unpack(item_id, self.slots[item_id])
+
+    def __delitem__(self, item_id):
+        slot = self.slots.pop(item_id)
+        self.raw.pop(slot, None)
+        for name in self.uuids:
+            self.missing.discard((slot, name))
+        for column in self.columns.values():
+            column[slot] = None
+        self.free.append(slot)
+
+    def __contains__(self, item_id):
+        return item_id in self.slots
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def export(self):
+        """Store contents (as types marshal can write)"""
+        return (self.slots, bytes(self.packed), self.columns, self.raw, self.missing, self.free)
+
+    def restore(self, state):
+        """Replace contents with exported store contents"""
+        self.slots, packed, self.columns, self.raw, self.missing, self.free = state
+        self.packed = bytearray(packed)
+
+
+def compact_cache():
+    """Compact stores for cached updates data (updates are short-lived, so kept as dicts)"""
+    return {"latest": CompactRecords((("latest_id", "key"), ("statement_id", "uuid"), ("reason", "value"))),
+            "references": CompactRecords((("statement_id", "key"), ("references_id", "references"))),
+            "exceptions": CompactRecords((("latest_id", "key"), ("statement_id", "uuid"), ("other_id", "uuid"),
+                                          ("reason", "value"), ("reference", "value"),
+                                          ("entity_type", "value"))),
+            "updates": {}}
+
+
+class DiskRecords(MutableMapping):
+    """Mapping of id to record stored in SQLite table, with recently used records held in memory
+
+    Records are written in batches (so the most recent changes may only be
+    in the pending batch), and don't change while the mapping is iterated.
+    The count of records is updated as batches are written."""
+    def __init__(self, connection, table, lru_size=100000, batch_size=10000):
+        """Initial setup"""
+        self.connection = connection
+        self.cursor = connection.cursor()	# Cursor for single record lookups
+        self.table = table
+        self.lru_size = lru_size		# Maximum records held in memory
+        self.batch_size = batch_size		# Changed records written at once
+        self.recent = OrderedDict()		# Id: record (least recently used first)
+        self.pending = {}			# Id: record (or None if deleted) not yet written
+        self.size = 0				# Records written to table
+        self.select = f'SELECT record FROM "{table}" WHERE id = ?'
+        self.exists = f'SELECT 1 FROM "{table}" WHERE id = ?'
+        connection.execute(f'CREATE TABLE "{table}" (id TEXT PRIMARY KEY, record BLOB) WITHOUT ROWID')
+
+    def remember(self, item_id, record):
+        """Hold record in memory, dropping least recently used record if full"""
+        self.recent[item_id] = record
+        self.recent.move_to_end(item_id)
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+
+    def stored(self, item_id):
+        """Record written to table (or None)"""
+        row = self.cursor.execute(self.select, (item_id,)).fetchone()
+        return None if row is None else marshal.loads(row[0])
+
+    def written(self, item_ids, chunk_size=500):
+        """Ids already written to table"""
+        found = set()
+        for start in range(0, len(item_ids), chunk_size):
+            chunk = item_ids[start:start+chunk_size]
+            found.update(row[0] for row in self.cursor.execute(
+                f'SELECT id FROM "{self.table}" WHERE id IN ({", ".join("?" * len(chunk))})', chunk))
+        return found
+
+    def write(self):
+        """Write pending changes to table"""
+        if not self.pending:
+            return
+        saved = [item_id for item_id, record in self.pending.items() if record is not None]
+        self.size += len(saved) - len(self.written(saved))
+        self.connection.executemany(f'INSERT OR REPLACE INTO "{self.table}" VALUES (?, ?)',
+                                    [(item_id, marshal.dumps(self.pending[item_id])) for item_id in saved])
+        deleted = self.connection.executemany(f'DELETE FROM "{self.table}" WHERE id = ?',
+                                              [(item_id,) for item_id, record in self.pending.items()
+                                               if record is None])
+        self.size -= max(deleted.rowcount, 0)
+        self.connection.commit()
+        self.pending = {}
+
+    def get(self, item_id, default=None):
+        record = self.recent.get(item_id)
+        if record is not None:
+            self.recent.move_to_end(item_id)
+            return record
+        if item_id in self.pending:
+            record = self.pending[item_id]
+        else:
+            record = self.stored(item_id)
+        if record is None:
+            return default
+        self.remember(item_id, record)
+        return record
+
+    def __getitem__(self, item_id):
+        record = self.get(item_id)
+        if record is None:
+            raise KeyError(item_id)
+        return record
+
+    def __contains__(self, item_id):
+        if item_id in self.recent:
+            return True
+        if item_id in self.pending:
+            return self.pending[item_id] is not None
+        return self.cursor.execute(self.exists, (item_id,)).fetchone() is not None
+
+    def __setitem__(self, item_id, record):
+        self.pending[item_id] = record
+        self.remember(item_id, record)
+        if len(self.pending) >= self.batch_size:
+            self.write()
+
+    def __delitem__(self, item_id):
+        if item_id not in self:
+            raise KeyError(item_id)
+        self.recent.pop(item_id, None)
+        self.pending[item_id] = None
+
+    def __iter__(self):
+        self.write()
+        for row in self.connection.execute(f'SELECT id FROM "{self.table}"'):
+            yield row[0]
+
+    def __len__(self):
+        self.write()
+        return self.size
+
+    def items(self):
+        """Ids and records (read in one pass over table)"""
+        self.write()
+        for item_id, record in self.connection.execute(f'SELECT id, record FROM "{self.table}"'):
+            yield item_id, marshal.loads(record)
+
+
+class DiskCache:
+    """On-disk stores for cached updates data, for state too large to hold in memory
+
+    Each store is a table in an SQLite database file (memory-mapped, and
+    without journal as the cache is reloaded each run), created in directory
+    and removed once opened."""
+    def __init__(self, directory, lru_size=100000, batch_size=10000, mmap_size=2**30):
+        """Initial setup"""
+        self.directory = Path(directory)	# Directory for database file
+        self.lru_size = lru_size		# Maximum records held in memory for each store
+        self.batch_size = batch_size		# Changed records written at once
+        self.mmap_size = mmap_size		# Bytes of database file memory-mapped
+
+    def connect(self):
+        """Connection to new database file"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        handle, path = tempfile.mkstemp(prefix="cache-", suffix=".sqlite", dir=self.directory)
+        os.close(handle)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        os.remove(path)
+        return connection
+
+    def records(self):
+        """Stores for cached updates data (updates are short-lived, so kept as a dict)"""
+        connection = self.connect()
+        return {item_type: DiskRecords(connection, item_type, lru_size=self.lru_size, batch_size=self.batch_size)
+                for item_type in ("latest", "references", "exceptions")} | {"updates": {}}
+
+
 class Caching():
     """Caching for updates"""
     def __init__(self):
@@ -16,7 +357,7 @@ class Caching():
     async def load(self, storage):
         """Load data into cache"""
         for item_type in self.cache:
-            print(f"Loading cache for {item_type}")
+            logger.info("loading cache", extra={"item_type": item_type})
             async for item in storage.stream_items(item_type):
                 #print(item_type, item)
                 item_id = get_id(storage, item_type, item)
@@ -149,30 +490,183 @@ class Caching():
 #    if batch: await cache.check_batch(storage)
 #    return out
 
+# Version of cache snapshot format
+snapshot_version = 1
+
+
+class CacheSnapshot:
+    """Snapshot file of cache contents, for loading in place of scanning storage
+
+    A snapshot is written when the cache is flushed, then stamped with the
+    run id once the run is saved. It is only used if stamped for the last
+    saved run and it has the same number of items as storage. Loading a
+    snapshot marks it used, so it can't be stamped again by a later run
+    which doesn't write a new one."""
+    def __init__(self, path, run_name):
+        """Initial setup"""
+        self.path = Path(path)			# Snapshot data file (details in .json file alongside)
+        self.run_name = run_name		# Name of pipeline runs snapshot is stamped with
+
+    def details_path(self):
+        """Path of snapshot details file"""
+        return self.path.with_name(self.path.name + ".json")
+
+    def details(self):
+        """Snapshot details (or None if no snapshot)"""
+        try:
+            return json.loads(self.details_path().read_text())
+        except (OSError, ValueError):
+            return None
+
+    def write_details(self, details):
+        """Write snapshot details atomically"""
+        path = self.details_path()
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_text(json.dumps(details))
+        os.replace(temp_path, path)
+
+    def save(self, cache, memory_only):
+        """Write snapshot of cache contents"""
+        details = {"version": snapshot_version, "marshal": marshal.version, "state": "writing",
+                   "compact": {item_type: isinstance(cache[item_type], CompactRecords) for item_type in cache},
+                   "counts": {item_type: len(cache[item_type]) for item_type in cache
+                              if not item_type in memory_only}}
+        self.write_details(details)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "wb") as f:
+            marshal.dump({item_type: cache[item_type].export() if details["compact"][item_type]
+                          else cache[item_type] for item_type in details["counts"]}, f)
+        os.replace(temp_path, self.path)
+        self.write_details(details | {"state": "written"})
+
+    def stamp(self, run_id):
+        """Mark snapshot written during run as current for run"""
+        details = self.details()
+        if details and details["state"] == "written":
+            self.write_details(details | {"state": "stamped", "run": str(run_id)})
+
+    async def valid(self, cache, storage):
+        """Check snapshot matches cache layout and storage state"""
+        details = self.details()
+        if (not details or details["state"] != "stamped" or details["version"] != snapshot_version or
+            details["marshal"] != marshal.version or not self.path.exists()):
+            return False
+        if any(isinstance(cache[item_type], CompactRecords) != compact
+               for item_type, compact in details["compact"].items()):
+            return False
+        try:
+            run = await load_last_run(storage, name=self.run_name)
+        except IndexError:
+            return False
+        if details["run"] != str(run["end_timestamp"]):
+            return False
+        for item_type, count in details["counts"].items():
+            stats = await storage.storage.statistics(item_type)
+            if stats["total"] != count:
+                return False
+        return True
+
+    def load(self, cache):
+        """Load snapshot into cache, marking it used"""
+        details = self.details()
+        with open(self.path, "rb") as f:
+            contents = marshal.load(f)
+        for item_type, data in contents.items():
+            if details["compact"][item_type]:
+                cache[item_type].restore(data)
+            else:
+                cache[item_type] = data
+        self.write_details(details | {"state": "loaded"})
+
+
 class Caching():
     """Caching for updates"""
-    def __init__(self, storage, batching=False):
-        """Setup cache"""
+    def __init__(self, storage, batching=False, compact=True, snapshot=None, disk=None, lazy=False,
+                 fetch_size=1000, load_slices=None):
+        """Setup cache
+
+        With lazy set nothing is loaded up front: items are read from storage
+        when first needed (or prefetched), and ids not found are remembered."""
+        if snapshot and (disk or lazy):
+            raise ValueError("Cache snapshot can't be used with disk cache or lazy loading")
         self.initialised = False
-        self.cache = {"latest": {}, "references": {}, "exceptions": {}, "updates": {}}
+        self.lazy = lazy
+        self.fetch_size = fetch_size		# Maximum ids read from storage at once
+        self.load_slices = load_slices		# Slices scanned concurrently loading each item type (or None)
+        self.absent = {"latest": set(), "references": set(), "exceptions": set()} if lazy else None
+        self.snapshot = snapshot		# CacheSnapshot to load from and save on flush (or None)
+        self.snapshot_saved = False
+        if disk:
+            self.cache = disk.records()
+        elif compact:
+            self.cache = compact_cache()
+        else:
+            self.cache = {"latest": {}, "references": {}, "exceptions": {}, "updates": {}}
         self.batch = {"latest": {}, "references": {}, "exceptions": {}, "updates": {}} if batching else None
         self.batch_size = batching if batching else None
         self.memory_only = ["updates"]
         self.storage = storage
 
     async def load(self):
-        """Load data into cache"""
-        for item_type in self.cache:
-            if not item_type in self.memory_only:
-                print(f"Loading cache for {item_type}")
-                async for item in self.storage.stream_items(item_type):
-                    #print(item_type, item)
-                    item_id = get_id(self.storage, item_type, item)
-                    self.cache[item_type][item_id] = item
+        """Load data into cache (from snapshot if current, or nothing if lazy)"""
+        if self.lazy:
+            self.initialised = True
+            return
+        if self.snapshot and await self.snapshot.valid(self.cache, self.storage):
+            logger.info("loading cache snapshot", extra={"path": str(self.snapshot.path)})
+            self.snapshot.load(self.cache)
+            self.initialised = True
+            return
+        await asyncio.gather(*[self.load_items(item_type) for item_type in self.cache
+                               if not item_type in self.memory_only])
         self.initialised = True
 
+    async def load_items(self, item_type):
+        """Load items of type into cache"""
+        logger.info("loading cache", extra={"item_type": item_type, "slices": self.load_slices})
+        cache = self.cache[item_type]
+        count = 0
+        items = (self.storage.stream_items(item_type, slices=self.load_slices) if self.load_slices
+                 else self.storage.stream_items(item_type))
+        async for item in items:
+            #print(item_type, item)
+            item_id = get_id(self.storage, item_type, item)
+            cache[item_id] = item
+            count += 1
+        logger.info("loaded cache", extra={"item_type": item_type, "items": count})
+
+    async def fetch(self, item_type, item_ids):
+        """Read items not yet cached from storage (if lazy), remembering ids not found"""
+        if not self.lazy or item_type in self.memory_only:
+            return
+        cache = self.cache[item_type]
+        absent = self.absent[item_type]
+        item_ids = [item_id for item_id in dict.fromkeys(item_ids)
+                    if item_id is not None and not item_id in cache and not item_id in absent]
+        for start in range(0, len(item_ids), self.fetch_size):
+            ids = item_ids[start:start+self.fetch_size]
+            logger.debug("fetching items", extra={"item_type": item_type, "items": len(ids)})
+            found = await self.storage.get_items(ids, item_type)
+            for item_id in ids:
+                if item_id in found:
+                    cache[item_id] = found[item_id]
+                else:
+                    absent.add(item_id)
+
+    async def prefetch(self, keys):
+        """Read items for (item type, id) keys not yet cached from storage, in batches (if lazy)"""
+        if not self.lazy:
+            return
+        item_ids = {}
+        for item_type, item_id in keys:
+            item_ids.setdefault(item_type, []).append(item_id)
+        for item_type in item_ids:
+            await self.fetch(item_type, item_ids[item_type])
+
     def _save(self, item_type, item, item_id, overwrite=False):
         """Save item in cache"""
+        if self.lazy and not item_type in self.memory_only:
+            self.absent[item_type].discard(item_id)
         if item_id in self.cache[item_type]:
             if overwrite:
                 self.cache[item_type][item_id] = item
@@ -213,7 +707,7 @@ class Caching():
                      if self.batch[item_type][item_id][0] == action]
             #print(f"{action}: {items}")
             if items:
-                print(f"Flushing {action}: {len(items)} items")
+                logger.debug("writing batch", extra={"item_type": item_type, "action": action, "items": len(items)})
                 await self.storage.dump_stream(item_type, action, self._generate_items(items))
         self.batch[item_type] = {}
 
@@ -225,13 +719,22 @@ class Caching():
                     await self._write_batch(item_type)
 
     async def flush(self):
-        """Check if any item need writing"""
-        print("Flushing cache")
+        """Write any batched items, returning number written once readable from storage"""
+        logger.debug("flushing cache")
+        count = 0
         for item_type in self.batch:
             if not item_type in self.memory_only:
                 #print(f"{item_type}: {len(self.batch[item_type])} items in batch")
                 if len(self.batch[item_type]) > 0:
+                    count += len(self.batch[item_type])
                     await self._write_batch(item_type)
+        if count > 0:
+            await self.storage.flush()
+        if self.snapshot and (count > 0 or not self.snapshot_saved):
+            logger.info("saving cache snapshot", extra={"path": str(self.snapshot.path)})
+            self.snapshot.save(self.cache, self.memory_only)
+            self.snapshot_saved = True
+        return count
 
     def _read(self, item_type, item_id):
         """Read item from cache"""
@@ -243,6 +746,8 @@ class Caching():
             return
         item = self.cache[item_type][item_id]
         del self.cache[item_type][item_id]
+        if self.lazy and not item_type in self.memory_only:
+            self.absent[item_type].add(item_id)
         if not item_type in self.memory_only:
             if item_id in self.batch[item_type] and self.batch[item_type][item_id][0] == 'index':
                 del self.batch[item_type][item_id]
@@ -264,6 +769,7 @@ class Caching():
     async def get(self, item_id, item_type):
         """Get cached item"""
         #print(item_id, item_type)
+        if self.lazy: await self.fetch(item_type, [item_id])
         item = self._read(item_type, item_id)
         #if item:
         #    out = item
@@ -273,6 +779,7 @@ class Caching():
 
     async def delete(self, item_id, item_type, if_exists=False):
         """Delete acched item"""
+        if self.lazy: await self.fetch(item_type, [item_id])
         self._delete(item_type, item_id, if_exists=if_exists)
         #if self._check_batch_item(item_type, item_id):
         #    self._unbatch_item(item_type, item_id)
@@ -2,9 +2,14 @@ import os
 import json
 import asyncio
 import elastic_transport
+from contextlib import aclosing
 from elasticsearch import AsyncElasticsearch
 from elasticsearch.helpers import async_streaming_bulk, async_scan, async_bulk
 
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("elasticsearch")
+
 async def create_client():
     """Create Elasticsearch client"""
     protocol = os.getenv('ELASTICSEARCH_PROTOCOL')
@@ -61,7 +66,7 @@ class ElasticsearchClient:
             await self.client.options(ignore_status=400).indices.create(index=self.index_name,
                                                                         settings=settings,
                                                                         mappings=mappings)
-            print('Elasticserach created Index')
+            logger.info("created index", extra={"index": self.index_name})
 
     async def setup_indexes(self):
         """Setup indexes"""
@@ -72,7 +77,7 @@ class ElasticsearchClient:
                 await self.create_indexes()
                 done = True
             except elastic_transport.ConnectionError:
-                print("Waiting for Elasticsearch to start ...")
+                logger.info("waiting for Elasticsearch to start")
                 await asyncio.sleep(5)
         await self.close()
 
@@ -100,6 +105,10 @@ class ElasticsearchClient:
         stats['total'] = int(result[0]['count'])
         return stats
 
+    async def refresh(self, index_name=None):
+        """Refresh index (or all indexes) so stored data is searchable"""
+        await self.client.indices.refresh(index=index_name if index_name else "_all")
+
     async def store_data(self, data, id=None):
         """Store data in index"""
         if isinstance(data, list):
@@ -126,7 +135,7 @@ class ElasticsearchClient:
     def batch_store_data(self, actions, index_name):
         """Store bulk data in index"""
         errors = self.client.bulk(index=index_name, operations=actions)
-        print("Bulk:", errors)
+        logger.debug("bulk store", extra={"index": index_name, "errors": errors})
         return errors
 
     async def batch_store_data(self, actions, batch, index_name):
@@ -134,6 +143,10 @@ class ElasticsearchClient:
         #await self.create_client()
         record_count = 0
         new_records = 0
+        # First action in batch for each id
+        batch_ids = {}
+        for action in batch:
+            batch_ids.setdefault(action['_id'], action)
         #for b in batch:
         #    print(b['_id'], b['_index'])
         async for ok, result in async_streaming_bulk(client=self.client, actions=actions, raise_on_error=False):
@@ -142,20 +155,19 @@ class ElasticsearchClient:
             if ok:
                 new_records += 1
                 #match = [i for i in batch if i['_id'] == result['create']['_id']]
-                match = [i for i in batch if i['_id'] == result[i['_op_type']]['_id']]
-                if match[0]['_op_type'] == 'delete':
+                match = batch_ids[next(iter(result.values()))['_id']]
+                if match['_op_type'] == 'delete':
                     yield True
                 else:
-                    yield match[0]['_source']
+                    yield match['_source']
             else:
-                print(ok, result)
+                # Not stored (e.g. create conflict for item already stored)
+                logger.debug("item not stored", extra={"result": result})
         if callable(index_name):
             index_name = index_name(batch[0]['_source'])
             #print(f"Storing in {index_name(batch[0]['_source'])}: {record_count} records; {new_records} new records")
-        if batch[0]['_op_type'] == 'delete':
-            print(f"Deleting in {index_name}: {record_count} records; {new_records} records deleted")
-        else:
-            print(f"Storing in {index_name}: {record_count} records; {new_records} new records")
+        logger.debug("deleted batch" if batch[0]['_op_type'] == 'delete' else "stored batch",
+                     extra={"index": index_name, "records": record_count, "changed": new_records})
 
     async def search(self, search):
         """Search index"""
@@ -172,6 +184,11 @@ class ElasticsearchClient:
         else:
             return None
 
+    async def mget(self, index_name, ids):
+        """Get documents with ids in index (id: document for those found)"""
+        response = await self.client.mget(index=index_name, ids=ids)
+        return {doc['_id']: doc['_source'] for doc in response['docs'] if doc.get('found')}
+
     async def delete(self, id):
         """Delete by id"""
         return await self.client.delete(index=self.index_name, id=id)
@@ -180,12 +197,66 @@ class ElasticsearchClient:
         """Delete all documents in index"""
         await self.client.delete_by_query(index=index, query={"query":{"match_all":{}}})
 
-    async def scan_index(self, index):
-        """Scan index"""
-        async for doc in async_scan(client=self.client,
-                                    query={"query": {"match_all": {}}},
-                                    index=index):
-            yield doc
+    async def scan_index(self, index, slices=None):
+        """Scan index (as concurrent sliced scrolls if more than one slice)"""
+        if not slices or slices < 2:
+            async for doc in async_scan(client=self.client,
+                                        query={"query": {"match_all": {}}},
+                                        index=index):
+                yield doc
+            return
+        async with aclosing(self._scan_slices(index, slices)) as docs:
+            async for doc in docs:
+                yield doc
+
+    async def _scan_slices(self, index, slices, chunk_size=500):
+        """Scan index with slices scrolled concurrently, yielding documents as they arrive
+
+        Each slice puts chunks of documents on the queue (at most two per slice
+        waiting), then None when it ends, or the exception if it fails (raised
+        as soon as it is taken from the queue, stopping the other slices)."""
+        chunks = asyncio.Queue()
+        space = asyncio.Semaphore(2 * slices)
+
+        async def put_chunk(chunk):
+            await space.acquire()
+            chunks.put_nowait(chunk)
+
+        async def scan_slice(slice_id):
+            chunk = []
+            try:
+                async for doc in async_scan(client=self.client,
+                                            query={"slice": {"id": slice_id, "max": slices},
+                                                   "query": {"match_all": {}}},
+                                            index=index):
+                    chunk.append(doc)
+                    if len(chunk) >= chunk_size:
+                        await put_chunk(chunk)
+                        chunk = []
+                if chunk: await put_chunk(chunk)
+            except Exception as error:
+                chunks.put_nowait(error)
+                return
+            chunks.put_nowait(None)
+
+        logger.debug("scanning index", extra={"index": index, "slices": slices})
+        tasks = [asyncio.create_task(scan_slice(slice_id)) for slice_id in range(slices)]
+        try:
+            finished = 0
+            while finished < slices:
+                chunk = await chunks.get()
+                if chunk is None:
+                    finished += 1
+                    continue
+                if isinstance(chunk, Exception):
+                    raise chunk
+                space.release()
+                for doc in chunk:
+                    yield doc
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def _generate_actions(self, index_name, action_type, items):
         #if action_type == 'update':
@@ -1,5 +1,5 @@
 import os
-import time
+import asyncio
 import json
 import gzip
 #import boto3
@@ -7,6 +7,11 @@ import gzip
 from pathlib import Path
 from aiobotocore.session import get_session
 
+from bodspipelines.infrastructure.metrics import metrics
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("kinesis")
+
 async def create_client(service):
      """Create AWS client for specified service"""
      #return boto3.client(service, region_name=os.getenv('BODS_AWS_REGION'), aws_access_key_id=os.environ.get('BODS_AWS_ACCESS_KEY_ID'),
@@ -74,13 +79,21 @@ class KinesisStream:
 
     async def send_records(self):
         """Send accumulated records"""
-        print(f"Sending {len(self.records)} records to {self.stream_arn}")
+        logger.debug("sending records", extra={"stream": self.stream_name, "records": len(self.records)})
+        component = f"kinesis/{self.stream_name}"
         failed = len(self.records)
         while failed == len(self.records):
-            response = await self.client.put_records(Records=self.records, StreamARN=self.stream_arn) #, StreamARN='string')
+            metrics.batch(component, len(self.records))
+            with metrics.timer(component):
+                response = await self.client.put_records(Records=self.records, StreamARN=self.stream_arn) #, StreamARN='string')
             failed = response['FailedRecordCount']
+            metrics.count("items_total", component, len(self.records) - failed)
+            if failed > 0:
+                metrics.count("errors_total", component, failed)
+                logger.warning("records not accepted", extra={"stream": self.stream_name, "failed": failed,
+                                                              "records": len(self.records)})
             if failed == len(self.records):
-                time.sleep(1)
+                await asyncio.sleep(1)
             elif failed > 0:
                 batch = self.records
                 self.records = []
@@ -108,8 +121,8 @@ class KinesisStream:
         if self.waiting_bytes > 500000 or len(self.records) > 485: await self.send_records()
 
     async def finish_write(self):
-        """Write any remaining records"""
-        if len(self.records) > 0: await self.send_records()
+        """Write any remaining records, returning once all are accepted"""
+        while len(self.records) > 0: await self.send_records()
 
     async def read_stream(self):
         """Read records from stream"""
@@ -125,18 +138,20 @@ class KinesisStream:
         shard_iterator = shard_iterator['ShardIterator']
         empty = 0
         while True:
-            record_response = await self.client.get_records(ShardIterator=shard_iterator, Limit=500)
+            with metrics.timer(f"kinesis/{self.stream_name}/read"):
+                record_response = await self.client.get_records(ShardIterator=shard_iterator, Limit=500)
             self.save_last_seqno(record_response)
             #print(record_response)
             if len(record_response['Records']) == 0 and record_response['MillisBehindLatest'] == 0:
                 empty += 1
             else:
                 if len(record_response['Records']) > 0: empty = 0
-                print(f"Read {len(record_response['Records'])} records from {self.stream_arn}")
+                logger.debug("read records", extra={"stream": self.stream_name,
+                                                    "records": len(record_response['Records'])})
                 for item in unpack_records(record_response):
                     yield item
             if empty > 250:
-                print(f"No records found in {self.stream_arn} after {empty} retries")
+                logger.info("end of stream", extra={"stream": self.stream_name, "empty_reads": empty})
                 break
             elif 'NextShardIterator' in record_response:
                 shard_iterator = record_response['NextShardIterator']
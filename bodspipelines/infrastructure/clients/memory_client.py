@@ -0,0 +1,109 @@
+class MemoryClient:
+    """In-memory storage client (same interface as ElasticsearchClient), for running without services
+
+    With store=False nothing is kept, so every item is new (null storage)."""
+    def __init__(self, indexes, store=True):
+        """Initial setup"""
+        self.indexes = indexes
+        self.index_name = None
+        self.store = store
+        self.data = {}				# Index name: {id: document}
+
+    def set_index(self, index_name):
+        """Set index name"""
+        self.index_name = index_name
+
+    def index(self, index_name):
+        """Documents in index"""
+        return self.data.setdefault(index_name, {})
+
+    async def setup(self):
+        """Dummy setup method"""
+        pass
+
+    async def setup_indexes(self):
+        """Dummy setup indexes"""
+        pass
+
+    async def create_index(self, index_name, properties):
+        """Create index"""
+        self.index(index_name)
+
+    def delete_index(self):
+        """Delete index"""
+        self.data.pop(self.index_name, None)
+
+    async def close(self):
+        """Dummy close method"""
+        pass
+
+    async def refresh(self, index_name=None):
+        """Stored data is always readable"""
+        pass
+
+    def apply(self, action):
+        """Apply bulk action, returning whether it changed stored data"""
+        documents = self.index(action['_index'])
+        if action['_op_type'] == 'create':
+            if action['_id'] in documents:
+                return False
+            if self.store: documents[action['_id']] = action['_source']
+        elif action['_op_type'] == 'delete':
+            if not self.store:
+                return True
+            return documents.pop(action['_id'], None) is not None
+        elif action['_op_type'] == 'update':
+            if self.store: documents[action['_id']] = documents.get(action['_id'], {}) | action['doc']
+        elif self.store:
+            documents[action['_id']] = action['_source']
+        return True
+
+    async def batch_store_data(self, actions, batch, index_name):
+        """Store bulk data in index"""
+        if not isinstance(actions, list):
+            actions = [action async for action in actions]
+        for action in actions:
+            if self.apply(action):
+                yield True if action['_op_type'] == 'delete' else action['_source']
+
+    async def dump_stream(self, index_name, action_type, items):
+        """Write stream of items to index with action"""
+        async for item in items:
+            action = {'_op_type': action_type, '_index': index_name, '_id': self.indexes[index_name]["id"](item)}
+            if action_type == 'update':
+                action['doc'] = item
+            elif action_type != 'delete':
+                action['_source'] = item
+            self.apply(action)
+
+    async def get(self, id):
+        """Get by id"""
+        return self.index(self.index_name).get(id)
+
+    async def mget(self, index_name, ids):
+        """Get documents with ids in index"""
+        documents = self.index(index_name)
+        return {id: documents[id] for id in ids if id in documents}
+
+    async def store_data(self, data, id=None):
+        """Store data in index"""
+        if self.store: self.index(self.index_name)[id] = data
+
+    async def update_data(self, data, id):
+        """Update data in index"""
+        if self.store: self.index(self.index_name)[id] = self.index(self.index_name).get(id, {}) | data
+
+    async def delete(self, id):
+        """Delete by id"""
+        self.index(self.index_name).pop(id, None)
+
+    async def scan_index(self, index, slices=None):
+        """Scan index (slices ignored)"""
+        for id, document in list(self.index(index).items()):
+            yield {"_id": id, "_source": document}
+
+    async def statistics(self, index_name=None):
+        """Count of documents (in index, or all indexes)"""
+        if index_name:
+            return {"total": len(self.index(index_name))}
+        return {"total": sum(len(documents) for documents in self.data.values())}
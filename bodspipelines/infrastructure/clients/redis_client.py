@@ -24,6 +24,11 @@ class RedisClient:
         """Set index name"""
         self.index_name = index_name
 
+    async def mget(self, index_name, ids):
+        """Get values with ids in index (id: value for those found)"""
+        values = await self.client.mget([get_key(index_name, id) for id in ids])
+        return {id: json.loads(value) for id, value in zip(ids, values) if value is not None}
+
     async def batch_store_data(self, actions, batch, index_name, output_new=True):
         """Store bulk data in index"""
         record_count = 0
@@ -1,3 +1,5 @@
+import json
+
 from bodspipelines.infrastructure.clients.kinesis_client import KinesisStream
 
 class KinesisInput:
@@ -19,3 +21,27 @@ class KinesisInput:
     async def close(self):
         if hasattr(self.stream, 'close'):
             await self.stream.close()
+
+
+class ChannelInput:
+    """Read from in-memory channel (queue) until closed with None"""
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def process(self):
+        while True:
+            record = await self.channel.get()
+            if record is None:
+                break
+            yield record
+
+
+class FileInput:
+    """Read records from file (one JSON record per line), in place of a stream"""
+    def __init__(self, path):
+        self.path = path
+
+    async def process(self):
+        with open(self.path) as stream:
+            for line in stream:
+                yield json.loads(line)
@@ -0,0 +1,112 @@
+import json
+import time
+import logging
+
+# Attributes of standard log records (anything else was passed as extra fields)
+record_attributes = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+def get_logger(component):
+    """Logger for pipeline component"""
+    return logging.getLogger(f"bodspipelines.{component}")
+
+
+def record_fields(record):
+    """Extra fields passed to log call"""
+    return {key: value for key, value in record.__dict__.items() if not key in record_attributes}
+
+
+def format_value(value):
+    """Value for key=value pair (quoted if contains spaces)"""
+    value = str(value)
+    return json.dumps(value) if " " in value or "=" in value or not value else value
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format log records as one line of key=value pairs"""
+    def format(self, record):
+        """Format record"""
+        fields = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                  "level": record.levelname,
+                  "logger": record.name,
+                  "message": record.getMessage()}
+        fields.update(record_fields(record))
+        line = " ".join(f"{key}={format_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as JSON objects (one per line)"""
+    def format(self, record):
+        """Format record"""
+        fields = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                  "level": record.levelname,
+                  "logger": record.name,
+                  "message": record.getMessage()}
+        fields.update(record_fields(record))
+        if record.exc_info:
+            fields["exception"] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str)
+
+
+# Log formatters by name
+formatters = {"text": StructuredFormatter, "json": JSONFormatter}
+
+
+def configure_logging(level="INFO", format="text"):
+    """Send pipeline logs to stderr at level, as key=value text or JSON"""
+    logger = logging.getLogger("bodspipelines")
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    if not any(getattr(handler, "bodspipelines", False) for handler in logger.handlers):
+        handler = logging.StreamHandler()
+        handler.bodspipelines = True
+        logger.addHandler(handler)
+        logger.propagate = False
+    for handler in logger.handlers:
+        if getattr(handler, "bodspipelines", False):
+            handler.setFormatter(formatters[format]())
+
+
+class Progress:
+    """Periodic progress summary, logged every so many items or seconds"""
+    def __init__(self, logger, name, every=100000, interval=60.0):
+        """Initial setup"""
+        self.logger = logger
+        self.name = name
+        self.every = every			# Items between summaries
+        self.interval = interval		# Seconds between summaries
+        self.reset()
+
+    def reset(self):
+        """Start counting"""
+        self.count = 0
+        self.start = self.last_time = time.monotonic()
+        self.next_count = self.every
+        self.next_check = 1000
+
+    def update(self, count=1):
+        """Count items, logging summary if due (clock only checked every thousand items)"""
+        self.count += count
+        if self.count >= self.next_count:
+            self.log("progress")
+        elif self.count >= self.next_check:
+            self.next_check = self.count + 1000
+            if time.monotonic() - self.last_time >= self.interval:
+                self.log("progress")
+
+    def log(self, message):
+        """Log summary"""
+        now = time.monotonic()
+        elapsed = now - self.start
+        self.logger.info(message, extra={"component": self.name, "items": self.count,
+                                         "elapsed": round(elapsed, 3),
+                                         "rate": round(self.count / elapsed, 1) if elapsed else None})
+        self.last_time = now
+        self.next_count = self.count + self.every
+        self.next_check = self.count + 1000
+
+    def done(self):
+        """Log final summary"""
+        self.log("finished")
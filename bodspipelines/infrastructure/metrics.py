@@ -0,0 +1,185 @@
+import os
+import time
+import json
+import asyncio
+from bisect import bisect_left
+from pathlib import Path
+
+# Histogram bucket upper bounds for latencies (seconds)
+latency_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, float("inf"))
+
+# Histogram bucket upper bounds for batch sizes (items)
+size_buckets = (1, 10, 50, 100, 250, 500, 1000, 5000, 10000, float("inf"))
+
+
+class Histogram:
+    """Counts of observed values in buckets"""
+    def __init__(self, buckets):
+        """Initial setup"""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add value to histogram"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate quantile (upper bound of bucket containing it)"""
+        if not self.count:
+            return None
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                break
+        return bound if bound != float("inf") else None
+
+
+class Timer:
+    """Context manager observing elapsed time, and counting errors, for component"""
+    def __init__(self, registry, component):
+        """Initial setup"""
+        self.registry = registry
+        self.component = component
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.registry.observe("latency_seconds", self.component, time.perf_counter() - self.start)
+        if exc_type is not None and not issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            self.registry.count("errors_total", self.component)
+        return False
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms for pipeline components"""
+    def __init__(self, prefix="bods"):
+        """Initial setup"""
+        self.prefix = prefix
+        self.reset()
+
+    def reset(self):
+        """Clear all metrics"""
+        self.start = time.monotonic()
+        self.counters = {}			# (name, component): value
+        self.gauges = {}			# (name, component): value
+        self.histograms = {}			# (name, component): Histogram
+
+    def count(self, name, component, value=1):
+        """Increase counter"""
+        key = (name, component)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, component, value):
+        """Set gauge"""
+        self.gauges[(name, component)] = value
+
+    def observe(self, name, component, value, buckets=latency_buckets):
+        """Add value to histogram"""
+        key = (name, component)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def batch(self, component, size):
+        """Record batch of items"""
+        self.observe("batch_size", component, size, buckets=size_buckets)
+
+    def timer(self, component):
+        """Time block for component"""
+        return Timer(self, component)
+
+    def elapsed(self):
+        """Seconds since metrics started"""
+        return time.monotonic() - self.start
+
+    def rates(self):
+        """Items per second for each component"""
+        elapsed = max(self.elapsed(), 1e-9)
+        return {component: value / elapsed for (name, component), value in self.counters.items()
+                if name == "items_total"}
+
+    def prometheus(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        def labels(component, extra=""):
+            return '{component="' + component.replace('"', '\\"') + '"' + extra + '}'
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for (key, component), value in sorted(self.counters.items()):
+                if key == name:
+                    lines.append(f"{self.prefix}_{name}{labels(component)} {value}")
+        lines.append(f"# TYPE {self.prefix}_items_per_second gauge")
+        for component, rate in sorted(self.rates().items()):
+            lines.append(f"{self.prefix}_items_per_second{labels(component)} {rate:.3f}")
+        for name in sorted({name for name, _ in self.gauges}):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            for (key, component), value in sorted(self.gauges.items()):
+                if key == name:
+                    lines.append(f"{self.prefix}_{name}{labels(component)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for (key, component), histogram in sorted(self.histograms.items()):
+                if key == name:
+                    total = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        total += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        bucket_labels = labels(component, f',le="{le}"')
+                        lines.append(f"{self.prefix}_{name}_bucket{bucket_labels} {total}")
+                    lines.append(f"{self.prefix}_{name}_sum{labels(component)} {histogram.sum}")
+                    lines.append(f"{self.prefix}_{name}_count{labels(component)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Summary of metrics for each component"""
+        out = {"elapsed_seconds": self.elapsed(), "components": {}}
+        def component_summary(component):
+            return out["components"].setdefault(component, {})
+        for (name, component), value in self.counters.items():
+            component_summary(component)[name] = value
+        for component, rate in self.rates().items():
+            component_summary(component)["items_per_second"] = rate
+        for (name, component), value in self.gauges.items():
+            component_summary(component)[name] = value
+        for (name, component), histogram in self.histograms.items():
+            component_summary(component)[name] = {"count": histogram.count,
+                                                  "sum": histogram.sum,
+                                                  "mean": histogram.sum / histogram.count if histogram.count else None,
+                                                  "p50": histogram.quantile(0.5),
+                                                  "p99": histogram.quantile(0.99)}
+        return out
+
+    def write(self, path, data):
+        """Write file atomically (so readers never see partial file)"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_text(data)
+        os.replace(temp_path, path)
+
+    def export(self, path):
+        """Write metrics to Prometheus text file"""
+        self.write(path, self.prometheus())
+
+    def export_summary(self, path):
+        """Write JSON summary of metrics"""
+        self.write(path, json.dumps(self.summary(), indent=2, default=str))
+
+    async def export_periodically(self, path, interval=60):
+        """Write metrics to Prometheus text file every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            self.export(path)
+
+
+# Metrics registry shared by pipeline components
+metrics = Metrics()
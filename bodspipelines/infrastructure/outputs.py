@@ -1,6 +1,14 @@
+import copy
+import json
+import asyncio
+import marshal
+import tempfile
 from typing import List, Union
 
 from bodspipelines.infrastructure.clients.kinesis_client import KinesisStream
+from bodspipelines.infrastructure.processing.record_cache import record_header
+from bodspipelines.infrastructure.utils import is_flush, acknowledge_flush
+from bodspipelines.infrastructure.metrics import metrics
 
 class OutputConsole:
     """Output to console definition class"""
@@ -27,6 +35,71 @@ class Output:
         self.target.process(item, item_type)
 
 
+class OutputLane:
+    """Output for one of several concurrent sources, spooling items to disk until released
+
+    Once released, spooled items are written to the output, followed by any
+    further items, so the output receives each source's items in turn. Flush
+    markers received before release are acknowledged once spooled items are
+    written."""
+    def __init__(self, output):
+        """Initial setup"""
+        self.output = output
+        self.spool = tempfile.TemporaryFile()
+        self.released = False
+        self.finished = False
+        self.markers = []			# Flush markers held until release
+        self.lock = asyncio.Lock()
+
+    async def process(self, item, item_type):
+        async with self.lock:
+            if self.released:
+                await self.output.process(item, item_type)
+            else:
+                data = marshal.dumps((item, item_type))
+                self.spool.write(record_header.pack(len(data)))
+                self.spool.write(data)
+
+    async def flush(self, marker=None):
+        """Write out items sent to output, returning False if held until release (with marker)"""
+        async with self.lock:
+            if not self.released:
+                if marker is not None: self.markers.append(marker)
+                return False
+            if hasattr(self.output, 'flush'):
+                await self.output.flush()
+            return True
+
+    async def finish(self):
+        async with self.lock:
+            if self.released:
+                await self.output.finish()
+            else:
+                self.finished = True
+
+    async def release(self):
+        """Write spooled items to output, then pass further items straight through"""
+        async with self.lock:
+            self.spool.seek(0)
+            while True:
+                header = self.spool.read(record_header.size)
+                if not header:
+                    break
+                size, = record_header.unpack(header)
+                item, item_type = marshal.loads(self.spool.read(size))
+                await self.output.process(item, item_type)
+            self.spool.close()
+            self.released = True
+            if self.markers:
+                if hasattr(self.output, 'flush'):
+                    await self.output.flush()
+                for marker in self.markers:
+                    acknowledge_flush(marker)
+                self.markers = []
+            if self.finished:
+                await self.output.finish()
+
+
 class NewOutput:
     """Storage data and output if new definition class"""
     def __init__(self, storage=None, output=None, identify=None):
@@ -50,10 +123,47 @@ class NewOutput:
     async def process_stream(self, stream, item_type):
         if self.identify: item_type = self.identify
         async for item in self.storage.process_batch(stream, item_type):
-            if item:
+            if is_flush(item):
+                await self.flush(item)
+            elif item:
                 await self.output.process(item, item_type)
         await self.output.finish()
 
+    async def process_batch_stream(self, stream, item_type):
+        if self.identify: item_type = self.identify
+        written = set()				# Indexes written since last flush
+        async for items in stream:
+            if is_flush(items):
+                await self.storage.flush_indexes(written)
+                written = set()
+                await self.flush(items)
+                continue
+            written.update({item_type(item) for item in items} if callable(item_type) else {item_type})
+            async for item in self.storage.process_items(items, item_type):
+                if item:
+                    await self.output.process(item, item_type)
+        await self.output.finish()
+
+    def lane(self):
+        """Copy of output for a concurrent source, holding new items until released"""
+        lane = copy.copy(self)
+        lane.output = OutputLane(self.output)
+        return lane
+
+    async def release(self):
+        """Release new items held for lane"""
+        await self.output.release()
+
+    async def flush(self, marker):
+        """Write out items sent to output, then acknowledge flush marker (deferred if lane not released)"""
+        if isinstance(self.output, OutputLane):
+            if not await self.output.flush(marker):
+                marker["deferred"] = True
+                return
+        elif hasattr(self.output, 'flush'):
+            await self.output.flush()
+        acknowledge_flush(marker)
+
     async def setup(self):
         if hasattr(self.storage, 'setup'):
             await self.storage.setup()
@@ -67,6 +177,60 @@ class NewOutput:
             await self.output.close()
 
 
+class ChannelOutput:
+    """Output to in-memory channel (queue) read by next stage"""
+    def __init__(self, channel):
+        self.streaming = False
+        self.channel = channel
+
+    async def process(self, item, item_type):
+        await self.channel.put(item)
+        metrics.gauge("queue_depth", "channel", self.channel.qsize())
+
+    async def finish(self):
+        pass
+
+    async def close(self):
+        """Mark end of items in channel"""
+        await self.channel.put(None)
+
+
+class NullOutput:
+    """Discard output (counting items), in place of a stream"""
+    def __init__(self):
+        self.streaming = False
+        self.count = 0
+
+    async def process(self, item, item_type):
+        self.count += 1
+
+    async def finish(self):
+        pass
+
+
+class FileOutput:
+    """Output to file (one JSON record per line), in place of a stream"""
+    def __init__(self, path):
+        self.streaming = False
+        self.path = path
+        self.file = None
+
+    async def process(self, item, item_type):
+        self.file.write(json.dumps(item) + "\n")
+
+    async def flush(self):
+        self.file.flush()
+
+    async def finish(self):
+        self.file.flush()
+
+    async def setup(self):
+        self.file = open(self.path, "w")
+
+    async def close(self):
+        self.file.close()
+
+
 class KinesisOutput:
     """Output to Kinesis Stream"""
     def __init__(self, stream_name=None):
@@ -77,6 +241,9 @@ class KinesisOutput:
     async def process(self, item, item_type):
         await self.stream.add_record(item)
 
+    async def flush(self):
+        await self.stream.finish_write()
+
     async def finish(self):
         await self.stream.finish_write()
 
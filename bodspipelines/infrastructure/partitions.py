@@ -0,0 +1,291 @@
+import zlib
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from bodspipelines.infrastructure.caching import Caching
+from bodspipelines.infrastructure.updates import ProcessUpdates
+
+
+def item_leis(item):
+    """LEIs whose state is read or written processing item"""
+    if "Relationship" in item:
+        return [item["Relationship"]["StartNode"]["NodeID"], item["Relationship"]["EndNode"]["NodeID"]]
+    else:
+        return [item["LEI"]]
+
+
+def relationship_key(key):
+    """Start and end LEIs for relationship latest key (or None if other key)"""
+    parts = key.split("_", 2)
+    if len(parts) == 3 and parts[2].startswith("IS_"):
+        return parts[0], parts[1]
+    return None
+
+
+class Components:
+    """Connected components of LEIs joined by relationships, with partition for each component"""
+    def __init__(self, partitions):
+        """Initial setup"""
+        self.partitions = partitions
+        self.parent = {}			# Parent of each LEI (root LEI for component)
+        self.size = {}				# Number of LEIs in each component
+        self.partition = {}			# Partition holding each component
+
+    def find(self, lei):
+        """Root LEI for component containing lei"""
+        parent = self.parent
+        if not lei in parent:
+            parent[lei] = lei
+            self.size[lei] = 1
+            self.partition[lei] = zlib.crc32(lei.encode("utf-8")) % self.partitions
+            return lei
+        root = lei
+        while parent[root] != root:
+            root = parent[root]
+        while parent[lei] != root:
+            parent[lei], lei = root, parent[lei]
+        return root
+
+    def union(self, lei, other_lei):
+        """Join components, returning root and merged root (or None if already joined)"""
+        root, merged = self.find(lei), self.find(other_lei)
+        if root == merged:
+            return None
+        if self.size[root] < self.size[merged]:
+            root, merged = merged, root
+        self.parent[merged] = root
+        self.size[root] += self.size.pop(merged)
+        return root, merged
+
+
+class PartitionCache(Caching):
+    """Cache holding state for components in one partition"""
+    def __init__(self, storage, batching=False):
+        """Setup cache"""
+        super().__init__(storage, batching=batching)
+        self.root = None			# Component of item being processed
+        self.keys = {}				# Cache keys written for each component
+
+    def _save(self, item_type, item, item_id, overwrite=False):
+        """Save item in cache, recording component"""
+        self.keys.setdefault(self.root, set()).add((item_type, item_id))
+        super()._save(item_type, item, item_id, overwrite=overwrite)
+
+    def merge(self, root, merged):
+        """Record keys for merged component under root"""
+        keys = self.keys.pop(merged, None)
+        if keys:
+            self.keys.setdefault(root, set()).update(keys)
+
+    def export(self, root):
+        """Remove and return cached items (and unwritten batch actions) for component"""
+        entries = []
+        for item_type, item_id in self.keys.pop(root, ()):
+            entries.append((item_type, item_id, self.cache[item_type].pop(item_id, None),
+                            self.batch[item_type].pop(item_id, None)))
+        return entries
+
+    def import_entries(self, root, entries):
+        """Add cached items (and unwritten batch actions) for component"""
+        keys = self.keys.setdefault(root, set())
+        for item_type, item_id, item, action in entries:
+            keys.add((item_type, item_id))
+            if item is not None:
+                self.cache[item_type][item_id] = item
+            if action is not None:
+                self.batch[item_type][item_id] = action
+
+
+class Partition:
+    """Worker process state for one partition"""
+    def __init__(self, id_name, transform, updates, storage):
+        """Initial setup"""
+        self.loop = asyncio.new_event_loop()
+        self.processor = ProcessUpdates(id_name=id_name, transform=transform, updates=updates, storage=storage)
+        self.processor.cache = PartitionCache(storage, batching=-1)
+        self.loop.run_until_complete(storage.setup())
+
+    async def apply(self, messages, item_type, header, updates=False):
+        """Apply messages in order, returning result for each"""
+        cache = self.processor.cache
+        results = []
+        for message in messages:
+            if message[0] == "item":
+                cache.root = message[1]
+                results.append([statement async for statement in self.processor.process(message[2], item_type,
+                                                                            header, updates=updates)])
+            elif message[0] == "merge":
+                results.append(cache.merge(message[1], message[2]))
+            elif message[0] == "export":
+                results.append(cache.export(message[1]))
+            elif message[0] == "import":
+                results.append(cache.import_entries(message[1], message[2]))
+            elif message[0] == "finish":
+                results.append([statement async for statement in self.processor.finish_updates(updates=updates)])
+        return results
+
+
+# Partition in worker process
+partition = None
+
+
+def init_partition(id_name, transform, updates, storage):
+    """Setup partition in worker process"""
+    global partition
+    partition = Partition(id_name, transform, updates, storage)
+
+
+def partition_ready():
+    """Check worker process started"""
+    return partition is not None
+
+
+def run_partition(messages, item_type, header, updates=False):
+    """Apply messages to partition in worker process"""
+    return partition.loop.run_until_complete(partition.apply(messages, item_type, header, updates=updates))
+
+
+class PartitionedUpdates(ProcessUpdates):
+    """Process updates with state partitioned across worker processes
+
+    Items are routed by the component of their LEIs (joined by relationship
+    records), so the worker for a partition owns all cached state its items
+    use. When a relationship joins components held by different partitions,
+    the smaller component's state is moved between them in stream order.
+    A cache snapshot is only loaded from (partition caches don't save one),
+    and a disk cache only holds the state loaded before it is distributed.
+    State is distributed when loaded, so it can't be loaded lazily."""
+    def __init__(self, id_name=None, transform=None, updates=None, storage=None, snapshot=None, disk_cache=None,
+                 lazy_cache=False, load_slices=None, partitions=2, message_limit=10000):
+        """Initial setup"""
+        if lazy_cache:
+            raise ValueError("Lazy cache loading can't be used with partitioned updates")
+        super().__init__(id_name=id_name, transform=transform, updates=updates, storage=storage,
+                         snapshot=snapshot, disk_cache=disk_cache, load_slices=load_slices)
+        self.partitions = partitions
+        self.message_limit = message_limit	# Maximum messages sent to worker at once
+        self.components = Components(partitions)
+        self.executors = None
+
+    async def setup(self):
+        """Start partition workers, then load cache and distribute to partitions"""
+        loop = asyncio.get_running_loop()
+        self.executors = [ProcessPoolExecutor(max_workers=1, initializer=init_partition,
+                                              initargs=(self.id_name, self.transform, self.updates, self.storage))
+                          for _ in range(self.partitions)]
+        await asyncio.gather(*[loop.run_in_executor(executor, partition_ready) for executor in self.executors])
+        await super().setup()
+        await self.run(self.distribute(), None, None)
+        self.cache = None
+
+    def distribute(self):
+        """Messages importing loaded cache into partition for each component"""
+        cache = self.cache.cache
+        statement_leis = {}
+        for item_id, item in cache["latest"].items():
+            if "_" in item_id:
+                leis = relationship_key(item_id)
+                if leis:
+                    joined = self.components.union(*leis)
+                    if joined: self.components.partition.pop(joined[1])
+            else:
+                statement_leis[item["statement_id"]] = item_id
+        components = {}
+        for item_type in cache:
+            for item_id, item in cache[item_type].items():
+                if item_type == "references":
+                    references = item["references_id"]
+                    if isinstance(references, dict): references = [references]
+                    leis = [relationship_key(reference["latest_id"]) for reference in references]
+                    leis = [lei for lei in leis if lei]
+                    lei = leis[0][0] if leis else statement_leis.get(item_id, item_id)
+                else:
+                    lei = item_id.split("_")[0]
+                root = self.components.find(lei)
+                components.setdefault(root, []).append((item_type, item_id, item, None))
+        messages = [[] for _ in range(self.partitions)]
+        for root, entries in components.items():
+            messages[self.components.partition[root]].append(("import", root, entries))
+        return messages
+
+    def join(self, messages, root, merged):
+        """Add messages for joining merged component into root"""
+        source = self.components.partition.pop(merged)
+        target = self.components.partition[root]
+        if source == target:
+            messages[target].append(("merge", root, merged))
+        else:
+            moved = asyncio.get_running_loop().create_future()
+            messages[source].append(("export", merged, moved))
+            messages[target].append(("import", root, moved))
+
+    async def run_partition(self, partition, messages, item_type, header, updates=False):
+        """Send messages to partition worker in order, waiting for exported state before each import"""
+        loop = asyncio.get_running_loop()
+        results = []
+        start = 0
+        while start < len(messages):
+            if messages[start][0] == "import" and isinstance(messages[start][2], asyncio.Future):
+                await messages[start][2]
+            end = start + 1
+            while (end < len(messages) and end - start < self.message_limit and
+                   not (messages[end][0] == "import" and isinstance(messages[end][2], asyncio.Future) and
+                        not messages[end][2].done())):
+                end += 1
+            chunk = []
+            for message in messages[start:end]:
+                if message[0] == "export":
+                    chunk.append(message[:2])
+                elif message[0] == "import" and isinstance(message[2], asyncio.Future):
+                    chunk.append((message[0], message[1], message[2].result()))
+                else:
+                    chunk.append(message)
+            out = await loop.run_in_executor(self.executors[partition], run_partition, chunk, item_type, header,
+                                             updates)
+            for message, result in zip(messages[start:end], out):
+                if message[0] == "export":
+                    message[2].set_result(result)
+            results.extend(out)
+            start = end
+        return results
+
+    async def run(self, messages, item_type, header, updates=False):
+        """Run messages for all partitions concurrently"""
+        return await asyncio.gather(*[self.run_partition(partition, messages[partition], item_type, header,
+                                                         updates=updates)
+                                      for partition in range(self.partitions)])
+
+    async def process_batch(self, items, item_type, header, updates=False):
+        """Process batch of items in partition for component of each item"""
+        messages = [[] for _ in range(self.partitions)]
+        positions = []
+        for item in items:
+            leis = item_leis(item)
+            for lei in leis[1:]:
+                joined = self.components.union(leis[0], lei)
+                if joined: self.join(messages, *joined)
+            root = self.components.find(leis[0])
+            partition = self.components.partition[root]
+            positions.append((partition, len(messages[partition])))
+            messages[partition].append(("item", root, item))
+        results = await self.run(messages, item_type, header, updates=updates)
+        return [statement for partition, position in positions for statement in results[partition][position]]
+
+    async def process(self, item, item_type, header, updates=False, statements=None):
+        """Process item in partition for its component"""
+        for statement in await self.process_batch([item], item_type, header, updates=updates):
+            yield statement
+
+    async def finish_updates(self, updates=False):
+        """Process updates to referencing statements in each partition"""
+        results = await self.run([[("finish",)] for _ in range(self.partitions)], None, None, updates=updates)
+        for result in results:
+            for statement in result[0]:
+                yield statement
+
+    async def close(self):
+        """Shutdown partition workers"""
+        if self.executors:
+            for executor in self.executors:
+                executor.shutdown()
+            self.executors = None
@@ -1,8 +1,16 @@
 import time
+import copy
 import asyncio
 from typing import List, Union
 from pathlib import Path
 
+from bodspipelines.infrastructure.utils import ProcessPool, flush_marker, is_flush, acknowledge_flush
+from bodspipelines.infrastructure.inputs import KinesisInput, ChannelInput
+from bodspipelines.infrastructure.outputs import KinesisOutput, ChannelOutput
+from bodspipelines.infrastructure.metrics import metrics
+from bodspipelines.infrastructure.profiling import get_profiler
+from bodspipelines.infrastructure.log import get_logger, Progress
+
 #from bodspipelines.infrastructure.processing.bulk_data import BulkData
 #from bodspipelines.infrastructure.processing.xml_data import XMLData
 
@@ -10,6 +18,8 @@ from pathlib import Path
 
 #from .memory_debugging import log_memory
 
+logger = get_logger("pipeline")
+
 class Source:
     """Data source definition class"""
     def __init__(self, name=None, origin=None, datatype=None):
@@ -20,14 +30,51 @@ class Source:
 
     async def process(self, stage_dir, updates=False):
         """Iterate over source items"""
+        component = f"source/{self.name}"
+        progress = Progress(logger, component)
         if hasattr(self.origin, "prepare"):
             for data in self.origin.prepare(stage_dir, self.name, updates=updates):
-                async for header, item in self.datatype.process(data):
+                async for header, item in self.datatype.process(data, stage_dir=stage_dir):
+                    if is_flush(item):
+                        yield header, item
+                        continue
+                    metrics.count("items_total", component)
+                    progress.update()
                     yield header, item
         else:
             async for item in self.origin.process():
                 header, item = self.datatype.process(item)
+                metrics.count("items_total", component)
+                progress.update()
                 yield header, item
+        progress.done()
+        metrics.gauge("active_seconds", component, progress.last_time - progress.start)
+
+    async def process_batch(self, stage_dir, updates=False, batch_size=1000):
+        """Iterate over batches of source items (with header shared by batch)"""
+        batch = []
+        header = None
+        async for item_header, item in self.process(stage_dir, updates=updates):
+            if is_flush(item):
+                if batch:
+                    metrics.batch(f"source/{self.name}", len(batch))
+                    yield header, batch
+                    batch = []
+                yield item_header, item
+                continue
+            if batch and item_header is not header:
+                metrics.batch(f"source/{self.name}", len(batch))
+                yield header, batch
+                batch = []
+            header = item_header
+            batch.append(item)
+            if len(batch) >= batch_size:
+                metrics.batch(f"source/{self.name}", len(batch))
+                yield header, batch
+                batch = []
+        if batch:
+            metrics.batch(f"source/{self.name}", len(batch))
+            yield header, batch
 
     async def setup(self):
         """Run origin setup"""
@@ -43,12 +90,17 @@ class Source:
 class Stage:
     """Pipeline stage definition class"""
 
-    def __init__(self, name=None, sources=None, processors=None, outputs=None):
+    def __init__(self, name=None, sources=None, processors=None, outputs=None, batch_size=None, workers=None,
+                 concurrency=None):
         """Initial setup"""
         self.name = name
         self.sources = sources
         self.processors = processors
         self.outputs = outputs
+        self.batch_size = batch_size		# Items per batch (or None to process items singly)
+        self.workers = workers			# Worker processes for CPU-bound processors (or None)
+        self.concurrency = concurrency		# Sources processed at once (or None to process in turn)
+        self.pool = None
 
     def directory(self, parent_dir) -> Path:
         """Return subdirectory path after ensuring exists"""
@@ -61,56 +113,177 @@ class Stage:
         #count = 0
         async for header, item in source.process(stage_dir, updates=updates):
             #print(header, item)
+            if is_flush(item):
+                yield item
+                continue
             if self.processors:
                 items = [item]
                 for processor in self.processors:
                     new_items = []
-                    for current_item in items:
-                    #print("Processor:", processor)
-                        async for out in processor.process(current_item, source.name, header, updates=updates):
-                            #print(out)
-                            #yield out
-                            new_items.append(out)
+                    component = f"processor/{type(processor).__name__}"
+                    with metrics.timer(component):
+                        for current_item in items:
+                        #print("Processor:", processor)
+                            async for out in processor.process(current_item, source.name, header, updates=updates):
+                                #print(out)
+                                #yield out
+                                new_items.append(out)
+                    metrics.count("items_total", component, len(items))
                     items = new_items
+                metrics.count("items_total", f"stage/{self.name}", len(items))
                 for current_item in items:
                     yield current_item
             else:
+                metrics.count("items_total", f"stage/{self.name}")
                 yield item
             #count += 1
             #if count % 100000 == 0:
             #    log_memory()
-        yield {"flush": True}
-        await asyncio.sleep(5)
+        flush = flush_marker()
+        yield flush
+        await self.wait_flushed(flush)
         for processor in self.processors:
-            print("Processor:", hasattr(processor, "finish_updates"), updates)
+            logger.debug("finish processor", extra={"processor": type(processor).__name__,
+                                                    "finish_updates": hasattr(processor, "finish_updates"),
+                                                    "updates": updates})
             if hasattr(processor, "finish_updates") and updates:
                 async for out in processor.finish_updates(updates=updates):
                     yield out
 
+    async def wait_flushed(self, marker):
+        """Check output acknowledged flush marker before it requested more items (or wait if deferred)"""
+        if marker.get("deferred"):
+            await marker["done"]
+        elif not marker["done"].done():
+            raise RuntimeError(f"Output for {self.name} stage did not acknowledge flush")
+
+    def batched(self, source):
+        """Can source be processed in batches"""
+        return (self.batch_size and hasattr(source, "process_batch") and
+                all(hasattr(processor, "process_batch") for processor in self.processors) and
+                all(hasattr(output, "process_batch_stream") if output.streaming else True
+                    for output in self.outputs))
+
+    async def processor_batch(self, processor, items, item_type, header, updates=False):
+        """Process batch of items, in worker processes if processor is CPU-bound"""
+        component = f"processor/{type(processor).__name__}"
+        metrics.count("items_total", component, len(items))
+        metrics.batch(component, len(items))
+        with metrics.timer(component):
+            if self.pool and getattr(processor, "cpu_bound", False):
+                results = await self.pool.map_batch(processor.transform_batch, items, item_type, header)
+                return [out for result in results for out in result]
+            else:
+                return await processor.process_batch(items, item_type, header, updates=updates)
+
+    async def source_batch_processing(self, source, stage_dir, updates=False):
+        """Iterate over batches of items from source, with processing"""
+        async for header, items in source.process_batch(stage_dir, updates=updates, batch_size=self.batch_size):
+            if is_flush(items):
+                yield items
+                continue
+            for processor in self.processors:
+                items = await self.processor_batch(processor, items, source.name, header, updates=updates)
+            if items:
+                metrics.count("items_total", f"stage/{self.name}", len(items))
+                yield items
+        flush = flush_marker()
+        yield flush
+        await self.wait_flushed(flush)
+        for processor in self.processors:
+            if hasattr(processor, "finish_updates") and updates:
+                items = [out async for out in processor.finish_updates(updates=updates)]
+                if items:
+                    yield items
+
+    async def process_source_batches(self, source, stage_dir, updates=False):
+        """Iterate over batches of items from source, and output"""
+        if len(self.outputs) > 1 or not self.outputs[0].streaming:
+            async for items in self.source_batch_processing(source, stage_dir, updates=updates):
+                if is_flush(items):
+                    acknowledge_flush(items)
+                    continue
+                for item in items:
+                    for output in self.outputs:
+                        output.process(item, source.name)
+        else:
+            await self.outputs[0].process_batch_stream(self.source_batch_processing(source, stage_dir,
+                                                       updates=updates), source.name)
+
     async def process_source(self, source, stage_dir, updates=False):
         """Iterate over items from source, and output"""
-        print("Process source:", len(self.outputs) > 1, not self.outputs[0].streaming)
+        if self.batched(source):
+            logger.debug("processing source", extra={"source": source.name, "mode": "batches"})
+            await self.process_source_batches(source, stage_dir, updates=updates)
+            return
         if len(self.outputs) > 1 or not self.outputs[0].streaming:
-            print("Interating:")
+            logger.debug("processing source", extra={"source": source.name, "mode": "iterate"})
             async for item in self.source_processing(source, stage_dir, updates=updates):
+                if is_flush(item):
+                    acknowledge_flush(item)
+                    continue
                 for output in self.outputs:
                     output.process(item, source.name)
         else:
-            print("Streaming:")
+            logger.debug("processing source", extra={"source": source.name, "mode": "stream"})
             await self.outputs[0].process_stream(self.source_processing(source, stage_dir, updates=updates),
                                                  source.name)
 
+    def lane(self):
+        """Copy of stage with own output lanes, for processing a source concurrently"""
+        stage = copy.copy(self)
+        stage.outputs = [output.lane() if hasattr(output, "lane") else output for output in self.outputs]
+        return stage
+
+    async def wait_lane(self, task, tasks):
+        """Wait for lane task to complete, raising any error from other lanes"""
+        while not task.done():
+            await asyncio.wait([other for other in tasks if not other.done()], return_when=asyncio.FIRST_COMPLETED)
+            for other in tasks:
+                if other.done() and not other.cancelled() and other.exception():
+                    raise other.exception()
+        task.result()
+
+    async def process_concurrent(self, stage_dir, updates=False):
+        """Process sources concurrently, releasing output for each source in turn"""
+        limit = asyncio.Semaphore(self.concurrency)
+        lanes = [self.lane() for source in self.sources]
+
+        async def process_lane(lane, source):
+            async with limit:
+                logger.info("processing source", extra={"stage": self.name, "source": source.name})
+                await lane.process_source(source, stage_dir, updates=updates)
+
+        tasks = [asyncio.create_task(process_lane(lane, source)) for lane, source in zip(lanes, self.sources)]
+        try:
+            for lane, task in zip(lanes, tasks):
+                for output in lane.outputs:
+                    if hasattr(output, "release"):
+                        await output.release()
+                await self.wait_lane(task, tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def process(self, pipeline_dir, updates=False):
         """Process all sources for stage"""
-        print(f"Running {self.name} pipeline stage")
+        logger.info("running stage", extra={"stage": self.name})
         stage_dir = self.directory(pipeline_dir)
-        for source in self.sources:
-            print(f"Processing {source.name} source")
-            await self.process_source(source, stage_dir, updates=updates)
-        print(f"Finished {self.name} pipeline stage")
+        if self.concurrency and len(self.sources) > 1:
+            await self.process_concurrent(stage_dir, updates=updates)
+        else:
+            for source in self.sources:
+                logger.info("processing source", extra={"stage": self.name, "source": source.name})
+                await self.process_source(source, stage_dir, updates=updates)
+        logger.info("finished stage", extra={"stage": self.name})
 
     async def setup(self):
         """Setup stage components"""
+        if self.workers:
+            self.pool = ProcessPool(self.workers)
+            for processor in self.processors:
+                if hasattr(processor, 'pool'):
+                    processor.pool = self.pool
         for components in (self.sources, self.processors, self.outputs):
             for component in components:
                 if hasattr(component, 'setup'):
@@ -122,14 +295,154 @@ class Stage:
             for component in components:
                 if hasattr(component, 'close'):
                     await component.close()
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
+
+# Marker for end of items in queue
+end_of_items = object()
+
+
+async def queue_stream(queue, component=None):
+    """Stream items from queue until end marker
+
+    Items are only marked done when the next item is requested, so joining the
+    queue waits until the consumer has finished with every item."""
+    while True:
+        if component: metrics.gauge("queue_depth", component, queue.qsize())
+        item = await queue.get()
+        if item is end_of_items:
+            queue.task_done()
+            break
+        yield item
+        queue.task_done()
+
+
+class PipelinedStage(Stage):
+    """Pipeline stage running source, processors and output as concurrent tasks
+
+    Components are connected by bounded queues, so each waits when the next
+    falls more than the queue size behind."""
+
+    def __init__(self, name=None, sources=None, processors=None, outputs=None, batch_size=None,
+                 workers=None, concurrency=None, queue_size=1000):
+        """Initial setup"""
+        super().__init__(name=name, sources=sources, processors=processors, outputs=outputs,
+                         batch_size=batch_size, workers=workers, concurrency=concurrency)
+        self.queue_size = queue_size		# Queue depth (or list with depth for each queue)
+
+    def queue_sizes(self):
+        """Depths of queues after source and each processor"""
+        if isinstance(self.queue_size, int):
+            return [self.queue_size] * (len(self.processors) + 1)
+        return self.queue_size
+
+    async def source_items(self, source, stage_dir, queue, batched, last, updates=False):
+        """Put items (or batches) from source on queue"""
+        if batched:
+            stream = source.process_batch(stage_dir, updates=updates, batch_size=self.batch_size)
+        else:
+            stream = source.process(stage_dir, updates=updates)
+        async for header, item in stream:
+            await queue.put(item if last else (header, item))
+        if not last:
+            await queue.put(end_of_items)
+
+    async def processor_items(self, processor, in_queue, out_queue, item_type, batched, last, updates=False):
+        """Put processed items (or batches) from input queue on output queue"""
+        component = f"processor/{type(processor).__name__}"
+        while True:
+            metrics.gauge("queue_depth", f"queue/{self.name}/{type(processor).__name__}", in_queue.qsize())
+            entry = await in_queue.get()
+            if entry is end_of_items:
+                break
+            header, item = entry
+            if is_flush(item):
+                await out_queue.put(item if last else (header, item))
+                continue
+            if batched:
+                items = await self.processor_batch(processor, item, item_type, header, updates=updates)
+                if items:
+                    await out_queue.put(items if last else (header, items))
+            else:
+                metrics.count("items_total", component)
+                with metrics.timer(component):
+                    items = [out async for out in processor.process(item, item_type, header, updates=updates)]
+                for out in items:
+                    await out_queue.put(out if last else (header, out))
+        if not last:
+            await out_queue.put(end_of_items)
+
+    async def output_items(self, queue, item_type, batched):
+        """Output items (or batches) from queue"""
+        component = f"queue/{self.name}/output"
+        if len(self.outputs) > 1 or not self.outputs[0].streaming:
+            async for item in queue_stream(queue, component):
+                if is_flush(item):
+                    acknowledge_flush(item)
+                    continue
+                for current_item in (item if batched else [item]):
+                    for output in self.outputs:
+                        output.process(current_item, item_type)
+        elif batched:
+            await self.outputs[0].process_batch_stream(queue_stream(queue, component), item_type)
+        else:
+            await self.outputs[0].process_stream(queue_stream(queue, component), item_type)
+
+    async def wait_tasks(self, tasks, output_task):
+        """Wait for tasks to complete, raising any error (including from output)"""
+        pending = set(tasks) | {output_task}
+        while not all(task.done() for task in tasks):
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+                if task is output_task:
+                    raise RuntimeError(f"Output for {self.name} stage stopped before end of items")
+
+    async def process_source(self, source, stage_dir, updates=False):
+        """Process items from source through concurrent tasks, and output"""
+        batched = self.batched(source)
+        logger.debug("processing source", extra={"source": source.name,
+                                                 "mode": "pipeline batches" if batched else "pipeline"})
+        queues = [asyncio.Queue(maxsize=size) for size in self.queue_sizes()]
+        output_task = asyncio.create_task(self.output_items(queues[-1], source.name, batched))
+        tasks = [asyncio.create_task(self.source_items(source, stage_dir, queues[0], batched,
+                                                       not self.processors, updates=updates))]
+        for i, processor in enumerate(self.processors):
+            tasks.append(asyncio.create_task(self.processor_items(processor, queues[i], queues[i+1], source.name,
+                                                                  batched, i == len(self.processors) - 1,
+                                                                  updates=updates)))
+        try:
+            await self.wait_tasks(tasks, output_task)
+            # Wait for output to write all items before finishing updates
+            flush = flush_marker()
+            await queues[-1].put(flush)
+            await self.wait_tasks([flush["done"]], output_task)
+            for processor in self.processors:
+                if hasattr(processor, "finish_updates") and updates:
+                    items = [out async for out in processor.finish_updates(updates=updates)]
+                    if batched:
+                        if items: await queues[-1].put(items)
+                    else:
+                        for item in items:
+                            await queues[-1].put(item)
+            await queues[-1].put(end_of_items)
+            await output_task
+        finally:
+            for task in tasks + [output_task]:
+                task.cancel()
 
 
 class Pipeline:
     """Pipeline definition class"""
-    def __init__(self, name=None, stages=None):
+    def __init__(self, name=None, stages=None, metrics_dir=None, metrics_interval=60, profile=None):
         """Initial setup"""
         self.name = name
         self.stages = stages
+        self.metrics_dir = metrics_dir			# Directory for metrics files (or None for no export)
+        self.metrics_interval = metrics_interval	# Seconds between Prometheus file exports
+        self.profile = profile				# Default profiler ("sample", "cprofile" or None)
 
     def directory(self) -> Path:
         """Return subdirectory path after ensuring exists"""
@@ -144,16 +457,101 @@ class Pipeline:
                 return stage
         return None
 
-    async def process_stage(self, stage_name, updates=False):
+    async def process_stage(self, stage_name, updates=False, profile=None):
         """Process specified pipeline stage"""
         stage = self.get_stage(stage_name)
         pipeline_dir = self.directory()
-        await stage.setup()
+        await self.with_profile(profile, stage.directory(pipeline_dir), stage_name,
+                                self.run_stage(stage, pipeline_dir, updates=updates, setup=True))
+
+    async def with_profile(self, profile, directory, run_name, work):
+        """Await work, profiling and writing results to directory (if profile set)"""
+        if not profile:
+            return await work
+        profiler = get_profiler(profile)
+        profiler.start()
+        try:
+            return await work
+        finally:
+            profiler.stop()
+            profiler.write(directory, f"profile-{run_name}")
+
+    async def with_metrics(self, run_name, work):
+        """Await work, exporting metrics periodically and summary at end (if metrics directory set)"""
+        if not self.metrics_dir:
+            return await work
+        metrics.reset()
+        path = Path(self.metrics_dir) / f"{self.name}-{run_name}.prom"
+        exporter = asyncio.create_task(metrics.export_periodically(path, self.metrics_interval))
+        try:
+            return await work
+        finally:
+            exporter.cancel()
+            metrics.export(path)
+            metrics.export_summary(Path(self.metrics_dir) / f"{self.name}-{run_name}-summary.json")
+
+    def process(self, stage_name, updates=False, profile=None):
+        """Process specified pipeline stage (profile: "sample", "cprofile" or None for pipeline default)"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.with_metrics(stage_name,
+                                                  self.process_stage(stage_name, updates=updates,
+                                                                     profile=profile or self.profile)))
+
+    def fuse(self, stages, channel_size=10000):
+        """Replace Kinesis streams between stages with in-memory channels
+
+        Returns replaced (component, attribute, value) for restoring afterwards."""
+        replaced = []
+        for stage, next_stage in zip(stages, stages[1:]):
+            for output in stage.outputs:
+                if isinstance(getattr(output, "output", None), KinesisOutput):
+                    channel = asyncio.Queue(maxsize=channel_size)
+                    for source in next_stage.sources:
+                        if (isinstance(source.origin, KinesisInput) and
+                            source.origin.stream_name == output.output.stream_name):
+                            replaced.append((source, "origin", source.origin))
+                            source.origin = ChannelInput(channel)
+                    replaced.append((output, "output", output.output))
+                    output.output = ChannelOutput(channel)
+        return replaced
+
+    async def run_stage(self, stage, pipeline_dir, updates=False, setup=False):
+        """Process and close stage (after setup if specified)"""
+        if setup:
+            await stage.setup()
         await stage.process(pipeline_dir, updates=updates)
         await stage.close()
 
-    def process(self, stage_name, updates=False):
-        """Process specified pipeline stage"""
+    async def run_fused_stages(self, stages, pipeline_dir, updates=False):
+        """Process stages concurrently, stopping at first error"""
+        for stage in stages:
+            await stage.setup()
+        tasks = [asyncio.create_task(self.run_stage(stage, pipeline_dir, updates=updates)) for stage in stages]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def process_fused_stages(self, stage_names, updates=False, profile=None):
+        """Process specified pipeline stages concurrently, connected by in-memory channels"""
+        stages = [self.get_stage(stage_name) for stage_name in stage_names]
+        pipeline_dir = self.directory()
+        replaced = self.fuse(stages)
+        try:
+            await self.with_profile(profile, pipeline_dir, "+".join(stage_names),
+                                    self.run_fused_stages(stages, pipeline_dir, updates=updates))
+        finally:
+            for component, attribute, value in replaced:
+                setattr(component, attribute, value)
+
+    def process_fused(self, stage_names, updates=False, profile=None):
+        """Process specified pipeline stages in one process, without streams between them"""
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.process_stage(stage_name, updates=updates))
+        loop.run_until_complete(self.with_metrics("+".join(stage_names),
+                                                  self.process_fused_stages(stage_names, updates=updates,
+                                                                            profile=profile or self.profile)))
@@ -1,6 +1,10 @@
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("api")
+
 def authenticate(auth_url, client_id, client_secret):
     """Authenticate and return token"""
     r = requests.post(auth_url, json={"username": client_id, "password": client_secret})
@@ -66,15 +70,14 @@ class APIData:
         else:
             auth_headers={}
         headers = self.headers | auth_headers
-        print("Headers:", headers, "Params:", params)
         param_str = self.build_params(params)
-        print(param_str)
         response = self.session.get(f"{api_url}?{param_str}", headers=headers, timeout=15)
-        print(response.url)
+        logger.debug("queried API", extra={"url": response.url, "status": response.status_code})
         if response.status_code == 200:
             return response.json(), response.status_code
         else:
-            print("Error code:", response.status_code, response.text)
+            logger.warning("API error", extra={"url": response.url, "status": response.status_code,
+                                               "response": response.text[:1000]})
             return None, response.status_code
 
     def data_stream(self):
@@ -87,7 +90,7 @@ class APIData:
             last_page = False
             page = 1
             while not last_page:
-                print("Downloading page: ", page, self.streaming)
+                logger.debug("downloading page", extra={"url": api_url, "page": page})
                 done = False
                 while not done:
                     data, status_code = self.query(api_url, self.params | {self.paging_names["pagesize"]: self.pagesize,
@@ -1,19 +1,137 @@
 import time
+import zlib
+import struct
 from pathlib import Path
 import requests
 from progress.bar import Bar
 import json
 import zipfile
 
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("bulk_data")
+
+
+class ZipStreamReader:
+    """Decompress first file in zip archive from stream of chunks"""
+
+    def __init__(self, chunks, close=None):
+        """Initial setup"""
+        self.chunks = iter(chunks)
+        self.raw = b""
+        self.finished = False
+        self.close_func = close
+        self.name = None
+        self.remaining = None
+        self.decompressor = None
+        self._read_header()
+
+    def _fill(self, size):
+        """Ensure at least size raw bytes are buffered"""
+        while len(self.raw) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise EOFError("Unexpected end of zip stream")
+            self.raw += chunk
+
+    def _read_header(self):
+        """Read local file header of first file"""
+        self._fill(30)
+        signature, _, flags, method, _, _, _, compressed_size, _, name_length, extra_length = \
+            struct.unpack("<IHHHHHIIIHH", self.raw[:30])
+        if signature != 0x04034b50:
+            raise zipfile.BadZipFile("Stream is not a zip archive")
+        self._fill(30 + name_length + extra_length)
+        self.name = self.raw[30:30 + name_length].decode("utf-8" if flags & 0x800 else "cp437")
+        self.raw = self.raw[30 + name_length + extra_length:]
+        if method == zipfile.ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == zipfile.ZIP_STORED and not flags & 0x08:
+            self.remaining = compressed_size
+        else:
+            raise NotImplementedError(f"Unsupported zip compression method: {method}")
+
+    def _next_raw(self):
+        """Return buffered raw bytes or next chunk"""
+        if self.raw:
+            data, self.raw = self.raw, b""
+            return data
+        return next(self.chunks, b"")
+
+    def read(self, size=-1):
+        """Read up to size decompressed bytes"""
+        if size is None or size < 0: size = 1 << 62
+        out = []
+        count = 0
+        while count < size and not self.finished:
+            data = self._next_raw()
+            if not data:
+                if self.decompressor:
+                    raise EOFError("Unexpected end of zip stream")
+                self.finished = True
+                break
+            if self.decompressor:
+                block = self.decompressor.decompress(data, size - count)
+                self.raw = self.decompressor.unconsumed_tail or self.decompressor.unused_data
+                if self.decompressor.eof:
+                    self.finished = True
+            else:
+                block = data[:min(size - count, self.remaining)]
+                self.raw = data[len(block):]
+                self.remaining -= len(block)
+                if self.remaining == 0:
+                    self.finished = True
+            out.append(block)
+            count += len(block)
+        return b"".join(out)
+
+    def close(self):
+        """Close underlying stream"""
+        if self.close_func: self.close_func()
+
+
+class ZipFileStream:
+    """Stream file from downloaded zip archive without extracting"""
+
+    def __init__(self, zip_file, name):
+        """Initial setup"""
+        self.zip_file = zip_file
+        self.name = name
+
+    def open(self):
+        """Open decompressing binary stream"""
+        with zipfile.ZipFile(self.zip_file, 'r') as zip_ref:
+            return zip_ref.open(self.name)
+
+
+class HTTPZipStream:
+    """Stream file from zip archive as it is downloaded"""
+
+    def __init__(self, url, chunk_size=1048576):
+        """Initial setup"""
+        self.url = url
+        self.name = url.rsplit('/', 1)[-1]
+        self.chunk_size = chunk_size
+
+    def open(self):
+        """Open decompressing binary stream over HTTP response"""
+        r = requests.get(self.url, stream=True)
+        r.raise_for_status()
+        return ZipStreamReader(r.iter_content(chunk_size=self.chunk_size), close=r.close)
+
+
 class BulkData:
     """Bulk data definition class"""
 
-    def __init__(self, display=None, data=None, size=None, directory=None):
+    def __init__(self, display=None, data=None, size=None, directory=None, streaming=None):
         """Initial setup"""
         self.display = display
         self.data = data
         self.size = size
         self.directory = directory
+        if not streaming in (None, "zip", "http"):
+            raise ValueError(f"Unknown streaming mode: {streaming}")
+        self.streaming = streaming      # Parse from "zip" file or "http" response (or None to extract)
 
     def data_dir(self, path) -> Path:
         """Return subdirectory path for data"""
@@ -119,23 +237,22 @@ class BulkData:
     def delete_old_data_all(self, directory):
         """Delete all data files"""
         for file in directory.glob('*'):
-            print(f"Deleting {file.name} ...")
+            logger.info("deleting file", extra={"file": file.name})
             file.unlink()
 
     def delete_old_data(self, directory, url):
         """Delete filename for specified url"""
         fn = url.rsplit('/', 1)[-1]
         for file in directory.glob('*'):
-            print(file.name, fn)
             if file.name == fn:
-                print(f"Deleting {file.name} ...")
+                logger.info("deleting file", extra={"file": file.name})
                 file.unlink()
 
     def delete_unused_data(self, directory, files):
         """Delete files not in list"""
         for file in directory.glob('*'):
             if not file.name in files:
-                print(f"Deleting {file.name} ...")
+                logger.info("deleting file", extra={"file": file.name})
                 file.unlink()
 
     def delete_zip_data(self, directory, url):
@@ -143,7 +260,7 @@ class BulkData:
         fn = url.rsplit('/', 1)[-1]
         for file in directory.glob('*'):
             if file.name == fn:
-                print(f"Deleting {file.name} ...")
+                logger.info("deleting file", extra={"file": file.name})
                 file.unlink()
 
     def download_data(self, directory, name):
@@ -175,8 +292,45 @@ class BulkData:
             self.delete_zip_data(directory, url)
             yield fn
 
+    def zip_streams(self, zip_file):
+        """Yield streams for files in zip archive"""
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            names = zip_ref.namelist()
+        for fn in names:
+            yield ZipFileStream(zip_file, fn)
+
+    def download_stream_data(self, directory, name, url):
+        """Download data files without extracting"""
+        if self.streaming == "http":
+            yield HTTPZipStream(url)
+        else:
+            self.delete_old_data(directory, url)
+            zip = self.download_large(directory, name, url)
+            yield from self.zip_streams(zip)
+
+    def prepare_stream(self, path, name, updates=False):
+        """Prepare data streams for use"""
+        directory = self.data_dir(path)
+        directory.mkdir(exist_ok=True)
+        files = []
+        if self.streaming == "zip" and list(directory.glob("*.zip")):
+            for f in directory.glob("*.zip"):
+                for stream in self.zip_streams(f):
+                    files.append(stream.name)
+                    yield stream
+        else:
+            for url in self.check_manifest(path, name, updates=updates):
+                for stream in self.download_stream_data(directory, name, url):
+                    files.append(stream.name)
+                    yield stream
+        logger.info("prepared files", extra={"source": name, "files": files})
+        self.create_manifest(path, name)
+
     def prepare(self, path, name, updates=False) -> Path:
         """Prepare data for use"""
+        if self.streaming:
+            yield from self.prepare_stream(path, name, updates=updates)
+            return
         directory = self.data_dir(path)
         directory.mkdir(exist_ok=True)
         files = []
@@ -190,5 +344,5 @@ class BulkData:
                 for fn in self.download_extract_data(directory, name, url):
                     files.append(fn)
                     yield directory / fn
-        print("Files:", files)
+        logger.info("prepared files", extra={"source": name, "files": files})
         self.create_manifest(path, name)
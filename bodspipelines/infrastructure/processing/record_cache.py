@@ -0,0 +1,55 @@
+import os
+import struct
+import marshal
+import hashlib
+from contextlib import aclosing
+from pathlib import Path
+
+# Length prefix for each record
+record_header = struct.Struct("<I")
+
+
+def file_key(filename):
+    """Hash of file path, size and modification time (identifying version of file without reading it)"""
+    stat = os.stat(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((str(Path(filename).resolve()), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, filename, config):
+    """Path of cache file for data file parsed with configuration"""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(repr((config, marshal.version)).encode("utf-8"))
+    return Path(cache_dir) / f"{file_key(filename)}-{digest.hexdigest()}.records"
+
+
+async def read_cache(path, buffer_size=1048576):
+    """Stream records from cache file"""
+    with open(path, "rb", buffering=buffer_size) as f:
+        while True:
+            header = f.read(record_header.size)
+            if not header:
+                break
+            size, = record_header.unpack(header)
+            yield marshal.loads(f.read(size))
+
+
+async def write_cache(records, path, buffer_size=1048576):
+    """Stream records, writing them to cache file
+
+    The cache file only appears once all records have been written."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    try:
+        with open(temp_path, "wb", buffering=buffer_size) as f:
+            async with aclosing(records) as stream:
+                async for record in stream:
+                    data = marshal.dumps(record)
+                    f.write(record_header.pack(len(data)))
+                    f.write(data)
+                    yield record
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
@@ -1,28 +1,106 @@
-import aiofiles
-#from lxml import etree
+import os
+import re
+import sys
+import json
+import asyncio
+from collections import deque
+from contextlib import aclosing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import mmap
+import queue
+import threading
+from lxml import etree as lxml_etree
 import xml.etree.ElementTree as etree
 
+from bodspipelines.infrastructure.processing.record_cache import cache_path, read_cache, write_cache
+from bodspipelines.infrastructure.utils import flush_marker
+from bodspipelines.infrastructure.log import get_logger
 
-async def stream_file(filename):
-    async with aiofiles.open(filename, mode='r') as f:
+logger = get_logger("xml")
+
+
+def read_file(filename, buffer_size=1048576, use_mmap=False, start=0):
+    """Read raw bytes from file (read directly, without text decoding)"""
+    with open(filename, mode='rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for offset in range(start, len(m), buffer_size):
+                    yield m[offset:offset + buffer_size]
+        else:
+            f.seek(start)
+            while True:
+                data = f.read(buffer_size)
+                if data:
+                    yield data
+                else:
+                    break
+    yield b""
+
+
+async def stream_file(filename, buffer_size=1048576, use_mmap=False):
+    """Stream raw bytes from file (each buffer read in a thread, so other tasks run meanwhile)"""
+    chunks = read_file(filename, buffer_size=buffer_size, use_mmap=use_mmap)
+    try:
         while True:
-            data = await f.read(65536)
+            data = await asyncio.to_thread(next, chunks, None)
+            if data is None:
+                break
+            yield data
+    finally:
+        chunks.close()
+
+
+def is_file(data):
+    """Is data a file path (rather than an openable stream)"""
+    return isinstance(data, (str, os.PathLike))
+
+
+async def stream_binary(stream, chunk_size=1048576):
+    """Stream chunks from openable binary stream (e.g. file in zip archive)"""
+    f = await asyncio.to_thread(stream.open)
+    try:
+        while True:
+            data = await asyncio.to_thread(f.read, chunk_size)
             if data:
                 yield data
             else:
-                yield ""
+                yield b""
                 break
+    finally:
+        f.close()
 
 
-def is_plural(tag, child_tag):
-    """Is tag name plural"""
-    if tag == child_tag + "s":
-        return True
-    elif tag == child_tag + "es":
-        return True
-    elif tag == child_tag[:-1] + 'ies':
-        return True
-    return False
+def read_binary(stream, chunk_size=1048576):
+    """Read chunks from openable binary stream (blocking)"""
+    f = stream.open()
+    try:
+        while True:
+            data = f.read(chunk_size)
+            if data:
+                yield data
+            else:
+                yield b""
+                break
+    finally:
+        f.close()
+
+
+def read_data(data, buffer_size=1048576, use_mmap=False):
+    """Read chunks from file path or openable stream (blocking)"""
+    if is_file(data):
+        return read_file(data, buffer_size=buffer_size, use_mmap=use_mmap)
+    else:
+        return read_binary(data, chunk_size=buffer_size)
+
+
+def stream_data(data, buffer_size=1048576, use_mmap=False):
+    """Stream chunks from file path or openable stream"""
+    if is_file(data):
+        return stream_file(data, buffer_size=buffer_size, use_mmap=use_mmap)
+    else:
+        return stream_binary(data, chunk_size=buffer_size)
 
 
 def is_plural(tag, child_tag):
@@ -43,20 +121,113 @@ def get_tag(element, pos):
             return element.tag[pos[ns]:]
 
 
-def handle_event(event, element, tag_name, skip, stack, pos, filter):
+class TagTable:
+    """Tag resolution rules, built on first sight of each qualified tag"""
+
+    def __init__(self, namespaces):
+        """Initial setup"""
+        self.pos = {namespaces[ns]: len(namespaces[ns])+2 for ns in namespaces}
+        self.names = {}			# Qualified tag -> local name
+        self.plurals = {}		# (Qualified parent tag, local child tag) -> is plural
+
+    def local(self, element):
+        """Return tag name without namespace"""
+        try:
+            return self.names[element.tag]
+        except KeyError:
+            tag = get_tag(element, self.pos)
+            if tag is not None:
+                tag = sys.intern(tag)
+            self.names[element.tag] = tag
+            return tag
+
+    def is_plural(self, tag, child_tag):
+        """Is tag name plural of child tag name"""
+        try:
+            return self.plurals[(tag, child_tag)]
+        except KeyError:
+            plural = is_plural(tag, child_tag)
+            self.plurals[(tag, child_tag)] = plural
+            return plural
+
+
+def add_child(parent, tag, val, element, plural):
+    """Add value of child element to parent stack entry (plural from tag table)"""
+    item_type = element.get('type')
+    if parent[1]:
+        if isinstance(parent[1], list):
+            if item_type is not None:
+                if isinstance(val, dict):
+                    val['type'] = item_type
+                    parent[1].append(val)
+                else:
+                    parent[1].append({'type': item_type, tag: val})
+            else:
+                parent[1].append(val)
+        else:
+            parent[1][tag] = val
+    else:
+        if plural(parent[0], tag):
+            if item_type is not None:
+                if isinstance(val, dict):
+                    val['type'] = item_type
+                    parent[1] = [val]
+                else:
+                    parent[1] = [{'type': item_type, tag: val}]
+            else:
+                if isinstance(parent[1], list):
+                    parent[1].append(val)
+                else:
+                    parent[1] = [val]
+        else:
+            parent[1][tag] = val
+
+
+def compile_projection(paths):
+    """Build tree of element names to keep from element paths (e.g. "Entity/LegalName")
+
+    Each name maps to the tree for its children, or None if its whole subtree is kept."""
+    projection = {}
+    for path in paths:
+        node = projection
+        *parents, name = path.split("/")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+            if node is None: break
+        else:
+            node[name] = None
+    return projection
+
+
+def child_projection(projection, tag):
+    """Return (keep, projection) for child element of element with projection"""
+    if projection is None:
+        return True, None
+    elif tag in projection:
+        return True, projection[tag]
+    return False, None
+
+
+def handle_event(event, element, tag_name, skip, stack, tags, filter, projection=None):
     out = None
-    tag = get_tag(element, pos)
+    tag = tags.local(element)
     if event == 'start':
-        if skip:
+        if skip is not None:
             pass
         elif tag in filter:
-            skip = True
-        elif element.tag == tag_name or stack:
-            stack.append([element.tag, {}])
+            skip = element
+        elif element.tag == tag_name:
+            stack.append([element.tag, {}, projection])
+        elif stack:
+            keep, node = child_projection(stack[-1][2], tag)
+            if keep:
+                stack.append([element.tag, {}, node])
+            else:
+                skip = element
     elif event == 'end':
-        if skip:
-            if tag in filter:
-                skip = False
+        if skip is not None:
+            if element is skip:
+                skip = None
         elif element.tag == tag_name:
             element.clear()
             # Also eliminate now-empty references from the root node to elem
@@ -69,73 +240,483 @@ def handle_event(event, element, tag_name, skip, stack, pos, filter):
             elem = stack.pop()
             if elem[1]:
                 val = elem[1]
+            elif elem[2]:
+                # None of the projected children present
+                return out, skip
             else:
                 val = element.text
-            if stack[-1][1]:
-                if isinstance(stack[-1][1], list):
-                    if 'type' in element.attrib:
-                        if isinstance(val, dict):
-                            val['type'] = element.attrib['type']
-                            stack[-1][1].append(val)
-                        else:
-                            stack[-1][1].append({'type': element.attrib['type'], tag: val})
-                    else:
-                        stack[-1][1].append(val)
-                else:
-                    stack[-1][1][tag] = val
-            else:
-                if is_plural(stack[-1][0], tag):
-                    if 'type' in element.attrib:
-                        if isinstance(val, dict):
-                            val['type'] = element.attrib['type']
-                            stack[-1][1] = [val]
-                        else:
-                            stack[-1][1] = [{'type': element.attrib['type'], tag: val}]
-                    else:
-                        if isinstance(stack[-1][1], list):
-                            stack[-1][1].append(val)
-                        else:
-                            stack[-1][1] = [val]
-                else:
-                    stack[-1][1][tag] = val
+            add_child(stack[-1], tag, val, element, plural=tags.is_plural)
     return out, skip
 
 
-async def data_stream(filename, tag_name, namespaces, filter=[]):
-    """Stream items from XML file"""
-    skip = False
-    stack = []
-    pos = {namespaces[ns]: len(namespaces[ns])+2 for ns in namespaces}
-    parser = etree.XMLPullParser(('start', 'end',))
-    async for chunk in stream_file(filename):
-        parser.feed(chunk)
-        for event, element in parser.read_events():
-            out, skip = handle_event(event, element, tag_name, skip, stack, pos, filter)
+def element_value(element, tags, filter, projection=None):
+    """Build value for element from its (already parsed) children"""
+    entry = [element.tag, {}]
+    for child in element:
+        if not isinstance(child.tag, str):
+            # Skip comments and processing instructions
+            continue
+        tag = tags.local(child)
+        if tag in filter:
+            continue
+        keep, node = child_projection(projection, tag)
+        if not keep:
+            continue
+        if len(child):
+            val = element_value(child, tags, filter, projection=node)
+            if not val:
+                if node: continue
+                val = child.text
+        elif node:
+            continue
+        else:
+            val = child.text
+        add_child(entry, tag, val, child, plural=tags.is_plural)
+    return entry[1]
+
+
+class EtreeParser:
+    """Pull parser handling every start/end event (xml.etree.ElementTree)"""
+
+    def __init__(self, tag_name, namespaces, filter=[], projection=None):
+        """Initial setup"""
+        self.tag_name = tag_name
+        self.filter = filter
+        self.projection = projection
+        self.skip = None
+        self.stack = []
+        self.count = 0				# Item elements completed
+        self.tags = TagTable(namespaces)
+        self.parser = etree.XMLPullParser(('start', 'end',))
+
+    def _records(self):
+        """Yield records completed by data fed so far"""
+        for event, element in self.parser.read_events():
+            out, self.skip = handle_event(event, element, self.tag_name, self.skip, self.stack,
+                                          self.tags, self.filter, projection=self.projection)
+            if out is not None: self.count += 1
             if out: yield out
 
+    def feed(self, data):
+        """Feed data to parser and return iterator over completed records"""
+        self.parser.feed(data)
+        return self._records()
+
+
+class LxmlParser:
+    """Pull parser only reporting end events for the item tag (lxml)"""
+
+    def __init__(self, tag_name, namespaces, filter=[], projection=None):
+        """Initial setup"""
+        self.filter = filter
+        self.projection = projection
+        self.count = 0				# Item elements completed
+        self.tags = TagTable(namespaces)
+        self.parser = lxml_etree.XMLPullParser(events=('end',), tag=tag_name)
+
+    def _records(self):
+        """Yield records completed by data fed so far"""
+        for event, element in self.parser.read_events():
+            self.count += 1
+            out = element_value(element, self.tags, self.filter, projection=self.projection)
+            # Free processed element and any earlier siblings
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if out: yield out
+
+    def feed(self, data):
+        """Feed data to parser and return iterator over completed records"""
+        self.parser.feed(data)
+        return self._records()
+
+
+# Available XML parser engines
+parser_engines = {"etree": EtreeParser, "lxml": LxmlParser}
+
+
+async def data_stream(filename, tag_name, namespaces, filter=[], engine="etree", buffer_size=1048576,
+                      use_mmap=False, projection=None):
+    """Stream items from XML file"""
+    parser = parser_engines[engine](tag_name, namespaces, filter=filter, projection=projection)
+    async with aclosing(stream_data(filename, buffer_size=buffer_size, use_mmap=use_mmap)) as stream:
+        async for chunk in stream:
+            for out in parser.feed(chunk):
+                yield out
+
+
+def parse_items(filename, tag_name, namespaces, filter=[], engine="etree", buffer_size=1048576,
+                use_mmap=False, projection=None):
+    """Parse items from XML file (blocking)"""
+    parser = parser_engines[engine](tag_name, namespaces, filter=filter, projection=projection)
+    for chunk in read_data(filename, buffer_size=buffer_size, use_mmap=use_mmap):
+        for out in parser.feed(chunk):
+            yield out
+
+
+def parse_batches(items, put, stopped, batch_size=1000):
+    """Pass batches from items iterator to put (run in background thread)"""
+    batch = []
+    for item in items:
+        if stopped.is_set():
+            return
+        batch.append(item)
+        if len(batch) >= batch_size:
+            put(batch)
+            batch = []
+    if batch:
+        put(batch)
+
+
+async def threaded_stream(items, queue_size=8, batch_size=1000):
+    """Stream items from blocking iterator run in a background thread
+
+    Batches are handed over through a bounded queue, so the parser blocks when
+    the consumer falls more than queue_size batches behind."""
+    batches = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(batch):
+        """Add batch to queue, waiting for space unless stopped"""
+        while not stopped.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        """Parse file and mark end of stream (or error)"""
+        try:
+            parse_batches(items, put, stopped, batch_size=batch_size)
+            put(None)
+        except Exception as exc:
+            put(exc)
+
+    worker = asyncio.ensure_future(asyncio.to_thread(run))
+    try:
+        while True:
+            batch = await asyncio.to_thread(batches.get)
+            if batch is None:
+                break
+            elif isinstance(batch, Exception):
+                raise batch
+            for item in batch:
+                yield item
+    finally:
+        stopped.set()
+        await worker
+        # Release any reader left waiting on the queue
+        try:
+            batches.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def record_pattern(item_tag):
+    """Regular expression matching start tag of item (with any namespace prefix)"""
+    return re.compile(rb"<(?:[\w.-]+:)?" + re.escape(item_tag.encode("utf-8")) + rb"[\s/>]")
+
+
+def find_record_start(f, offset, pattern, read_size=1048576):
+    """Find byte offset of first item start tag at or after offset"""
+    f.seek(offset)
+    carry = b""
+    position = offset
+    while True:
+        data = f.read(read_size)
+        if not data:
+            return None
+        buffer = carry + data
+        match = pattern.search(buffer)
+        if match:
+            return position - len(carry) + match.start()
+        carry = buffer[-256:]
+        position += len(data)
+
+
+def find_records_end(f, item_tag, read_size=1048576):
+    """Find byte offset just after last item end tag"""
+    end_pattern = re.compile(rb"</(?:[\w.-]+:)?" + re.escape(item_tag.encode("utf-8")) + rb"\s*>")
+    f.seek(0, 2)
+    position = f.tell()
+    carry = b""
+    while position > 0:
+        start = max(0, position - read_size)
+        f.seek(start)
+        buffer = f.read(position - start) + carry
+        matches = list(end_pattern.finditer(buffer))
+        if matches:
+            return start + matches[-1].end()
+        carry = buffer[:256]
+        position = start
+    return None
+
+
+def shard_file(filename, item_tag, shard_size):
+    """Split XML file into shards on item boundaries
+
+    Returns the bytes preceding the first item, the bytes following the last
+    item and a list of (start, end) byte ranges each containing whole items."""
+    pattern = record_pattern(item_tag)
+    with open(filename, "rb") as f:
+        first = find_record_start(f, 0, pattern)
+        if first is None:
+            return None, None, []
+        last = find_records_end(f, item_tag)
+        f.seek(0)
+        prefix = f.read(first)
+        f.seek(last)
+        suffix = f.read()
+        starts = [first]
+        while True:
+            start = find_record_start(f, starts[-1] + shard_size, pattern)
+            if start is None or start >= last:
+                break
+            starts.append(start)
+    ends = starts[1:] + [last]
+    return prefix, suffix, list(zip(starts, ends))
+
+
+def parse_shard(filename, start, end, prefix, suffix, tag_name, namespaces, filter=[], engine="etree",
+                read_size=1048576, projection=None):
+    """Parse items in byte range of XML file (run in worker process)"""
+    parser = parser_engines[engine](tag_name, namespaces, filter=filter, projection=projection)
+    records = list(parser.feed(prefix))
+    with open(filename, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(read_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            records.extend(parser.feed(data))
+    records.extend(parser.feed(suffix))
+    return records
+
+
+async def sharded_data_stream(filename, item_tag, tag_name, namespaces, filter=[], engine="etree",
+                              workers=None, shard_size=67108864, ordered=True, buffer_size=1048576,
+                              projection=None):
+    """Stream items from XML file parsed in shards across worker processes"""
+    loop = asyncio.get_running_loop()
+    prefix, suffix, shards = await loop.run_in_executor(None, shard_file, filename, item_tag, shard_size)
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers)
+    max_pending = workers * 2
+    pending = deque()
+    try:
+        shards = iter(shards)
+        while True:
+            while len(pending) < max_pending:
+                shard = next(shards, None)
+                if shard is None: break
+                pending.append(loop.run_in_executor(executor, partial(parse_shard, filename, shard[0], shard[1],
+                                                    prefix, suffix, tag_name, namespaces, filter=filter,
+                                                    engine=engine, read_size=buffer_size,
+                                                    projection=projection)))
+            if not pending:
+                break
+            if ordered:
+                done = [await pending.popleft()]
+            else:
+                finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done = []
+                for future in finished:
+                    pending.remove(future)
+                    done.append(future.result())
+            for records in done:
+                for record in records:
+                    yield record
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_records(filename, item_tag, tag_name, namespaces, filter=[], engine="etree", buffer_size=1048576,
+                  use_mmap=False, projection=None, start=None):
+    """Parse items from XML file, with byte offset of start tag of each item (blocking)
+
+    If start is given parsing resumes from the item at that offset."""
+    pattern = record_pattern(item_tag)
+    parser = parser_engines[engine](tag_name, namespaces, filter=filter, projection=projection)
+    if start:
+        with open(filename, "rb") as f:
+            first = find_record_start(f, 0, pattern)
+            f.seek(0)
+            list(parser.feed(f.read(first)))
+    position = start or 0
+    starts = deque()			# Offsets of items not yet completed
+    found = -1
+    done = 0
+    carry = b""
+    for chunk in read_file(filename, buffer_size=buffer_size, use_mmap=use_mmap, start=position):
+        buffer = carry + chunk
+        for match in pattern.finditer(buffer):
+            offset = position - len(carry) + match.start()
+            if offset > found:
+                starts.append(offset)
+                found = offset
+        carry = buffer[-256:]
+        position += len(chunk)
+        for out in parser.feed(chunk):
+            # Discard offsets of any empty items
+            while done < parser.count - 1:
+                starts.popleft()
+                done += 1
+            done += 1
+            yield starts.popleft(), out
+
+
+async def iterate(items):
+    """Stream items from blocking iterator"""
+    for item in items:
+        yield item
+
+
+def file_details(filename):
+    """Details identifying version of file"""
+    stat = os.stat(filename)
+    return {"file": str(filename), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def load_checkpoint(path, details):
+    """Load checkpoint, if present and for same version of file"""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if all(checkpoint.get(key) == details[key] for key in details):
+        return checkpoint
+    return None
+
+
+def save_checkpoint(path, details, offset, count):
+    """Save checkpoint (offset of next item and count of items processed)"""
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w") as f:
+        json.dump({**details, "offset": offset, "count": count}, f)
+    os.replace(temp_path, path)
+
 
 class XMLData:
     """XML data parser configuration"""
 
-    def __init__(self, item_tag=None, header_tag=None, namespace=None, filter=[]):
+    def __init__(self, item_tag=None, header_tag=None, namespace=None, filter=[], engine="etree",
+                 workers=None, shard_size=67108864, ordered=True, buffer_size=1048576, mmap=False,
+                 projection=None, threaded=False, queue_size=8, batch_size=1000, checkpoint=False,
+                 checkpoint_interval=10000, cache=False):
         """Initial setup"""
         self.item_tag = item_tag
         self.header_tag = header_tag
         self.namespace = namespace
         self.filter = filter
+        if not engine in parser_engines:
+            raise ValueError(f"Unknown XML parser engine: {engine}")
+        self.engine = engine			# XML parser engine ("etree" or "lxml")
+        self.workers = workers			# Worker processes for sharded parsing (or None)
+        self.shard_size = shard_size		# Approximate shard size in bytes
+        self.ordered = ordered			# Preserve file order when sharding
+        self.buffer_size = buffer_size		# Bytes fed to parser per read
+        self.mmap = mmap			# Read file via memory map
+        # Element paths to keep in items (or None to keep all)
+        self.projection = compile_projection(projection) if projection else None
+        self.threaded = threaded		# Parse in background thread
+        self.queue_size = queue_size		# Maximum batches waiting in queue
+        self.batch_size = batch_size		# Items per batch passed from thread
+        self.checkpoint = checkpoint		# Save progress in stage directory and resume
+        self.checkpoint_interval = checkpoint_interval	# Items between flush markers for checkpoints
+        self.cache = cache			# Cache parsed items in stage directory
 
     async def extract_header(self, filename):
         """Extract header"""
         if self.header_tag:
             tag_name = f"{{{self.namespace[next(iter(self.namespace))]}}}{self.header_tag}"
-            async for item in data_stream(filename, tag_name, self.namespace, filter=self.filter):
-                return item
+            async with aclosing(data_stream(filename, tag_name, self.namespace, filter=self.filter,
+                                            engine=self.engine, buffer_size=self.buffer_size,
+                                            use_mmap=self.mmap)) as stream:
+                async for item in stream:
+                    return item
         else:
             return None
 
-    async def process(self, filename):
+    def records(self, filename, tag_name, start=None):
+        """Stream of parsed items from file, with byte offsets"""
+        records = parse_records(filename, self.item_tag, tag_name, self.namespace, filter=self.filter,
+                                engine=self.engine, buffer_size=self.buffer_size, use_mmap=self.mmap,
+                                projection=self.projection, start=start)
+        if self.threaded:
+            return threaded_stream(records, queue_size=self.queue_size, batch_size=self.batch_size)
+        else:
+            return iterate(records)
+
+    async def checkpointed_items(self, filename, tag_name, stage_dir):
+        """Stream of parsed items from file, resuming from and saving checkpoints
+
+        Flush markers are yielded between items, and a checkpoint is only saved
+        once outputs have acknowledged that the items before it are durable."""
+        path = Path(stage_dir) / f"{Path(filename).name}.checkpoint"
+        details = file_details(filename)
+        checkpoint = load_checkpoint(path, details)
+        if checkpoint:
+            logger.info("resuming file", extra={"file": str(filename), "record": checkpoint['count']})
+            count = checkpoint["count"]
+        else:
+            count = 0
+        marked = count
+        pending = deque()			# Flush markers (with offset and count) not yet acknowledged
+        async with aclosing(self.records(filename, tag_name,
+                                         start=checkpoint["offset"] if checkpoint else None)) as stream:
+            async for offset, item in stream:
+                acknowledged = None
+                while pending and pending[0][0]["done"].done():
+                    acknowledged = pending.popleft()
+                if acknowledged:
+                    save_checkpoint(path, details, acknowledged[1], acknowledged[2])
+                if count - marked >= self.checkpoint_interval:
+                    marker = flush_marker()
+                    pending.append((marker, offset, count))
+                    marked = count
+                    yield marker
+                yield item
+                count += 1
+        path.unlink(missing_ok=True)
+
+    def cached_items(self, filename, tag_name, stage_dir):
+        """Stream of parsed items from cache, or from file while writing cache"""
+        path = cache_path(Path(stage_dir) / "cache", filename,
+                          (self.item_tag, self.namespace, self.filter, self.projection))
+        if path.exists():
+            logger.info("reading file from cache", extra={"file": str(filename)})
+            return read_cache(path, buffer_size=self.buffer_size)
+        else:
+            return write_cache(self.items(filename, tag_name), path, buffer_size=self.buffer_size)
+
+    def items(self, filename, tag_name, stage_dir=None):
+        """Stream of parsed items from file"""
+        if self.cache and stage_dir and is_file(filename):
+            return self.cached_items(filename, tag_name, stage_dir)
+        elif self.workers and is_file(filename):
+            return sharded_data_stream(filename, self.item_tag, tag_name, self.namespace, filter=self.filter,
+                                       engine=self.engine, workers=self.workers, shard_size=self.shard_size,
+                                       ordered=self.ordered, buffer_size=self.buffer_size,
+                                       projection=self.projection)
+        elif self.checkpoint and stage_dir and is_file(filename):
+            return self.checkpointed_items(filename, tag_name, stage_dir)
+        elif self.threaded:
+            return threaded_stream(parse_items(filename, tag_name, self.namespace, filter=self.filter,
+                                               engine=self.engine, buffer_size=self.buffer_size,
+                                               use_mmap=self.mmap, projection=self.projection),
+                                   queue_size=self.queue_size, batch_size=self.batch_size)
+        else:
+            return data_stream(filename, tag_name, self.namespace, filter=self.filter, engine=self.engine,
+                               buffer_size=self.buffer_size, use_mmap=self.mmap, projection=self.projection)
+
+    async def process(self, filename, stage_dir=None):
         """Iterate over processed items from file"""
         header = await self.extract_header(filename)
         tag_name = f"{{{self.namespace[next(iter(self.namespace))]}}}{self.item_tag}"
-        async for item in data_stream(filename, tag_name, self.namespace, filter=self.filter):
-            yield header, item
+        async with aclosing(self.items(filename, tag_name, stage_dir=stage_dir)) as stream:
+            async for item in stream:
+                yield header, item
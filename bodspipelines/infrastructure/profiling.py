@@ -0,0 +1,190 @@
+import gc
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import threading
+from collections import deque
+from pathlib import Path
+
+
+def frame_name(code):
+    """Name for function of code object (qualified name needs Python 3.11)"""
+    return f"{Path(code.co_filename).name}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def frame_stack(frame):
+    """Function names from outermost frame to frame"""
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def awaited_generator(awaiting):
+    """Async generator stepped by awaited object (for "async for" over generator)"""
+    for referent in gc.get_referents(awaiting):
+        if hasattr(referent, "ag_frame"):
+            return referent
+    return None
+
+
+def task_stack(task):
+    """Function names of coroutines task is suspended in (outermost first)"""
+    stack = []
+    awaiting = task.get_coro()
+    while awaiting is not None:
+        frame = (getattr(awaiting, "cr_frame", None) or getattr(awaiting, "ag_frame", None) or
+                 getattr(awaiting, "gi_frame", None))
+        if frame is None:
+            awaiting = awaited_generator(awaiting)
+            if awaiting is None:
+                break
+            continue
+        stack.append(frame_name(frame.f_code))
+        awaiting = (getattr(awaiting, "cr_await", None) or getattr(awaiting, "ag_await", None) or
+                    getattr(awaiting, "gi_yieldfrom", None))
+    return stack
+
+
+def idle(stack):
+    """Check whether event loop is waiting for I/O"""
+    return bool(stack) and stack[-1].startswith("selectors.py:")
+
+
+class SamplingProfiler:
+    """Profiler sampling stack of thread running event loop
+
+    While the loop waits for I/O, samples instead record the stack of each
+    task awaiting it (prefixed with "await"), so time spent waiting on
+    Elasticsearch or Kinesis is attributed to the code waiting. Tasks are
+    only safe to inspect on the loop thread, so their stacks are snapshotted
+    there by a callback and passed back to the sampler thread."""
+    def __init__(self, interval=0.005):
+        """Initial setup"""
+        self.interval = interval		# Seconds between samples
+        self.samples = {}			# Collapsed stack: sample count
+        self.snapshots = deque()		# Stacks of awaiting tasks snapshotted on loop thread
+        self.thread_id = None
+        self.loop = None
+        self.running = False
+        self.sampler = None
+
+    def sample(self):
+        """Record stack of profiled thread (or ask loop to snapshot awaiting tasks if idle)"""
+        self.record_snapshots()
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = frame_stack(frame)
+        if idle(stack) and self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.snapshot_tasks, stack)
+                return
+            except RuntimeError:
+                pass
+        self.record([stack])
+
+    def snapshot_tasks(self, stack):
+        """Snapshot stacks of awaiting tasks (run on loop thread, falling back to idle stack if none)"""
+        waiting = [["await", task.get_name()] + task_stack(task) for task in asyncio.all_tasks(self.loop)]
+        self.snapshots.append(waiting or [stack])
+
+    def record_snapshots(self):
+        """Record task stacks snapshotted on loop thread"""
+        while self.snapshots:
+            self.record(self.snapshots.popleft())
+
+    def record(self, stacks):
+        """Count sample for each stack"""
+        for stack in stacks:
+            key = ";".join(stack)
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def run(self):
+        """Take samples until stopped"""
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def start(self):
+        """Start sampling current thread"""
+        self.thread_id = threading.get_ident()
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+        self.running = True
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self.running = False
+        self.sampler.join()
+        self.record_snapshots()
+
+    def collapsed(self):
+        """Samples in collapsed stack format (input for flamegraph.pl or speedscope)"""
+        return "".join(f"{stack} {count}\n" for stack, count in
+                       sorted(self.samples.items(), key=lambda sample: -sample[1]))
+
+    def table(self, top=30):
+        """Functions with most samples (self and cumulative)"""
+        own = {}
+        cumulative = {}
+        total = sum(self.samples.values())
+        for stack, count in self.samples.items():
+            names = stack.split(";")
+            own[names[-1]] = own.get(names[-1], 0) + count
+            for name in set(names):
+                cumulative[name] = cumulative.get(name, 0) + count
+        lines = [f"{total} samples every {self.interval}s", "",
+                 f"{'self':>8} {'self%':>6} {'cumul':>8} {'cumul%':>6}  function"]
+        for name, count in sorted(own.items(), key=lambda entry: -entry[1])[:top]:
+            lines.append(f"{count:8d} {100 * count / total:6.1f} {cumulative[name]:8d} "
+                         f"{100 * cumulative[name] / total:6.1f}  {name}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, name, top=30):
+        """Write collapsed stacks and top functions table"""
+        Path(directory, f"{name}.collapsed").write_text(self.collapsed())
+        Path(directory, f"{name}.txt").write_text(self.table(top=top) if self.samples else "No samples\n")
+
+
+class TracingProfiler:
+    """Profiler using cProfile (CPU time by function, excluding time awaiting I/O)"""
+    def __init__(self):
+        """Initial setup"""
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        """Start profiling current thread"""
+        self.profiler.enable()
+
+    def stop(self):
+        """Stop profiling"""
+        self.profiler.disable()
+
+    def write(self, directory, name, top=30):
+        """Write pstats file and top functions table"""
+        self.profiler.dump_stats(Path(directory, f"{name}.pstats"))
+        with open(Path(directory, f"{name}.txt"), "w") as output:
+            stats = pstats.Stats(self.profiler, stream=output)
+            stats.sort_stats("cumulative").print_stats(top)
+
+
+# Profilers by name
+profilers = {"sample": SamplingProfiler, "cprofile": TracingProfiler}
+
+
+def get_profiler(profile):
+    """Profiler for profile option (True for sampling, or profiler name)"""
+    if profile is True:
+        profile = "sample"
+    if not profile in profilers:
+        raise ValueError(f"Unknown profiler: {profile} (expected one of {', '.join(profilers)})")
+    return profilers[profile]()
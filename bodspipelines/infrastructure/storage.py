@@ -1,6 +1,9 @@
 from typing import List, Union, Optional
 from dataclasses import dataclass
 
+from bodspipelines.infrastructure.utils import is_flush
+from bodspipelines.infrastructure.metrics import metrics
+
 class Storage:
     """Storage definition class"""
 
@@ -67,6 +70,17 @@ class Storage:
         self.storage.set_index(item_type)
         return await self.storage.get(id)
 
+    async def get_items(self, ids, item_type):
+        """Get items with ids from index (id: item for those found)"""
+        if hasattr(self.storage, 'mget'):
+            return await self.storage.mget(item_type, ids)
+        self.storage.set_index(item_type)
+        items = {}
+        for id in ids:
+            item = await self.storage.get(id)
+            if item is not None: items[id] = item
+        return items
+
     async def add_item(self, item, item_type, overwrite=False):
         """Add item to index"""
         self.storage.set_index(item_type)
@@ -91,9 +105,10 @@ class Storage:
         self.storage.set_index(item_type)
         await self.storage.delete(id)
 
-    async def stream_items(self, index):
-        """Stream items in index"""
-        async for item in self.storage.scan_index(index):
+    async def stream_items(self, index, slices=None):
+        """Stream items in index (scanning slices concurrently if supported)"""
+        scan = self.storage.scan_index(index, slices=slices) if slices else self.storage.scan_index(index)
+        async for item in scan:
             yield item['_source']
 
     async def process(self, item, item_type):
@@ -113,9 +128,11 @@ class Storage:
         """Create stream of batched actions"""
         batch = []
         async for item in stream:
-            if "flush" in item and item["flush"] is True:
+            if is_flush(item):
                 if len(batch) > 0:
                     yield await self.create_batch(batch)
+                    batch = []
+                yield None, item
             else:
                 batch.append(self.create_action(index_name, item))
                 if len(batch) > 485:
@@ -125,10 +142,46 @@ class Storage:
             yield await self.create_batch(batch)
 
     async def process_batch(self, stream, item_type):
-        """Store items from stream in batches"""
+        """Store items from stream in batches, passing on flush markers once earlier items are readable"""
+        written = set()				# Indexes written since last flush
         async for actions, items in self.batch_stream(stream, item_type):
+            if actions is None:
+                await self.flush_indexes(written)
+                written = set()
+                yield items
+            else:
+                written.update(action['_index'] for action in items)
+                async for item in self.store_batch(actions, items, item_type):
+                    yield item
+
+    async def flush(self, index_name=None):
+        """Make stored items visible to reads"""
+        if hasattr(self.storage, 'refresh'):
+            await self.storage.refresh(index_name)
+
+    async def flush_indexes(self, index_names):
+        """Make items stored in indexes visible to reads (nothing to do if none)"""
+        if index_names:
+            await self.flush(",".join(sorted(index_names)))
+
+    async def process_items(self, items, item_type):
+        """Store batch of items"""
+        actions = [self.create_action(item_type, item) for item in items]
+        async for item in self.store_batch(actions, actions, item_type):
+            yield item
+
+    async def store_batch(self, actions, items, item_type):
+        """Store batch of actions, recording metrics"""
+        component = f"storage/{getattr(item_type, '__name__', item_type)}"
+        metrics.count("items_total", component, len(items))
+        metrics.batch(component, len(items))
+        new = []
+        with metrics.timer(component):
             async for item in self.storage.batch_store_data(actions, items, item_type):
-                yield item
+                new.append(item)
+        metrics.count("new_items_total", component, sum(1 for item in new if item))
+        for item in new:
+            yield item
 
     async def setup_indexes(self):
         """Setup indexes"""
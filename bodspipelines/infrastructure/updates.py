@@ -2,6 +2,9 @@ from bodspipelines.pipelines.gleif.indexes import id_rr as rr_id
 from bodspipelines.infrastructure.utils import (current_date_iso, generate_statement_id, 
                                                 random_string, format_date)
 from bodspipelines.infrastructure.caching import Caching
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("updates")
 
 def convert_rel_type(rel_type):
     """Convert Relationship Type To Exception Type"""
@@ -350,29 +353,66 @@ async def process_ooc_repex(statement_id, statement, item, except_lei, except_ty
         await latest_save(cache, f"{except_lei}_{except_type}_{except_reason}_ownership", statement_id, updates=updates)
     return statement_id, statement
 
+def item_keys(item):
+    """Cache keys (item type, id) read processing item"""
+    if "ExceptionCategory" in item:
+        lei, except_type, except_reason = item["LEI"], item["ExceptionCategory"], item["ExceptionReason"]
+        return [("exceptions", f"{lei}_{except_type}"), ("latest", lei),
+                ("latest", f"{lei}_{except_type}_{except_reason}_entity"),
+                ("latest", f"{lei}_{except_type}_{except_reason}_ownership")]
+    elif "Relationship" in item:
+        start = item["Relationship"]["StartNode"]["NodeID"]
+        end = item["Relationship"]["EndNode"]["NodeID"]
+        rel_type = item["Relationship"]["RelationshipType"]
+        keys = [("latest", start), ("latest", end), ("latest", f"{start}_{end}_{rel_type}")]
+        if rel_type in ("IS_DIRECTLY_CONSOLIDATED_BY", "IS_ULTIMATELY_CONSOLIDATED_BY"):
+            keys.append(("exceptions", f"{start}_{convert_rel_type(rel_type)}"))
+        return keys
+    else:
+        return [("latest", item["LEI"])]
+
+async def prefetch_items(cache, items):
+    """Read cached state for batch of items from storage, then references to their latest statements"""
+    keys = [key for item in items for key in item_keys(item)]
+    await cache.prefetch(keys)
+    latest = [await cache.get(item_id, item_type) for item_type, item_id in keys if item_type == "latest"]
+    await cache.prefetch([("references", data["statement_id"]) for data in latest if data])
+
 class ProcessUpdates:
     """Data processor definition class"""
-    def __init__(self, id_name=None, transform=None, updates=None, storage=None):
+    def __init__(self, id_name=None, transform=None, updates=None, storage=None, snapshot=None, disk_cache=None,
+                 lazy_cache=False, load_slices=None):
         """Initial setup"""
         self.transform = transform
         self.updates = updates
         self.id_name = id_name
         self.storage = storage
-        self.cache = Caching(self.storage, batching=-1)
+        self.cache = Caching(self.storage, batching=-1, snapshot=snapshot, disk=disk_cache, lazy=lazy_cache,
+                             load_slices=load_slices)
+        self.pool = None			# Process pool for pure transforms (set by stage)
 
     async def setup(self):
         """Load data into cache"""
         await self.storage.setup()
         await self.cache.load()
 
-    async def process(self, item, item_type, header, updates=False):
+    async def transformed(self, item, item_type, header, mapping, statements=None):
+        """Statements transformed from item (unless already transformed)"""
+        if statements is None:
+            async for statement in self.transform.process(item, item_type, header, mapping=mapping):
+                yield statement
+        else:
+            for statement in statements:
+                yield statement
+
+    async def process(self, item, item_type, header, updates=False, statements=None):
         """Process updates if applicable"""
-        print(f"Processing - updates: {updates}")
+        logger.debug("processing item", extra={"item_type": item_type, "updates": updates})
         entity_voided = False
         entity_type = None
         mapping, old_ooc_id, old_other_id, old_reason, old_reference, old_entity_type, except_lei, \
             except_type, except_reason, except_reference = await item_setup(self.cache, item, updates=updates)
-        async for statement in self.transform.process(item, item_type, header, mapping=mapping):
+        async for statement in self.transformed(item, item_type, header, mapping, statements=statements):
             statement_id = statement['statementID']
             if statement['statementType'] in ('entityStatement', 'personStatement'):
                 entity_type = statement['statementType']
@@ -427,9 +467,24 @@ class ProcessUpdates:
             await exception_save(self.cache, f"{except_lei}_{except_type}", ooc_id, 
                                  other_id, except_reason, except_reference, entity_type, updates=updates)
 
+    async def process_batch(self, items, item_type, header, updates=False):
+        """Process batch of items, transforming those not needing a mapping in process pool"""
+        if self.pool and getattr(self.transform, "cpu_bound", False):
+            transformed = await self.pool.map_batch(self.transform.transform_batch, items, item_type, header,
+                                                    mapping=None)
+        else:
+            transformed = [None] * len(items)
+        if self.cache.lazy:
+            await prefetch_items(self.cache, items)
+        out = []
+        for item, statements in zip(items, transformed):
+            async for statement in self.process(item, item_type, header, updates=updates, statements=statements):
+                out.append(statement)
+        return out
+
     async def finish_updates(self, updates=False):
         """Process updates to referencing statements"""
-        print("In finish_updates")
+        logger.info("finishing updates", extra={"updates": updates})
         data_type = self.updates
         if updates:
             done_updates = []
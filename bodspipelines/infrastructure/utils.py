@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import dateutil
 import pytz
@@ -9,6 +10,47 @@ import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+class ProcessPool:
+    """Process pool running pure functions over batches of items"""
+
+    def __init__(self, workers):
+        """Initial setup"""
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    async def map_batch(self, func, items, *args, **kwargs):
+        """Run func on contiguous chunks of items across workers, returning results in order"""
+        if not items:
+            return []
+        loop = asyncio.get_running_loop()
+        size = -(-len(items) // self.workers)
+        results = await asyncio.gather(*[loop.run_in_executor(self.executor,
+                                                              partial(func, items[i:i+size], *args, **kwargs))
+                                         for i in range(0, len(items), size)])
+        return [result for chunk in results for result in chunk]
+
+    def close(self):
+        """Shutdown worker processes"""
+        self.executor.shutdown()
+
+
+def flush_marker():
+    """Create marker item asking outputs to acknowledge once all earlier items are durable"""
+    return {"flush": True, "done": asyncio.get_running_loop().create_future()}
+
+
+def is_flush(item):
+    """Is item a flush marker"""
+    return isinstance(item, dict) and item.get("flush") is True
+
+
+def acknowledge_flush(item):
+    """Acknowledge flush marker (all earlier items written)"""
+    if "done" in item and not item["done"].done():
+        item["done"].set_result(True)
+
 
 def random_string(length):
     """Generate random string of specified length"""
@@ -3,8 +3,9 @@ import time
 import elastic_transport
 import asyncio
 from datetime import datetime
+from functools import partial
 
-from bodspipelines.infrastructure.pipeline import Source, Stage, Pipeline
+from bodspipelines.infrastructure.pipeline import Source, Stage, PipelinedStage, Pipeline
 from bodspipelines.infrastructure.inputs import KinesisInput
 from bodspipelines.infrastructure.storage import Storage
 from bodspipelines.infrastructure.clients.elasticsearch_client import ElasticsearchClient
@@ -14,6 +15,8 @@ from bodspipelines.infrastructure.processing.bulk_data import BulkData
 from bodspipelines.infrastructure.processing.xml_data import XMLData
 from bodspipelines.infrastructure.processing.json_data import JSONData
 from bodspipelines.infrastructure.updates import ProcessUpdates
+from bodspipelines.infrastructure.caching import CacheSnapshot, DiskCache
+from bodspipelines.infrastructure.partitions import PartitionedUpdates
 
 from bodspipelines.pipelines.gleif.indexes import gleif_index_properties
 from bodspipelines.infrastructure.indexes import bods_index_properties
@@ -25,6 +28,76 @@ from bodspipelines.pipelines.gleif.indexes import (lei_properties, rr_properties
 from bodspipelines.pipelines.gleif.utils import gleif_download_link, GLEIFData, identify_gleif
 from bodspipelines.pipelines.gleif.updates import GleifUpdates
 from bodspipelines.infrastructure.utils import identify_bods, load_last_run, save_run
+from bodspipelines.infrastructure.log import configure_logging
+
+# Log level (DEBUG for per-batch detail) and format ("text" key=value lines or "json")
+configure_logging(level=os.environ.get('GLEIF_LOG_LEVEL', 'INFO'),
+                  format=os.environ.get('GLEIF_LOG_FORMAT', 'text'))
+
+# XML parser engine, "lxml" or "etree" for standard library parser (unset for lxml)
+parser_engine = os.environ.get('GLEIF_PARSER_ENGINE', 'lxml')
+
+# Worker processes for sharded XML parsing (unset to parse in-process)
+parser_workers = int(os.environ.get('GLEIF_PARSER_WORKERS', 0)) or None
+
+# Parse data directly from downloaded "zip" file or "http" response (unset to extract XML)
+data_streaming = os.environ.get('GLEIF_DATA_STREAMING') or None
+
+# Items per batch moved through stages (unset to process items singly)
+batch_size = int(os.environ.get('GLEIF_BATCH_SIZE', 0)) or None
+
+# Worker processes for pure transforms in batched transform stage (unset to transform in-process)
+transform_workers = int(os.environ.get('GLEIF_TRANSFORM_WORKERS', 0)) or None
+
+# Worker processes each owning transform state for a partition of LEI components (unset to use one process)
+transform_partitions = int(os.environ.get('GLEIF_TRANSFORM_PARTITIONS', 0)) or None
+updates_class = (partial(PartitionedUpdates, partitions=transform_partitions) if transform_partitions
+                 else ProcessUpdates)
+
+# Items per batch in transform stage (partition workers are sent batches, so batched even if batch size unset)
+transform_batch_size = batch_size or (1000 if transform_partitions else None)
+
+# Snapshot file of transform stage cache, loaded in place of scanning indexes if current (unset for none)
+cache_snapshot = (CacheSnapshot(os.environ['GLEIF_CACHE_SNAPSHOT'], "transform")
+                  if os.environ.get('GLEIF_CACHE_SNAPSHOT') else None)
+
+# Directory for on-disk transform stage cache, with records held in memory (unset to hold all in memory)
+disk_cache = (DiskCache(os.environ['GLEIF_DISK_CACHE'],
+                        lru_size=int(os.environ.get('GLEIF_DISK_CACHE_RECORDS', 100000)))
+              if os.environ.get('GLEIF_DISK_CACHE') else None)
+
+# Read transform stage cache from indexes when needed instead of loading it all (e.g. for small delta runs)
+lazy_cache = bool(os.environ.get('GLEIF_LAZY_CACHE'))
+
+# Sliced scrolls scanned concurrently loading each transform stage cache index (unset for one scroll)
+load_slices = int(os.environ.get('GLEIF_CACHE_LOAD_SLICES', 0)) or None
+
+# Ingest sources processed at once, with output kept in source order (unset to process in turn)
+concurrent_sources = int(os.environ.get('GLEIF_CONCURRENT_SOURCES', 0)) or None
+
+# Run stage components as concurrent tasks connected by queues (unset to run in turn)
+stage_class = PipelinedStage if os.environ.get('GLEIF_PIPELINED') else Stage
+
+# Cache parsed records in stage directory for repeat runs (unset to always parse XML)
+parse_cache = bool(os.environ.get('GLEIF_PARSE_CACHE'))
+
+# Parse XML in a background thread alongside pipeline processing (unset to parse inline)
+parser_threaded = bool(os.environ.get('GLEIF_PARSER_THREADED'))
+
+# Save parse progress in stage directory once items are stored, resuming interrupted runs (unset to start over)
+parse_checkpoint = bool(os.environ.get('GLEIF_PARSE_CHECKPOINT'))
+
+# Only keep LEI record fields used by the transform stage (unset to keep all)
+lei_projection = ["LEI",
+                  "Entity/LegalName",
+                  "Entity/LegalJurisdiction",
+                  "Entity/RegistrationAuthority",
+                  "Entity/LegalAddress",
+                  "Entity/HeadquartersAddress",
+                  "Entity/EntityCreationDate",
+                  "Registration/LastUpdateDate",
+                  "Registration/RegistrationStatus",
+                  "Registration/ValidationSources"] if os.environ.get('GLEIF_PROJECTION') else None
 
 # Defintion of LEI-CDF v3.1 XML date source
 lei_source = Source(name="lei",
@@ -32,11 +105,18 @@ lei_source = Source(name="lei",
                        data=GLEIFData(url="https://goldencopy.gleif.org/api/v2/golden-copies/publishes/lei2/latest",
                                       data_date="2024-01-01"),
                               size=41491,
-                              directory="lei-cdf"),
+                              directory="lei-cdf",
+                              streaming=data_streaming),
                     datatype=XMLData(item_tag="LEIRecord",
                                      namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016",
                                           "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"},
-                                     filter=['NextVersion', 'Extension']))
+                                     filter=['NextVersion', 'Extension'],
+                                     engine=parser_engine,
+                                     workers=parser_workers,
+                                     projection=lei_projection,
+                                     threaded=parser_threaded,
+                                     checkpoint=parse_checkpoint,
+                                     cache=parse_cache))
 
 # Defintion of RR-CDF v2.1 XML date source
 rr_source = Source(name="rr",
@@ -44,11 +124,17 @@ rr_source = Source(name="rr",
                        data=GLEIFData(url="https://goldencopy.gleif.org/api/v2/golden-copies/publishes/rr/latest",
                                       data_date="2024-01-01"),
                        size=2823,
-                       directory="rr-cdf"),
+                       directory="rr-cdf",
+                       streaming=data_streaming),
                    datatype=XMLData(item_tag="RelationshipRecord",
                             namespace={"rr": "http://www.gleif.org/data/schema/rr/2016",
                                        "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"},
-                            filter=['NextVersion', ]))
+                            filter=['NextVersion', ],
+                            engine=parser_engine,
+                            workers=parser_workers,
+                            threaded=parser_threaded,
+                            checkpoint=parse_checkpoint,
+                            cache=parse_cache))
 
 # Defintion of Reporting Exceptions v2.1 XML date source
 repex_source = Source(name="repex",
@@ -56,12 +142,18 @@ repex_source = Source(name="repex",
                       data=GLEIFData(url="https://goldencopy.gleif.org/api/v2/golden-copies/publishes/repex/latest",
                                      data_date="2024-01-01"),
                            size=3954,
-                           directory="rep-ex"),
+                           directory="rep-ex",
+                           streaming=data_streaming),
                       datatype=XMLData(item_tag="Exception",
                                  header_tag="Header",
                                  namespace={"repex": "http://www.gleif.org/data/schema/repex/2016",
                                             "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"},
-                                 filter=['NextVersion', ]))
+                                 filter=['NextVersion', ],
+                                 engine=parser_engine,
+                                 workers=parser_workers,
+                                 threaded=parser_threaded,
+                                 checkpoint=parse_checkpoint,
+                                 cache=parse_cache))
 
 # Easticsearch storage for GLEIF data
 gleif_storage = ElasticsearchClient(indexes=gleif_index_properties)
@@ -71,11 +163,13 @@ output_new = NewOutput(storage=Storage(storage=gleif_storage),
                        output=KinesisOutput(stream_name=os.environ.get('GLEIF_KINESIS_STREAM')))
 
 # Definition of GLEIF data pipeline ingest stage
-ingest_stage = Stage(name="ingest",
+ingest_stage = stage_class(name="ingest",
               sources=[lei_source, rr_source, repex_source],
               processors=[AddContentDate(identify=identify_gleif),
                           RemoveEmptyExtension(identify=identify_gleif)],
-              outputs=[output_new])
+              outputs=[output_new],
+              batch_size=batch_size,
+              concurrency=concurrent_sources)
 
 # Kinesis stream of GLEIF data from ingest stage
 gleif_source = Source(name="gleif",
@@ -91,16 +185,29 @@ bods_output_new = NewOutput(storage=Storage(storage=bods_storage),
                             identify=identify_bods)
 
 # Definition of GLEIF data pipeline transform stage
-transform_stage = Stage(name="transform",
+transform_stage = stage_class(name="transform",
               sources=[gleif_source],
-              processors=[ProcessUpdates(id_name='XI-LEI',
+              processors=[updates_class(id_name='XI-LEI',
                                          transform=Gleif2Bods(identify=identify_gleif),
-                                         storage=Storage(storage=bods_storage),
-                                         updates=GleifUpdates())],
-              outputs=[bods_output_new])
+                                        storage=Storage(storage=bods_storage),
+                                        updates=GleifUpdates(),
+                                        snapshot=cache_snapshot,
+                                        disk_cache=disk_cache,
+                                        lazy_cache=lazy_cache,
+                                        load_slices=load_slices)],
+              outputs=[bods_output_new],
+              batch_size=transform_batch_size,
+              workers=transform_workers)
+
+# Directory for Prometheus metrics file (updated every minute) and end of run summary (unset for none)
+metrics_dir = os.environ.get('GLEIF_METRICS_DIR') or None
+
+# Profiler to run for each stage ("sample" or "cprofile"), writing results to the stage directory (unset for none)
+profile = os.environ.get('GLEIF_PROFILE') or None
 
 # Definition of GLEIF data pipeline
-pipeline = Pipeline(name="gleif", stages=[ingest_stage, transform_stage])
+pipeline = Pipeline(name="gleif", stages=[ingest_stage, transform_stage], metrics_dir=metrics_dir,
+                    profile=profile)
 
 # Setup storage indexes
 async def setup_indexes():
@@ -123,6 +230,8 @@ async def save_current_run(name, start_timestamp):
                 'start_timestamp': str(start_timestamp),
                 'end_timestamp': datetime.now().timestamp()}
     await save_run(storage_run, run_data)
+    if cache_snapshot and name == cache_snapshot.run_name:
+        cache_snapshot.stamp(run_data['end_timestamp'])
 
 # Setup pipeline storage
 def setup():
@@ -318,6 +318,8 @@ def transform_repex(data, mapping):
 
 class Gleif2Bods:
     """Data processor definition class"""
+    cpu_bound = True			# Pure transform, can run in worker processes
+
     def __init__(self, identify=None):
         """Initial setup"""
         self.identify = identify
@@ -334,6 +336,31 @@ class Gleif2Bods:
             for statement in transform_repex(item, mapping):
                 yield statement
 
+    def transform_batch(self, items, item_type, header, mapping={}):
+        """Transform batch of items, returning list of statements for each item
+
+        If mapping is None, items needing one (relationships and reporting
+        exceptions) are left as None, to be transformed later."""
+        out = []
+        for item in items:
+            current_type = self.identify(item) if self.identify else item_type
+            if current_type == 'lei':
+                out.append([transform_lei(item)])
+            elif mapping is None:
+                out.append(None)
+            elif current_type == 'rr':
+                out.append([transform_rr(item, mapping)])
+            elif current_type == 'repex':
+                out.append(list(transform_repex(item, mapping)))
+            else:
+                out.append([])
+        return out
+
+    async def process_batch(self, items, item_type, header, mapping={}, updates=False):
+        """Process batch of items"""
+        return [statement for statements in self.transform_batch(items, item_type, header, mapping=mapping)
+                          for statement in statements]
+
 class AddContentDate:
     """Data processor to add ContentDate"""
     def __init__(self, identify=None):
@@ -347,6 +374,13 @@ class AddContentDate:
             item["ContentDate"] = header["ContentDate"]
         yield item
 
+    async def process_batch(self, items, item_type, header, mapping={}, updates=False):
+        """Process batch of items"""
+        for item in items:
+            if (self.identify(item) if self.identify else item_type) == 'repex':
+                item["ContentDate"] = header["ContentDate"]
+        return items
+
 class RemoveEmptyExtension:
     """Data processor to remove empty Extension"""
     def __init__(self, identify=None):
@@ -360,3 +394,11 @@ class RemoveEmptyExtension:
             if "Extension" in item and not isinstance(item["Extension"], dict):
                 del item["Extension"]
         yield item
+
+    async def process_batch(self, items, item_type, header, mapping={}, updates=False):
+        """Process batch of items"""
+        for item in items:
+            if (self.identify(item) if self.identify else item_type) == 'repex':
+                if "Extension" in item and not isinstance(item["Extension"], dict):
+                    del item["Extension"]
+        return items
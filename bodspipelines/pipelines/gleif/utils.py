@@ -2,6 +2,9 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 from bodspipelines.infrastructure.utils import download_delayed, download
+from bodspipelines.infrastructure.log import get_logger
+
+logger = get_logger("gleif")
 
 def source_metadata(r):
     """Get metadata from request"""
@@ -13,7 +16,7 @@ def get_source(r, name):
     """Extract source url from metadata"""
     data = source_metadata(r)
     url = data['full_file']['xml']['url']
-    print(f"Using: {url}")
+    logger.info("using source", extra={"url": url})
     return url
 
 def step_date(date, time, period_name, count):
@@ -53,10 +56,10 @@ def step_period(data, base, period_name, count):
 def get_sources_int(data, base, last_update):
     """Get urls for sources (internal)"""
     current_date = data['publish_date']
-    print(current_date, last_update)
     delta = relativedelta(datetime.strptime(current_date, "%Y-%m-%d %H:%M:%S"),
                           datetime.strptime(last_update, "%Y-%m-%d %H:%M:%S"))
-    print(current_date, delta)
+    logger.info("checking for updates", extra={"publish_date": current_date, "last_update": last_update,
+                                               "delta": delta})
     periods = {'months': 'LastMonth', 'days': 'LastDay', 'hours': 'IntraDay'}
     done = 0
     if getattr(delta, 'months') > 0:
@@ -145,11 +148,11 @@ def find_urls_for_target_date(target_date):
         start_date = datetime.strptime(data[9]["publish_date"].split()[0], "%Y-%m-%d")
         if target_date < start_date:
             delta = start_date - target_date
-            print(delta.days)
+            logger.debug("searching for publish date", extra={"days": delta.days, "page": page})
             page = page + max(1, int(delta.days/3))
         elif target_date > end_date:
             delta = target_date - end_date
-            print(delta.days)
+            logger.debug("searching for publish date", extra={"days": delta.days, "page": page})
             page = page - max(1, int(delta.days/3))
         else:
             return data, page
@@ -216,7 +219,7 @@ class GLEIFData:
     def sources(self, last_update=False, delta_type=None):
         """Yield data sources"""
         if last_update:
-            print("Updating ...")
+            logger.info("updating", extra={"last_update": last_update})
             if delta_type:
                 if delta_type == "stream":
                     yield from get_source_from_date(self.url, self.data_date, delta_type=delta_type)
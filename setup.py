@@ -17,7 +17,6 @@ install_requires = [
     "pytz",
     "pycountry",
     "aiohttp",
-    "aiofiles",
     "redis",
     "psutil",
     "loguru"
@@ -0,0 +1,71 @@
+import json
+from unittest.mock import patch
+
+from bodspipelines.infrastructure.pipeline import Source, Stage, Pipeline
+from bodspipelines.infrastructure.inputs import KinesisInput
+from bodspipelines.infrastructure.outputs import NewOutput, KinesisOutput
+from bodspipelines.infrastructure.storage import Storage
+from bodspipelines.infrastructure.updates import ProcessUpdates
+from bodspipelines.infrastructure.clients.elasticsearch_client import ElasticsearchClient
+from bodspipelines.infrastructure.processing.bulk_data import BulkData
+from bodspipelines.infrastructure.processing.xml_data import XMLData
+from bodspipelines.infrastructure.processing.json_data import JSONData
+from bodspipelines.infrastructure.indexes import bods_index_properties
+from bodspipelines.infrastructure.utils import identify_bods
+from bodspipelines.infrastructure.benchmark import benchmark, report
+from bodspipelines.pipelines.gleif.indexes import gleif_index_properties
+from bodspipelines.pipelines.gleif.transforms import Gleif2Bods, AddContentDate, RemoveEmptyExtension
+from bodspipelines.pipelines.gleif.updates import GleifUpdates
+from bodspipelines.pipelines.gleif.utils import GLEIFData, identify_gleif
+
+
+def gleif_pipeline():
+    """GLEIF pipeline using Elasticsearch and Kinesis"""
+    lei_source = Source(name="lei",
+                        origin=BulkData(display="LEI-CDF v3.1",
+                                        data=GLEIFData(url="https://example.com/lei"),
+                                        size=41491,
+                                        directory="lei-cdf"),
+                        datatype=XMLData(item_tag="LEIRecord",
+                                         namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016",
+                                                    "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"},
+                                         filter=['NextVersion', 'Extension']))
+    ingest_stage = Stage(name="ingest",
+                         sources=[lei_source],
+                         processors=[AddContentDate(identify=identify_gleif),
+                                     RemoveEmptyExtension(identify=identify_gleif)],
+                         outputs=[NewOutput(storage=Storage(storage=ElasticsearchClient(indexes=gleif_index_properties)),
+                                            output=KinesisOutput(stream_name="gleif"))])
+    bods_storage = ElasticsearchClient(indexes=bods_index_properties)
+    transform_stage = Stage(name="transform",
+                            sources=[Source(name="gleif", origin=KinesisInput(stream_name="gleif"),
+                                            datatype=JSONData())],
+                            processors=[ProcessUpdates(id_name='XI-LEI',
+                                                       transform=Gleif2Bods(identify=identify_gleif),
+                                                       storage=Storage(storage=bods_storage),
+                                                       updates=GleifUpdates())],
+                            outputs=[NewOutput(storage=Storage(storage=bods_storage),
+                                               output=KinesisOutput(stream_name="bods"),
+                                               identify=identify_bods)])
+    return Pipeline(name="gleif", stages=[ingest_stage, transform_stage])
+
+
+def test_benchmark_stages(tmp_path):
+    """Test ingest and transform stages run against local files without services"""
+    pipeline = gleif_pipeline()
+    gleif_path = tmp_path / "gleif.jsonl"
+    bods_path = tmp_path / "bods.jsonl"
+    with patch('bodspipelines.infrastructure.pipeline.Pipeline.directory') as mock_pdr:
+        mock_pdr.return_value = tmp_path
+        summary = benchmark(pipeline, "ingest", files={"lei": ["tests/fixtures/lei-data.xml"]}, output=gleif_path)
+        assert summary["components"]["source/lei"]["items_total"] == 13
+        assert summary["components"]["storage/lei"]["new_items_total"] == 13
+        assert "source/lei" in report(summary)
+        summary = benchmark(pipeline, "transform", inputs={"gleif": gleif_path}, output=bods_path)
+    records = [json.loads(line) for line in bods_path.read_text().splitlines()]
+    assert len(records) == 13
+    assert all(record["statementType"] == "entityStatement" for record in records)
+    assert summary["components"]["processor/ProcessUpdates"]["items_total"] == 13
+    assert isinstance(pipeline.stages[0].outputs[0].output, KinesisOutput)
+    assert isinstance(pipeline.stages[1].sources[0].origin, KinesisInput)
+    assert isinstance(pipeline.stages[1].outputs[0].storage.storage, ElasticsearchClient)
@@ -0,0 +1,88 @@
+import zipfile
+from pathlib import Path
+from unittest.mock import patch, Mock
+import pytest
+
+from bodspipelines.infrastructure.processing.bulk_data import (BulkData, ZipFileStream, ZipStreamReader,
+                                                               HTTPZipStream)
+from bodspipelines.infrastructure.processing.xml_data import XMLData
+
+
+class DummyData:
+    """Dummy data sources"""
+    def sources(self, last_update=False, delta_type=None):
+        yield "https://example.com/repex-data.zip"
+
+
+@pytest.fixture
+def repex_xml_data_file():
+    """GLEIF Repex XML data"""
+    return Path("tests/fixtures/repex-data.xml")
+
+
+@pytest.fixture
+def repex_zip_data_file(tmp_path, repex_xml_data_file):
+    """GLEIF Repex XML data in zip archive"""
+    directory = tmp_path / "rep-ex"
+    directory.mkdir()
+    zip_file = directory / "repex-data.zip"
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.write(repex_xml_data_file, "repex-data.xml")
+    return zip_file
+
+
+def repex_parser():
+    """Reporting Exceptions parser"""
+    return XMLData(item_tag="Exception",
+                   header_tag="Header",
+                   namespace={"repex": "http://www.gleif.org/data/schema/repex/2016"},
+                   filter=['NextVersion', 'Extension'],
+                   engine="lxml")
+
+
+@pytest.mark.asyncio
+async def test_zip_file_stream(repex_xml_data_file, repex_zip_data_file):
+    """Test parsing XML directly from zip archive"""
+    expected = [item async for item in repex_parser().process(repex_xml_data_file)]
+    items = [item async for item in repex_parser().process(ZipFileStream(repex_zip_data_file, "repex-data.xml"))]
+    assert len(items) == 10
+    assert items == expected
+
+
+@pytest.mark.asyncio
+async def test_http_zip_stream(repex_xml_data_file, repex_zip_data_file):
+    """Test parsing XML from zip archive as it is downloaded"""
+    data = repex_zip_data_file.read_bytes()
+    with patch('bodspipelines.infrastructure.processing.bulk_data.requests.get') as mock_get:
+        mock_get.side_effect = lambda *args, **kwargs: Mock(
+                       iter_content=lambda chunk_size: (data[i:i+1000] for i in range(0, len(data), 1000)))
+        expected = [item async for item in repex_parser().process(repex_xml_data_file)]
+        stream = HTTPZipStream("https://example.com/repex-data.zip")
+        items = [item async for item in repex_parser().process(stream)]
+    assert len(items) == 10
+    assert items == expected
+
+
+def test_zip_stream_reader(repex_xml_data_file, repex_zip_data_file):
+    """Test decompressing zip archive from chunks"""
+    data = repex_zip_data_file.read_bytes()
+    reader = ZipStreamReader(data[i:i+100] for i in range(0, len(data), 100))
+    out = b""
+    while block := reader.read(333):
+        out += block
+    assert reader.name == "repex-data.xml"
+    assert out == repex_xml_data_file.read_bytes()
+
+
+def test_bulk_data_prepare_zip(tmp_path, repex_zip_data_file):
+    """Test existing zip archive streamed without extracting"""
+    bulk_data = BulkData(display="Reporting Exceptions v2.1",
+                         data=DummyData(),
+                         size=3954,
+                         directory="rep-ex",
+                         streaming="zip")
+    streams = list(bulk_data.prepare(tmp_path, "repex"))
+    assert len(streams) == 1
+    assert isinstance(streams[0], ZipFileStream)
+    assert streams[0].name == "repex-data.xml"
+    assert not list((tmp_path / "rep-ex").glob("*.xml"))
@@ -0,0 +1,200 @@
+import random
+import asyncio
+import pytest
+
+from bodspipelines.infrastructure.caching import (Caching, CacheSnapshot, CompactRecords, DiskCache,
+                                                  compact_cache)
+from bodspipelines.infrastructure.storage import Storage
+from bodspipelines.infrastructure.clients.memory_client import MemoryClient
+from bodspipelines.infrastructure.indexes import bods_index_properties
+from bodspipelines.infrastructure.updates import (latest_save, references_save, latest_lookup, lookup_references,
+                                                  prefetch_items)
+from bodspipelines.infrastructure.utils import generate_statement_id, save_run
+
+
+def test_compact_records_round_trip():
+    """Test records read back from compact store as saved"""
+    cache = compact_cache()
+    latest = {"latest_id": "029200067A7K6CH0H586", "statement_id": generate_statement_id("a", "entityStatement"),
+              "reason": False}
+    references = {"statement_id": generate_statement_id("b", "entityStatement"),
+                  "references_id": [{"statement_id": generate_statement_id("c", "ownershipOrControlStatement"),
+                                     "latest_id": "029200067A7K6CH0H586_5493001Z012YSB2A0K51_IS_DIRECTLY_CONSOLIDATED_BY"}]}
+    exception = {"latest_id": "029200067A7K6CH0H586_DIRECT_ACCOUNTING_CONSOLIDATION_PARENT",
+                 "statement_id": generate_statement_id("d", "ownershipOrControlStatement"),
+                 "other_id": None, "reason": "NATURAL_PERSONS", "reference": None, "entity_type": None}
+    cache["latest"][latest["latest_id"]] = latest
+    cache["references"][references["statement_id"]] = references
+    cache["exceptions"][exception["latest_id"]] = exception
+    assert cache["latest"].get(latest["latest_id"]) == latest
+    assert cache["references"][references["statement_id"]] == references
+    assert cache["exceptions"][exception["latest_id"]] == exception
+    assert not cache["latest"].raw and not cache["references"].raw and not cache["exceptions"].raw
+    assert list(cache["latest"].items()) == [(latest["latest_id"], latest)]
+
+
+@pytest.mark.parametrize("record", [
+    {"latest_id": "A", "statement_id": "not-a-uuid", "reason": False},
+    {"latest_id": "A", "statement_id": "6BA7B810-9DAD-11D1-80B4-00C04FD430C8", "reason": False},
+    {"latest_id": "A", "statement_id": "6ba7b810-9dad-11d1-80b4-00c04fd430c8", "reason": False, "extra": 1},
+])
+def test_compact_records_raw(record):
+    """Test records not fitting fields are kept as they are"""
+    records = CompactRecords((("latest_id", "key"), ("statement_id", "uuid"), ("reason", "value")))
+    records["A"] = record
+    assert records["A"] == record
+    records["A"] = {"latest_id": "A", "statement_id": "6ba7b810-9dad-11d1-80b4-00c04fd430c8", "reason": False}
+    assert not records.raw
+    assert records["A"]["statement_id"] == "6ba7b810-9dad-11d1-80b4-00c04fd430c8"
+
+
+def test_compact_records_delete_reuses_slot():
+    """Test deleted slots are reused and cleared"""
+    records = CompactRecords((("latest_id", "key"), ("statement_id", "uuid"), ("reason", "value")))
+    for i in range(3):
+        records[str(i)] = {"latest_id": str(i), "statement_id": None, "reason": "r"}
+    del records["1"]
+    assert "1" not in records and len(records) == 2
+    assert records.pop("1", None) is None
+    records["3"] = {"latest_id": "3", "statement_id": generate_statement_id("e", "entityStatement"), "reason": None}
+    assert len(records.packed) == 3 * 16
+    assert records["3"]["statement_id"] == generate_statement_id("e", "entityStatement")
+    assert records["0"]["statement_id"] is None
+    assert sorted(records) == ["0", "2", "3"]
+
+
+def test_disk_records_match_dict(tmp_path):
+    """Test disk store (with small memory front and batches) behaves as dict"""
+    records = DiskCache(tmp_path, lru_size=5, batch_size=7).records()["latest"]
+    expected = {}
+    rng = random.Random(1)
+    for step in range(2000):
+        item_id = str(rng.randrange(50))
+        action = rng.random()
+        if action < 0.5:
+            record = {"latest_id": item_id, "statement_id": generate_statement_id(str(step), "entityStatement"),
+                      "reason": step % 3 == 0}
+            records[item_id] = expected[item_id] = record
+        elif action < 0.7:
+            assert records.pop(item_id, None) == expected.pop(item_id, None)
+        else:
+            assert records.get(item_id) == expected.get(item_id)
+            assert (item_id in records) == (item_id in expected)
+        assert len(records) == len(expected)
+    assert dict(records.items()) == expected
+    assert sorted(records) == sorted(expected)
+    assert not list(tmp_path.iterdir())
+
+
+def test_caching_disk(tmp_path):
+    """Test cache using disk stores"""
+    storage = Storage(storage=MemoryClient(bods_index_properties))
+    cache = Caching(storage, batching=-1, disk=DiskCache(tmp_path, lru_size=1))
+    lei = "029200067A7K6CH0H586"
+
+    async def run():
+        await cache.load()
+        await latest_save(cache, lei, generate_statement_id(lei, "entityStatement"))
+        await latest_save(cache, "5493001Z012YSB2A0K51", generate_statement_id("x", "entityStatement"))
+        latest = await cache.get(lei, "latest")
+        return latest, await cache.flush()
+
+    latest, count = asyncio.run(run())
+    assert latest["statement_id"] == generate_statement_id(lei, "entityStatement")
+    assert count == 2
+    assert len(storage.storage.index("latest")) == 2
+    with pytest.raises(ValueError):
+        Caching(storage, snapshot=CacheSnapshot(tmp_path / "cache.snapshot", "transform"), disk=DiskCache(tmp_path))
+
+
+def test_caching_lazy():
+    """Test lazy cache reads items from storage in batches when needed, remembering ids not found"""
+    fetched = []
+
+    class FetchCounting(MemoryClient):
+        """Client recording ids read"""
+        async def mget(self, index_name, ids):
+            fetched.append((index_name, sorted(ids)))
+            return await super().mget(index_name, ids)
+
+    storage = Storage(storage=FetchCounting(bods_index_properties))
+    start, end = "029200067A7K6CH0H586", "5493001Z012YSB2A0K51"
+    start_id, ooc_id = generate_statement_id(start, "entityStatement"), generate_statement_id("r", "ownershipOrControlStatement")
+    relationship = f"{start}_{end}_IS_DIRECTLY_CONSOLIDATED_BY"
+    storage.storage.index("latest")[start] = {"latest_id": start, "statement_id": start_id, "reason": False}
+    storage.storage.index("references")[start_id] = {"statement_id": start_id,
+                                                     "references_id": [{"statement_id": ooc_id,
+                                                                        "latest_id": relationship}]}
+    item = {"Relationship": {"StartNode": {"NodeID": start}, "EndNode": {"NodeID": end},
+                             "RelationshipType": "IS_DIRECTLY_CONSOLIDATED_BY"}}
+    cache = Caching(storage, batching=-1, lazy=True)
+
+    async def run():
+        await cache.load()
+        await prefetch_items(cache, [item, {"LEI": end}])
+        prefetched = list(fetched)
+        lookups = [await latest_lookup(cache, start), await latest_lookup(cache, end),
+                   await lookup_references(cache, start_id)]
+        await latest_save(cache, end, generate_statement_id(end, "entityStatement"))
+        saved = await latest_lookup(cache, end)
+        return prefetched, lookups, saved
+
+    prefetched, lookups, saved = asyncio.run(run())
+    assert prefetched == [("latest", sorted([start, end, relationship])),
+                          ("exceptions", [f"{start}_DIRECT_ACCOUNTING_CONSOLIDATION_PARENT"]),
+                          ("references", [start_id])]
+    assert fetched == prefetched
+    assert lookups == [(start_id, False), (None, None), {ooc_id: relationship}]
+    assert saved == (generate_statement_id(end, "entityStatement"), False)
+    assert len(cache.cache["latest"]) == 2
+
+
+def test_cache_snapshot(tmp_path):
+    """Test cache loaded from snapshot only when stamped for last run and matching storage"""
+    storage = Storage(storage=MemoryClient(indexes=bods_index_properties))
+    snapshot = CacheSnapshot(tmp_path / "cache.snapshot", "transform")
+    scanned = []
+
+    class ScanCounting(Storage):
+        """Storage recording scans of cached indexes"""
+        async def stream_items(self, index):
+            if index != "runs": scanned.append(index)
+            async for item in super().stream_items(index):
+                yield item
+
+    async def run(end_timestamp, lei):
+        cache = Caching(ScanCounting(storage=storage.storage), batching=-1, snapshot=snapshot)
+        await cache.load()
+        contents = {item_type: dict(cache.cache[item_type]) for item_type in ("latest", "references")}
+        await latest_save(cache, lei, generate_statement_id(lei, "entityStatement"))
+        await references_save(cache, generate_statement_id(lei, "entityStatement"),
+                              {generate_statement_id(lei, "ownershipOrControlStatement"): f"{lei}_X_IS_DIRECTLY_CONSOLIDATED_BY"})
+        await cache.flush()
+        if end_timestamp:
+            await save_run(storage, {'stage_name': 'transform', 'start_timestamp': "0",
+                                     'end_timestamp': end_timestamp})
+            snapshot.stamp(end_timestamp)
+        return contents
+
+    asyncio.run(run(1.5, "A"))
+    assert snapshot.details()["state"] == "stamped"
+    scanned.clear()
+    contents = asyncio.run(run(2.5, "B"))
+    assert not scanned
+    assert set(contents["latest"]) == {"A"}
+    assert list(contents["references"].values())[0]["references_id"][0]["latest_id"] == "A_X_IS_DIRECTLY_CONSOLIDATED_BY"
+    # Run not saved, so snapshot not stamped
+    contents = asyncio.run(run(None, "C"))
+    assert not scanned
+    assert set(contents["latest"]) == {"A", "B"}
+    assert snapshot.details()["state"] == "written"
+    contents = asyncio.run(run(None, "D"))
+    assert scanned
+    assert set(contents["latest"]) == {"A", "B", "C"}
+    # Storage changed since snapshot
+    asyncio.run(run(3.5, "E"))
+    storage.storage.data["latest"].pop("A")
+    scanned.clear()
+    contents = asyncio.run(run(None, "F"))
+    assert scanned
+    assert set(contents["latest"]) == {"B", "C", "D", "E"}
@@ -140,3 +140,73 @@ async def test_lei_bulk_storage_existing(lei_list, last_update_list, json_data):
         async for result in storage.process_batch(json_stream(), 'lei'):
             count += 1
         assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_sliced_scan():
+    """Test index scanned as concurrent sliced scrolls"""
+    with (patch('bodspipelines.infrastructure.clients.elasticsearch_client.AsyncElasticsearch') as mock_es,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_scan') as mock_as):
+        active = []
+        overlap = []
+        async def scan(client=None, query=None, index=None):
+            slice_id = query["slice"]["id"]
+            active.append(slice_id)
+            for i in range(1200):
+                await asyncio.sleep(0)
+                overlap.append(len(active))
+                yield {"_id": f"{slice_id}-{i}", "_source": {"slice": slice_id}}
+            active.remove(slice_id)
+        mock_as.side_effect = scan
+        set_environment_variables()
+        storage = Storage(storage=ElasticsearchClient(indexes=index_properties))
+        await storage.setup()
+        items = [item async for item in storage.stream_items("lei", slices=3)]
+        assert len(items) == 3600
+        assert sorted({item["slice"] for item in items}) == [0, 1, 2]
+        assert [call.kwargs["query"]["slice"]["max"] for call in mock_as.call_args_list] == [3, 3, 3]
+        assert max(overlap) == 3
+
+
+@pytest.mark.asyncio
+async def test_sliced_scan_stopped():
+    """Test slice scrolls finished when sliced scan stops early"""
+    with (patch('bodspipelines.infrastructure.clients.elasticsearch_client.AsyncElasticsearch') as mock_es,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_scan') as mock_as):
+        async def scan(client=None, query=None, index=None):
+            for i in range(100000):
+                await asyncio.sleep(0)
+                yield {"_id": i, "_source": {"id": i}}
+        mock_as.side_effect = scan
+        set_environment_variables()
+        client = ElasticsearchClient(indexes=index_properties)
+        await client.setup()
+        scan_tasks = lambda: [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        docs = client.scan_index("lei", slices=4)
+        for _ in range(5000):
+            await docs.__anext__()
+        await docs.aclose()
+        assert scan_tasks() == []
+
+
+@pytest.mark.asyncio
+async def test_sliced_scan_slice_fails():
+    """Test sliced scan raises as soon as a slice fails, without scanning rest of index"""
+    with (patch('bodspipelines.infrastructure.clients.elasticsearch_client.AsyncElasticsearch') as mock_es,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_scan') as mock_as):
+        async def scan(client=None, query=None, index=None):
+            for i in range(100000):
+                await asyncio.sleep(0)
+                if query["slice"]["id"] == 1 and i == 3000:
+                    raise RuntimeError("scroll failed")
+                yield {"_id": i, "_source": {"id": i}}
+        mock_as.side_effect = scan
+        set_environment_variables()
+        client = ElasticsearchClient(indexes=index_properties)
+        await client.setup()
+        scanned = 0
+        with pytest.raises(RuntimeError, match="scroll failed"):
+            async for doc in client.scan_index("rr", slices=4):
+                scanned += 1
+        assert scanned < 20000
+        assert [task for task in asyncio.all_tasks() if task is not asyncio.current_task()] == []
@@ -0,0 +1,39 @@
+import json
+import logging
+
+from bodspipelines.infrastructure.log import get_logger, Progress, StructuredFormatter, JSONFormatter
+
+
+def test_progress_every_items(caplog):
+    """Test progress summary logged every so many items, and when done"""
+    logger = get_logger("test")
+    progress = Progress(logger, "source/test", every=2500, interval=3600)
+    with caplog.at_level(logging.INFO, logger="bodspipelines"):
+        for _ in range(6000):
+            progress.update()
+        progress.done()
+    assert [record.message for record in caplog.records] == ["progress", "progress", "finished"]
+    assert [record.items for record in caplog.records] == [2500, 5000, 6000]
+    assert caplog.records[0].component == "source/test"
+
+
+def test_progress_interval(caplog):
+    """Test progress summary logged after interval"""
+    logger = get_logger("test")
+    progress = Progress(logger, "source/test", every=10**9, interval=0)
+    with caplog.at_level(logging.INFO, logger="bodspipelines"):
+        for _ in range(2500):
+            progress.update()
+    assert [record.items for record in caplog.records] == [1000, 2000]
+
+
+def test_formatters():
+    """Test log records formatted with extra fields"""
+    record = logging.makeLogRecord({"name": "bodspipelines.test", "levelname": "INFO", "msg": "stored batch",
+                                    "index": "lei", "records": 10})
+    line = StructuredFormatter().format(record)
+    assert 'message="stored batch"' in line
+    assert line.endswith("index=lei records=10")
+    fields = json.loads(JSONFormatter().format(record))
+    assert fields["message"] == "stored batch"
+    assert fields["records"] == 10
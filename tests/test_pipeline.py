@@ -4,7 +4,7 @@ import time
 import datetime
 from pathlib import Path
 import json
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, AsyncMock
 import asyncio
 import pytest
 
@@ -607,3 +607,490 @@ def test_rr_transform_stage(repex_json_data_file, ooc_json_data_file):
         assert validate_date_now(item['annotations'][0]['creationDate'])
         assert item['annotations'][0]['createdBy'] == {'name': 'Open Ownership',
                                                        'uri': 'https://www.openownership.org'}
+
+
+class CollectOutput:
+    """Output collecting items written by NewOutput"""
+    def __init__(self):
+        self.items = []
+        self.item_types = []
+        self.flushed = []
+        self.finished = 0
+    async def process(self, item, item_type):
+        self.items.append(item)
+        self.item_types.append(item_type)
+    async def flush(self):
+        self.flushed.append(len(self.items))
+    async def finish(self):
+        self.finished += 1
+
+
+class CollectStageOutput:
+    """Stage output collecting items (not streaming, so not stored)"""
+    streaming = False
+    def __init__(self):
+        self.items = []
+    def process(self, item, item_type):
+        self.items.append(item)
+
+
+class ListOrigin:
+    """Origin yielding numbered items"""
+    def __init__(self, count):
+        self.count = count
+    async def process(self):
+        for i in range(self.count):
+            yield {"id": str(i)}
+
+
+class PassThrough:
+    """Datatype with no header"""
+    def process(self, item):
+        return None, item
+
+
+class RecordingClient:
+    """Storage client recording stored items (readable once refreshed)"""
+    def __init__(self, index_names):
+        self.indexes = {name: {"id": lambda item: item["id"]} for name in index_names}
+        self.stored = []
+        self.readable = []
+        self.refreshed = []
+    async def batch_store_data(self, actions, batch, index_name):
+        for action in batch:
+            self.stored.append(action["_id"])
+            yield action["_source"]
+    async def refresh(self, index_name=None):
+        self.readable = list(self.stored)
+        self.refreshed.append(index_name)
+
+
+def streaming_bulk(client=None, actions=None, raise_on_error=True):
+    """Elasticsearch streaming bulk helper reporting every action succeeded"""
+    async def result():
+        if hasattr(actions, '__aiter__'):
+            action_list = [action async for action in actions]
+        else:
+            action_list = actions
+        for action in action_list:
+            yield True, {action['_op_type']: {'_id': action['_id']}}
+    return result()
+
+
+def repex_test_source():
+    """Reporting exceptions source reading test data"""
+    return Source(name="repex",
+                  origin=BulkData(display="Reporting Exceptions v2.1",
+                                  data=GLEIFData(url="https://goldencopy.gleif.org/api/v2/golden-copies/publishes/repex/latest"),
+                                  size=3954,
+                                  directory="rep-ex"),
+                  datatype=XMLData(item_tag="Exception",
+                                   header_tag="Header",
+                                   namespace={"repex": "http://www.gleif.org/data/schema/repex/2016"},
+                                   filter=['NextVersion', ]))
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 1000])
+def test_repex_ingest_stage_batches(batch_size):
+    """Test ingest pipeline stage processing items in batches"""
+    from bodspipelines.pipelines.gleif.transforms import AddContentDate, RemoveEmptyExtension
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    with (patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd,
+          patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_streaming_bulk',
+                side_effect=streaming_bulk)):
+        mock_bd.return_value = [Path("tests/fixtures/repex-data.xml")]
+        mock_sdr.return_value = None
+        repex_source = repex_test_source()
+        collect = CollectOutput()
+        es_client = ElasticsearchClient(indexes=index_properties)
+        es_client.client = AsyncMock()
+        output_new = NewOutput(storage=Storage(storage=es_client),
+                               output=collect)
+        stage = Stage(name="ingest-test",
+                      sources=[repex_source],
+                      processors=[AddContentDate(identify=identify_gleif),
+                                  RemoveEmptyExtension(identify=identify_gleif)],
+                      outputs=[output_new],
+                      batch_size=batch_size)
+        asyncio.run(stage.process(None))
+        assert len(collect.items) == 10
+        assert collect.finished == 1
+        es_client.client.indices.refresh.assert_awaited_once_with(index="repex")
+        assert all(item['ContentDate'] == '2023-06-09T09:03:29Z' for item in collect.items)
+        assert collect.items[0]['LEI'] == '001GPB6A9XPE8XJICC14'
+
+
+@pytest.mark.parametrize("batch_size, queue_size", [(None, 1), (None, 100), (4, 1), (1000, [2, 3, 4])])
+def test_repex_ingest_pipelined_stage(batch_size, queue_size):
+    """Test pipelined ingest stage processing items through queues"""
+    from bodspipelines.infrastructure.pipeline import PipelinedStage
+    from bodspipelines.pipelines.gleif.transforms import AddContentDate, RemoveEmptyExtension
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    with (patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd,
+          patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_streaming_bulk',
+                side_effect=streaming_bulk)):
+        mock_bd.return_value = [Path("tests/fixtures/repex-data.xml")]
+        mock_sdr.return_value = None
+        repex_source = repex_test_source()
+        collect = CollectOutput()
+        es_client = ElasticsearchClient(indexes=index_properties)
+        es_client.client = AsyncMock()
+        output_new = NewOutput(storage=Storage(storage=es_client),
+                               output=collect)
+        stage = PipelinedStage(name="ingest-test",
+                               sources=[repex_source],
+                               processors=[AddContentDate(identify=identify_gleif),
+                                           RemoveEmptyExtension(identify=identify_gleif)],
+                               outputs=[output_new],
+                               batch_size=batch_size,
+                               queue_size=queue_size)
+        asyncio.run(stage.process(None))
+        assert len(collect.items) == 10
+        assert len({id_repex(item) for item in collect.items}) == 10
+        assert collect.finished == 1
+        es_client.client.indices.refresh.assert_awaited_once_with(index="repex")
+        assert all(item['ContentDate'] == '2023-06-09T09:03:29Z' for item in collect.items)
+        assert collect.items[0]['LEI'] == '001GPB6A9XPE8XJICC14'
+
+
+@pytest.mark.parametrize("pipelined, batch_size", [(False, None), (False, 4), (True, None), (True, 4)])
+def test_repex_ingest_stage_checkpoint(pipelined, batch_size, tmp_path):
+    """Test source checkpoints are only saved once output has flushed earlier items"""
+    from bodspipelines.infrastructure.pipeline import PipelinedStage
+    from bodspipelines.infrastructure.processing import xml_data
+    from bodspipelines.pipelines.gleif.transforms import AddContentDate, RemoveEmptyExtension
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    collect = CollectOutput()
+    saved = []
+    save_checkpoint = xml_data.save_checkpoint
+    def record_checkpoint(path, details, offset, count):
+        saved.append((count, collect.flushed[-1] if collect.flushed else 0))
+        save_checkpoint(path, details, offset, count)
+
+    with (patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd,
+          patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr,
+          patch('bodspipelines.infrastructure.processing.xml_data.save_checkpoint',
+                side_effect=record_checkpoint),
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_streaming_bulk',
+                side_effect=streaming_bulk)):
+        mock_bd.return_value = [Path("tests/fixtures/repex-data.xml")]
+        mock_sdr.return_value = tmp_path
+        repex_source = repex_test_source()
+        repex_source.datatype.checkpoint = True
+        repex_source.datatype.checkpoint_interval = 3
+        es_client = ElasticsearchClient(indexes=index_properties)
+        es_client.client = AsyncMock()
+        output_new = NewOutput(storage=Storage(storage=es_client),
+                               output=collect)
+        # Small queues so pipelined source does not read whole file before output flushes
+        options = {"queue_size": 1} if pipelined else {}
+        stage = (PipelinedStage if pipelined else Stage)(name="ingest-test",
+                                                         sources=[repex_source],
+                                                         processors=[AddContentDate(identify=identify_gleif),
+                                                                     RemoveEmptyExtension(identify=identify_gleif)],
+                                                         outputs=[output_new],
+                                                         batch_size=batch_size,
+                                                         **options)
+        asyncio.run(stage.process(None))
+        assert len(collect.items) == 10
+        assert len({id_repex(item) for item in collect.items}) == 10
+        assert collect.flushed[:3] == [3, 6, 9]
+        assert saved and all(count <= flushed for count, flushed in saved)
+        assert not list(tmp_path.glob("*.checkpoint"))
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_lei_transform_stage_workers(workers, xml_data_file):
+    """Test CPU-bound processor gives same output in worker processes"""
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    with patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd:
+        mock_bd.return_value = [xml_data_file]
+        lei_source = Source(name="lei",
+                            origin=BulkData(display="LEI-CDF v3.1",
+                                            data=GLEIFData(url="https://goldencopy.gleif.org/api/v2/golden-copies/publishes/lei2/latest"),
+                                            size=41491,
+                                            directory="lei-cdf"),
+                            datatype=XMLData(item_tag="LEIRecord",
+                                             namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                                             filter=['NextVersion', 'Extension']))
+        collect = CollectStageOutput()
+        stage = Stage(name="transform-test",
+                      sources=[lei_source],
+                      processors=[Gleif2Bods(identify=identify_gleif)],
+                      outputs=[collect],
+                      batch_size=5,
+                      workers=workers)
+        async def run():
+            await stage.setup()
+            await stage.process_source(lei_source, None)
+            await stage.close()
+        asyncio.run(run())
+        async def items():
+            return [item async for header, item in lei_source.datatype.process(xml_data_file)]
+        expected = [generate_statement_id(entity_id(item), 'entityStatement') for item in asyncio.run(items())]
+        assert len(collect.items) == 13
+        assert [item['statementID'] for item in collect.items] == expected
+        assert collect.items[0]['name'] == 'Fidelity Advisor Leveraged Company Stock Fund'
+        assert collect.items[-1]['name'] == 'Swedeit Italian Aktiebolag'
+
+
+@pytest.mark.parametrize("batch_size", [None, 3])
+def test_stage_flush_barrier(batch_size):
+    """Test updates only finish once output has stored all earlier items"""
+
+    class Finisher:
+        """Processor recording readable items when updates are finished"""
+        def __init__(self, client):
+            self.client = client
+            self.seen = None
+        async def process(self, item, item_type, header, updates=False):
+            yield item
+        async def process_batch(self, items, item_type, header, updates=False):
+            return items
+        async def finish_updates(self, updates=False):
+            self.seen = list(self.client.readable)
+            yield {"id": "update"}
+
+    client = RecordingClient(("test",))
+    finisher = Finisher(client)
+    collect = CollectOutput()
+    stage = Stage(name="flush-test",
+                  sources=[Source(name="test", origin=ListOrigin(10), datatype=PassThrough())],
+                  processors=[finisher],
+                  outputs=[NewOutput(storage=Storage(storage=client), output=collect)],
+                  batch_size=batch_size)
+    start = time.perf_counter()
+    asyncio.run(stage.process_source(stage.sources[0], None, updates=True))
+    assert time.perf_counter() - start < 1
+    assert finisher.seen == [str(i) for i in range(10)]
+    assert collect.flushed == [10]
+    assert client.stored == [str(i) for i in range(10)] + ["update"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_stage_concurrent_sources(concurrency):
+    """Test sources processed concurrently keep output in source order"""
+
+    class SlowOrigin:
+        """Origin yielding items with delay"""
+        def __init__(self, name, count, delay):
+            self.name = name
+            self.count = count
+            self.delay = delay
+        async def process(self):
+            for i in range(self.count):
+                await asyncio.sleep(self.delay)
+                yield {"id": f"{self.name}-{i}"}
+
+    client = RecordingClient(("a", "b", "c"))
+    collect = CollectOutput()
+    sources = [Source(name=name, origin=SlowOrigin(name, count, 0.01), datatype=PassThrough())
+               for name, count in (("a", 20), ("b", 10), ("c", 5))]
+    stage = Stage(name="concurrent-test",
+                  sources=sources,
+                  processors=[],
+                  outputs=[NewOutput(storage=Storage(storage=client), output=collect)],
+                  concurrency=concurrency)
+    with patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr:
+        mock_sdr.return_value = None
+        start = time.perf_counter()
+        asyncio.run(stage.process(None))
+        elapsed = time.perf_counter() - start
+    expected = [(name, f"{name}-{i}") for name, count in (("a", 20), ("b", 10), ("c", 5)) for i in range(count)]
+    assert list(zip(collect.item_types, [item["id"] for item in collect.items])) == expected
+    assert sorted(client.stored) == sorted(item_id for _, item_id in expected)
+    assert collect.finished == 3
+    if concurrency == 3:
+        # Less than sum of source times (0.35s)
+        assert elapsed < 0.35
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_flush_refreshes_written_indexes(batched):
+    """Test flush with items identified by type only refreshes indexes written since last flush"""
+    from bodspipelines.infrastructure.utils import flush_marker
+
+    async def run():
+        client = RecordingClient(("a", "b", "c"))
+        output = NewOutput(storage=Storage(storage=client), output=CollectOutput(),
+                           identify=lambda item: item["type"])
+        items = [{"id": "1", "type": "a"}, {"id": "2", "type": "c"}]
+        markers = [flush_marker(), flush_marker()]
+        async def stream():
+            if batched:
+                yield items
+            else:
+                for item in items: yield item
+            for marker in markers: yield marker
+        if batched:
+            await output.process_batch_stream(stream(), "test")
+        else:
+            await output.process_stream(stream(), "test")
+        return client.refreshed, markers
+
+    refreshed, markers = asyncio.run(run())
+    assert refreshed == ["a,c"]
+    assert all(marker["done"].done() for marker in markers)
+
+
+def test_lane_flush_held_until_release():
+    """Test flush through unreleased lane is only acknowledged once spooled items are written"""
+    from bodspipelines.infrastructure.utils import flush_marker
+
+    async def run():
+        client = RecordingClient(("test",))
+        collect = CollectOutput()
+        lane = NewOutput(storage=Storage(storage=client), output=collect).lane()
+        marker = flush_marker()
+        async def stream():
+            for i in range(5):
+                yield {"id": str(i)}
+            yield marker
+        await lane.process_stream(stream(), "test")
+        held = (marker["done"].done(), list(collect.items), list(collect.flushed))
+        await lane.release()
+        return held, marker, collect
+
+    held, marker, collect = asyncio.run(run())
+    assert held == (False, [], [])
+    assert marker["done"].done() and marker["deferred"]
+    assert [item["id"] for item in collect.items] == [str(i) for i in range(5)]
+    assert collect.flushed == [5]
+    assert collect.finished == 1
+
+
+def test_fused_ingest_transform_stages():
+    """Test ingest and transform stages run in one process connected by in-memory channel"""
+    from bodspipelines.pipelines.gleif.transforms import AddContentDate, RemoveEmptyExtension
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    with (patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd,
+          patch('bodspipelines.infrastructure.pipeline.Pipeline.directory') as mock_pdr,
+          patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.ElasticsearchClient.setup'),
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_streaming_bulk',
+                side_effect=streaming_bulk)):
+        mock_bd.return_value = [Path("tests/fixtures/repex-data.xml")]
+        mock_pdr.return_value = None
+        mock_sdr.return_value = None
+        repex_source = repex_test_source()
+        es_client = ElasticsearchClient(indexes=index_properties)
+        es_client.client = AsyncMock()
+        kinesis_output = KinesisOutput(stream_name="gleif-test")
+        output_new = NewOutput(storage=Storage(storage=es_client), output=kinesis_output)
+        ingest_stage = Stage(name="ingest",
+                             sources=[repex_source],
+                             processors=[AddContentDate(identify=identify_gleif),
+                                         RemoveEmptyExtension(identify=identify_gleif)],
+                             outputs=[output_new])
+        kinesis_input = KinesisInput(stream_name="gleif-test")
+        gleif_source = Source(name="gleif", origin=kinesis_input, datatype=JSONData())
+        collect = CollectStageOutput()
+        transform_stage = Stage(name="transform",
+                                sources=[gleif_source],
+                                processors=[Gleif2Bods(identify=identify_gleif)],
+                                outputs=[collect])
+        pipeline = Pipeline(name="gleif", stages=[ingest_stage, transform_stage])
+        pipeline.process_fused(["ingest", "transform"])
+        assert len(collect.items) > 10
+        assert all(item["statementType"] in ("entityStatement", "personStatement", "ownershipOrControlStatement")
+                   for item in collect.items)
+        assert output_new.output is kinesis_output
+        assert gleif_source.origin is kinesis_input
+
+
+def test_pipeline_metrics(tmp_path):
+    """Test pipeline exports metrics for stage components"""
+    from bodspipelines.infrastructure.metrics import metrics
+    from bodspipelines.pipelines.gleif.transforms import AddContentDate, RemoveEmptyExtension
+    from bodspipelines.pipelines.gleif.utils import identify_gleif
+
+    with (patch('bodspipelines.infrastructure.processing.bulk_data.BulkData.prepare') as mock_bd,
+          patch('bodspipelines.infrastructure.pipeline.Pipeline.directory') as mock_pdr,
+          patch('bodspipelines.infrastructure.pipeline.Stage.directory') as mock_sdr,
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.ElasticsearchClient.setup'),
+          patch('bodspipelines.infrastructure.clients.elasticsearch_client.async_streaming_bulk',
+                side_effect=streaming_bulk)):
+        mock_bd.return_value = [Path("tests/fixtures/repex-data.xml")]
+        mock_pdr.return_value = None
+        mock_sdr.return_value = None
+        repex_source = repex_test_source()
+        es_client = ElasticsearchClient(indexes=index_properties)
+        es_client.client = AsyncMock()
+        stage = Stage(name="ingest",
+                      sources=[repex_source],
+                      processors=[AddContentDate(identify=identify_gleif),
+                                  RemoveEmptyExtension(identify=identify_gleif)],
+                      outputs=[NewOutput(storage=Storage(storage=es_client), output=CollectOutput())],
+                      batch_size=4)
+        pipeline = Pipeline(name="gleif", stages=[stage], metrics_dir=tmp_path)
+        pipeline.process("ingest")
+    summary = json.loads((tmp_path / "gleif-ingest-summary.json").read_text())
+    components = summary["components"]
+    assert components["source/repex"]["items_total"] == 10
+    assert components["processor/AddContentDate"]["items_total"] == 10
+    assert components["processor/AddContentDate"]["latency_seconds"]["count"] == 3
+    assert components["storage/repex"]["new_items_total"] == 10
+    assert components["storage/repex"]["batch_size"]["count"] == 3
+    assert components["stage/ingest"]["items_total"] == 10
+    prometheus = (tmp_path / "gleif-ingest.prom").read_text()
+    assert 'bods_items_total{component="source/repex"} 10' in prometheus
+    assert 'bods_latency_seconds_bucket{component="storage/repex",le="+Inf"} 3' in prometheus
+
+
+@pytest.mark.parametrize("profile", ["sample", "cprofile"])
+def test_pipeline_profile(tmp_path, profile):
+    """Test profiling stage writes results to stage directory"""
+
+    class SlowProcessor:
+        """Processor waiting on I/O for each item"""
+        async def process(self, item, item_type, header, updates=False):
+            await asyncio.sleep(0.01)
+            yield item
+
+    collect = CollectStageOutput()
+    stage = Stage(name="profile-test",
+                  sources=[Source(name="test", origin=ListOrigin(20), datatype=PassThrough())],
+                  processors=[SlowProcessor()],
+                  outputs=[collect])
+    pipeline = Pipeline(name="test", stages=[stage])
+    with patch('bodspipelines.infrastructure.pipeline.Pipeline.directory') as mock_pdr:
+        mock_pdr.return_value = tmp_path
+        pipeline.process("profile-test", profile=profile)
+    assert len(collect.items) == 20
+    assert (tmp_path / "profile-test" / "profile-profile-test.txt").exists()
+    if profile == "sample":
+        collapsed = (tmp_path / "profile-test" / "profile-profile-test.collapsed").read_text()
+        waiting = [line for line in collapsed.splitlines() if "SlowProcessor.process" in line]
+        assert waiting and all(line.startswith("await;") for line in waiting)
+    else:
+        assert (tmp_path / "profile-test" / "profile-profile-test.pstats").exists()
+
+
+def test_sampling_profiler_inspects_tasks_on_loop():
+    """Test sampling profiler only inspects tasks on event loop thread"""
+    import threading
+    from bodspipelines.infrastructure.profiling import SamplingProfiler
+    threads = []
+    all_tasks = asyncio.all_tasks
+    def record_thread(loop=None):
+        threads.append(threading.get_ident())
+        return all_tasks(loop)
+    async def wait():
+        await asyncio.sleep(0.1)
+    async def run():
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        await asyncio.create_task(wait())
+        profiler.stop()
+        return profiler
+    with patch("bodspipelines.infrastructure.profiling.asyncio.all_tasks", side_effect=record_thread):
+        profiler = asyncio.run(run())
+    assert threads and set(threads) == {threading.get_ident()}
+    assert any(stack.startswith("await;") and stack.endswith(".wait;tasks.py:sleep") for stack in profiler.samples)
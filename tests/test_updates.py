@@ -682,3 +682,98 @@ def test_transform_stage_updates(updates_json_data_file, rr_json_data_file_store
                     cycle = 0
                     count += 1
             if i == 9: ent_offset += 2
+
+
+class DirectoryStorage:
+    """Storage keeping items as JSON files, shared between processes"""
+    def __init__(self, path):
+        self.path = path
+        self.storage = Mock(indexes=bods_index_properties)
+
+    async def setup(self):
+        pass
+
+    def item_path(self, item_id, item_type):
+        return self.path / item_type / f"{item_id}.json"
+
+    def add(self, item, item_type):
+        path = self.item_path(bods_index_properties[item_type]["id"](item), item_type)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(item))
+
+    async def get_item(self, item_id, item_type):
+        path = self.item_path(item_id, item_type)
+        return json.loads(path.read_text()) if path.exists() else None
+
+    async def stream_items(self, item_type):
+        for path in sorted((self.path / item_type).glob("*.json")):
+            yield json.loads(path.read_text())
+
+    async def dump_stream(self, item_type, action_type, items):
+        async for item in items:
+            if action_type == 'delete':
+                self.item_path(bods_index_properties[item_type]["id"](item), item_type).unlink(missing_ok=True)
+            else:
+                self.add(item, item_type)
+
+    async def flush(self, index_name=None):
+        pass
+
+
+def run_updates(processor, storage, items):
+    """Process items with updates, storing output statements"""
+    async def run():
+        await processor.setup()
+        out = await processor.process_batch(items, "gleif", None, updates=True)
+        for statement in out:
+            storage.add(statement, identify_bods(statement))
+        finished = [statement async for statement in processor.finish_updates(updates=True)]
+        for statement in finished:
+            storage.add(statement, identify_bods(statement))
+        if hasattr(processor, "close"):
+            await processor.close()
+        return out, finished
+    return asyncio.run(run())
+
+
+def test_partitioned_updates(tmp_path, updates_json_data_file):
+    """Test partitioned updates give same statements and state as single process"""
+    from bodspipelines.infrastructure.partitions import PartitionedUpdates
+    first_items = []
+    for name in ("lei-updates-data2", "rr-updates-data2", "repex-updates-data2"):
+        with open(f"tests/fixtures/{name}.json", "r") as data_file:
+            first_items.extend(json.load(data_file))
+    results = {}
+    for name, processor_class, kwargs in (("serial", ProcessUpdates, {}),
+                                          ("partitioned", PartitionedUpdates, {"partitions": 3})):
+        storage = DirectoryStorage(tmp_path / name)
+        results[name] = []
+        for items in (first_items, updates_json_data_file):
+            processor = processor_class(id_name='XI-LEI',
+                                        transform=Gleif2Bods(identify=identify_gleif),
+                                        storage=storage,
+                                        updates=GleifUpdates(),
+                                        **kwargs)
+            out, finished = run_updates(processor, storage, items)
+            results[name].append((out, sorted(finished, key=lambda statement: statement["statementID"])))
+    assert results["partitioned"] == results["serial"]
+    assert len(results["serial"][1][0]) > 0 and len(results["serial"][1][1]) > 0
+    for item_type in ("latest", "references", "exceptions"):
+        assert ({path.name: path.read_text() for path in (tmp_path / "serial" / item_type).glob("*.json")} ==
+                {path.name: path.read_text() for path in (tmp_path / "partitioned" / item_type).glob("*.json")})
+
+
+def test_partitioned_updates_config_batched(monkeypatch):
+    """Test GLEIF transform stage is batched when partitioned, even without batch size set"""
+    import importlib
+    from bodspipelines.pipelines.gleif import config
+    monkeypatch.delenv('GLEIF_BATCH_SIZE', raising=False)
+    monkeypatch.setenv('GLEIF_TRANSFORM_PARTITIONS', '2')
+    try:
+        importlib.reload(config)
+        assert config.ingest_stage.batch_size is None
+        assert config.transform_stage.batch_size == 1000
+        assert config.transform_stage.batched(config.transform_stage.sources[0])
+    finally:
+        monkeypatch.undo()
+        importlib.reload(config)
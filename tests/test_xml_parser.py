@@ -8,8 +8,10 @@ import json
 from unittest.mock import patch, Mock
 import asyncio
 import pytest
+from contextlib import aclosing
 
 from bodspipelines.infrastructure.processing.xml_data import XMLData
+from bodspipelines.infrastructure.utils import is_flush, acknowledge_flush
 
 def validate_datetime(d):
     """Test is valid datetime"""
@@ -198,3 +200,210 @@ async def test_repex_xml_parser(repex_xml_data_file):
             assert item['ExceptionReason'] == 'NO_KNOWN_PERSON'
         count += 1
     assert count == 10
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("xml_file, item_tag, header_tag, namespace", [
+    ("tests/fixtures/lei-data.xml", "LEIRecord", None, {"lei": "http://www.gleif.org/data/schema/leidata/2016",
+                                  "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"}),
+    ("tests/fixtures/rr-data.xml", "RelationshipRecord", None, {"rr": "http://www.gleif.org/data/schema/rr/2016"}),
+    ("tests/fixtures/repex-data.xml", "Exception", "Header", {"repex": "http://www.gleif.org/data/schema/repex/2016"}),
+    ("tests/fixtures/rr-updates-data2.xml", "RelationshipRecord", None, {"rr": "http://www.gleif.org/data/schema/rr/2016",
+                                  "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"}),
+    ])
+async def test_xml_parser_engines(xml_file, item_tag, header_tag, namespace):
+    """Test lxml parser engine produces same items as etree engine"""
+    items = {}
+    for engine in ("etree", "lxml"):
+        xml_parser = XMLData(item_tag=item_tag,
+                             header_tag=header_tag,
+                             namespace=namespace,
+                             filter=['NextVersion'],
+                             engine=engine)
+        items[engine] = [(header, item) async for header, item in xml_parser.process(Path(xml_file))]
+    assert len(items["lxml"]) > 0
+    assert items["lxml"] == items["etree"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine, ordered", [("etree", True), ("lxml", True), ("lxml", False)])
+async def test_xml_parser_sharded(lei_xml_data_file, engine, ordered):
+    """Test sharded parsing across worker processes matches sequential parsing"""
+    namespace = {"lei": "http://www.gleif.org/data/schema/leidata/2016",
+                 "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"}
+    xml_parser = XMLData(item_tag="LEIRecord", namespace=namespace, filter=['NextVersion', 'Extension'])
+    expected = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    xml_parser = XMLData(item_tag="LEIRecord", namespace=namespace, filter=['NextVersion', 'Extension'],
+                         engine=engine, workers=2, shard_size=5000, ordered=ordered)
+    items = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    if ordered:
+        assert items == expected
+    else:
+        assert sorted(items, key=lambda x: x['LEI']) == sorted(expected, key=lambda x: x['LEI'])
+    assert len(items) == 13
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("buffer_size, mmap", [(1024, False), (1024, True), (1048576, True)])
+async def test_xml_parser_buffering(lei_xml_data_file, buffer_size, mmap):
+    """Test buffer size and memory mapped reads produce same items as default reader"""
+    items = {}
+    for options in ({}, {"buffer_size": buffer_size, "mmap": mmap}):
+        xml_parser = XMLData(item_tag="LEIRecord",
+                             namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016",
+                                        "gleif": "http://www.gleif.org/data/schema/golden-copy/extensions/1.0"},
+                             filter=['NextVersion', 'Extension'],
+                             **options)
+        items[bool(options)] = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    assert len(items[True]) > 0
+    assert items[True] == items[False]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["etree", "lxml"])
+async def test_xml_parser_projection(lei_xml_data_file, engine):
+    """Test XML parser only keeps projected elements"""
+    xml_parser = XMLData(item_tag="LEIRecord",
+                         namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                         filter=['NextVersion', 'Extension'],
+                         engine=engine,
+                         projection=["LEI", "Entity/LegalName", "Entity/LegalAddress",
+                                     "Entity/OtherEntityNames", "Registration/LastUpdateDate",
+                                     "Registration/Missing/Element"])
+    items = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    assert len(items) > 0
+    for item in items:
+        assert set(item) == {"LEI", "Entity", "Registration"}
+        assert set(item["Entity"]) - {"OtherEntityNames"} == {"LegalName", "LegalAddress"}
+        assert set(item["Registration"]) == {"LastUpdateDate"}
+    assert items[0]['Entity']['LegalAddress'] == {'FirstAddressLine': '245 SUMMER STREET', 'City': 'BOSTON',
+                                                  'Region': 'US-MA', 'Country': 'US', 'PostalCode': '02210'}
+    assert items[0]['Entity']['OtherEntityNames'] == [{'type': 'PREVIOUS_LEGAL_NAME',
+                'OtherEntityName': 'FIDELITY ADVISOR SERIES I - Fidelity Advisor Leveraged Company Stock Fund'}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["etree", "lxml"])
+async def test_xml_parser_threaded(lei_xml_data_file, engine):
+    """Test XML parser in background thread produces same items as in-loop parser"""
+    items = {}
+    for threaded in (False, True):
+        xml_parser = XMLData(item_tag="LEIRecord",
+                             namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                             filter=['NextVersion', 'Extension'],
+                             engine=engine,
+                             threaded=threaded,
+                             queue_size=1,
+                             batch_size=3)
+        items[threaded] = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    assert len(items[True]) > 0
+    assert items[True] == items[False]
+
+
+@pytest.mark.asyncio
+async def test_xml_parser_threaded_close(lei_xml_data_file):
+    """Test closing threaded XML parser stream early stops background thread"""
+    xml_parser = XMLData(item_tag="LEIRecord",
+                         namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                         filter=['NextVersion', 'Extension'],
+                         threaded=True,
+                         queue_size=1,
+                         batch_size=1)
+    async with aclosing(xml_parser.process(lei_xml_data_file)) as stream:
+        async for header, item in stream:
+            assert item['LEI'] == '001GPB6A9XPE8XJICC14'
+            break
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine, threaded", [("etree", False), ("lxml", False), ("lxml", True)])
+async def test_xml_parser_checkpoint(lei_xml_data_file, tmp_path, engine, threaded):
+    """Test XML parser resumes from last acknowledged checkpoint after interrupted run"""
+    def parser():
+        return XMLData(item_tag="LEIRecord",
+                       namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                       filter=['NextVersion', 'Extension'],
+                       engine=engine,
+                       buffer_size=1024,
+                       threaded=threaded,
+                       checkpoint=True,
+                       checkpoint_interval=2)
+    expected = [item async for header, item in parser().process(lei_xml_data_file)]
+    processed = []
+    markers = []
+    async with aclosing(parser().process(lei_xml_data_file, stage_dir=tmp_path)) as stream:
+        async for header, item in stream:
+            if is_flush(item):
+                # Output only acknowledges first two flush markers (items before third not durable)
+                markers.append(item)
+                if len(markers) <= 2: acknowledge_flush(item)
+                continue
+            processed.append(item)
+            if len(processed) == 7: break
+    assert len(markers) == 3
+    checkpoint = json.loads((tmp_path / "lei-data.xml.checkpoint").read_text())
+    assert checkpoint["count"] == 4
+    resumed = []
+    async for header, item in parser().process(lei_xml_data_file, stage_dir=tmp_path):
+        if is_flush(item):
+            acknowledge_flush(item)
+        else:
+            resumed.append(item)
+    assert processed[:4] + resumed == expected
+    assert not (tmp_path / "lei-data.xml.checkpoint").exists()
+
+
+@pytest.mark.asyncio
+async def test_xml_parser_cache(lei_xml_data_file, tmp_path):
+    """Test XML parser writes parsed items to cache and reads them back"""
+    xml_parser = XMLData(item_tag="LEIRecord",
+                         namespace={"lei": "http://www.gleif.org/data/schema/leidata/2016"},
+                         filter=['NextVersion', 'Extension'],
+                         cache=True)
+    expected = [item async for header, item in xml_parser.process(lei_xml_data_file)]
+    parsed = [item async for header, item in xml_parser.process(lei_xml_data_file, stage_dir=tmp_path)]
+    cache_files = list((tmp_path / "cache").iterdir())
+    assert len(cache_files) == 1 and cache_files[0].suffix == ".records"
+    with patch("bodspipelines.infrastructure.processing.xml_data.data_stream") as mock_stream:
+        cached = [item async for header, item in xml_parser.process(lei_xml_data_file, stage_dir=tmp_path)]
+        assert not mock_stream.called
+    assert parsed == expected
+    assert cached == expected
+
+
+def test_cache_path_file_version(lei_xml_data_file, tmp_path):
+    """Test cache key follows file size and modification time, without reading file"""
+    from bodspipelines.infrastructure.processing.record_cache import cache_path
+    data_file = tmp_path / "lei-data.xml"
+    data_file.write_bytes(lei_xml_data_file.read_bytes())
+    config = ("LEIRecord", None)
+    with patch("builtins.open") as mock_open:
+        path = cache_path(tmp_path / "cache", data_file, config)
+        assert not mock_open.called
+    assert cache_path(tmp_path / "cache", data_file, config) == path
+    assert cache_path(tmp_path / "cache", data_file, ("Exception", None)) != path
+    stat = data_file.stat()
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache_path(tmp_path / "cache", data_file, config) != path
+
+
+@pytest.mark.asyncio
+async def test_stream_file_not_blocking(lei_xml_data_file):
+    """Test reading file buffers does not block other tasks"""
+    from bodspipelines.infrastructure.processing.xml_data import stream_file, read_file
+    def slow_read(*args, **kwargs):
+        for data in read_file(*args, **kwargs):
+            time.sleep(0.02)
+            yield data
+    ticks = 0
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.005)
+            ticks += 1
+    task = asyncio.create_task(ticker())
+    with patch("bodspipelines.infrastructure.processing.xml_data.read_file", side_effect=slow_read):
+        data = b"".join([chunk async for chunk in stream_file(lei_xml_data_file, buffer_size=4096)])
+    task.cancel()
+    assert data == lei_xml_data_file.read_bytes()
+    assert ticks > 10